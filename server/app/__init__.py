@@ -1,6 +1,11 @@
+import logging
+import os
+
 from flask import Flask
 from flask_session import Session
 
+logger = logging.getLogger(__name__)
+
 
 def create_app():
     app = Flask(__name__)
@@ -19,4 +24,31 @@ def create_app():
     from .routes import api_bp
     app.register_blueprint(api_bp)
 
+    # create the pooled metadata engine and its tables before serving requests
+    from .utils import init_db
+    db = None
+    try:
+        db = init_db()
+    except Exception as e:
+        logger.exception(e)
+        logger.info("Metadata database not ready, will retry on first request")
+
+    # load the embedding model once, before the first keystroke needs it
+    from .utils.embeddings import warm_up_embeddings
+    try:
+        warm_up_embeddings()
+    except Exception as e:
+        logger.exception(e)
+
+    # continue generating the sample queries a previous run left pending, once per server
+    first_worker = int(os.environ.get('SERVER_WORKER_AGE', 1)) <= 1
+    if db is not None and first_worker and os.environ.get('USE_DATABASE') and os.environ.get('GET_SAMPLE_QUERIES', False) and not os.environ.get('EMBEDDING_SERVER'):
+        from .utils.embeddings import select_embeddings
+        from .utils.indexes import select_index
+        from .utils.sample_queries import resume_sample_queries
+        try:
+            resume_sample_queries(db, select_index(), select_embeddings())
+        except Exception as e:
+            logger.exception(e)
+
     return app
@@ -1,16 +1,23 @@
 import time
 
-from flask import Blueprint, Flask, jsonify, make_response, request
+from flask import Blueprint, Flask, Response, g, jsonify, make_response, request, session, stream_with_context
 from flask_cors import CORS, cross_origin
 from dotenv import load_dotenv
+import json
 import os
 import openai
 from .utils.embeddings import select_embeddings
-from .utils.autocomplete import autocomplete_query_suggestions, generate_queries_for_schema
-from .utils.indexes import select_index
+from .utils.autocomplete import autocomplete_query_suggestions, stream_autocomplete_suggestions
+from .utils.indexes import FaissEngine, select_index
+from .utils.jobs import discover_jobs
+from .utils.residency import residency
+from .utils.write_buffer import write_buffer
 from .utils.repair import repair_query_suggestions
-from .utils import connect_to_db, explain_query
-from threading import Thread
+from .utils.deadline import INDEX_SHARE, Deadline, DeadlineExceeded
+from .utils.sequencing import RequestSuperseded, request_sequencer
+from .utils.speculative import schedule_prefetch
+from .utils.metrics import render_metrics, request_seconds
+from .utils import ann, connect_to_db, init_db
 import logging
 
 logger = logging.getLogger(__name__)
@@ -25,6 +32,26 @@ load_dotenv()
 openai.api_key = os.environ.get('OPENAI_API_KEY')
 TOTAL_AUTOCOMPLETE_TIME = os.environ.get('TOTAL_AUTOCOMPLETE_TIME', 3)
 TOTAL_REPAIR_TIME = os.environ.get('TOTAL_REPAIR_TIME', 10)
+AUTOCOMPLETE_DEBOUNCE = float(os.environ.get('AUTOCOMPLETE_DEBOUNCE_MS', 0)) / 1000
+
+
+@api_bp.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@api_bp.after_request
+def observe_request(response):
+    # labelled by route, not by path, so the number of series stays bounded
+    if request.method != 'OPTIONS' and request.url_rule is not None and request.url_rule.rule != '/metrics':
+        request_seconds.labels(request.url_rule.rule).observe(time.perf_counter() - g.request_start)
+    return response
+
+
+@api_bp.route('/metrics', methods=['GET'])
+def metrics():
+    content, content_type = render_metrics()
+    return Response(content, content_type=content_type)
 
 
 @api_bp.route('/discover', methods=['OPTIONS', 'POST'])
@@ -38,49 +65,42 @@ def discover():
     if error:
         return error
 
-    index_engine = select_index()
-
-    embeddings = select_embeddings()
-    docsearch = index_engine.read_index(db, embeddings)
-
-    texts = []
-    metadatas = []
-    table_queries = {}
+    tables_info = {}
     schema_dict = request.json.get('schema', None)
     tables = schema_dict.keys()
     table_info_dict = request.json.get('tables_info', None)
     for table in tables:
         info = table_info_dict[table].replace('\r', ' ').replace('\t', ' ').replace('\n', ' ') if table_info_dict else None
-        texts.append(info)
-        metadatas.append({'type': 'schema'})
-        if os.environ.get('GET_SAMPLE_QUERIES', False):
-            table_queries[table] = info
+        tables_info[table] = info or table
 
-    # add to a vector search using embeddings
-    docsearch = index_engine.read_index_contents(texts, embeddings, metadatas)
-    index_engine.write_index(db, docsearch)
+    # embedded and written by a job process, the previous index version keeps serving until it is swapped in
+    job, active = discover_jobs.submit(db, session['conn_str'], tables_info, dialect, schema_dict)
+    if job is None:
+        return make_response(jsonify({'error': 'A discover job is already running', 'job': public_job(active)}), 409)
+    return make_response(jsonify({'status': 'queued', 'job': public_job(job)}), 202)
 
-    # add sample queries
-    if os.environ.get('GET_SAMPLE_QUERIES', False):
-        # run the generate_and_save_sample_queries in a new thread to not block the code execution
-        thread = Thread(target=generate_and_save_sample_queries,
-                        args=(table_queries, dialect, schema_dict, docsearch))
-        thread.start()
 
-    index_engine.write_index(db, docsearch)
+@api_bp.route('/discover/<job_id>', methods=['OPTIONS', 'POST'])
+@cross_origin(origin='http://localhost:3000', supports_credentials=True)
+def discover_status(job_id):
+    if request.method == 'OPTIONS':
+        return make_response(jsonify({}), 200)
 
-    response = jsonify({"status": 'OK'})
-    return response
+    db, error = connect_to_db(request)
+    if error:
+        return error
 
+    # only the jobs of the database of the request
+    job = discover_jobs.get(db, job_id)
+    if job is None or job['name'] != session['conn_str']:
+        return make_response(jsonify({'error': 'Job not found'}), 404)
+    return jsonify(public_job(job))
 
-def generate_and_save_sample_queries(table_queries, dialect, schema_dict, docsearch):
-    logger.info('Started generating sample queries')
-    for info in table_queries.values():
-        queries = generate_queries_for_schema(info, schema_dict, dialect)
-        if (queries and len(queries) > 0):
-            for query in queries:
-                docsearch.add_texts([query], [{'type': 'query'}])
-    logger.info('Finished generating sample queries')
+
+def public_job(job):
+    if job is None:
+        return None
+    return {key: value for key, value in job.items() if key != 'name'}
 
 
 @api_bp.route('/autocomplete', methods=['OPTIONS', 'POST'])
@@ -94,16 +114,48 @@ def autocomplete():
     if error:
         return error
 
+    ticket = request_ticket()
+    try:
+        return autocomplete_ticket(db, dialect, ticket)
+    except RequestSuperseded:
+        return jsonify({'suggestions': [], 'superseded': True})
+    finally:
+        request_sequencer.finish(ticket)
+
+
+def request_ticket():
+    # a newer request from the same editor session cancels this one, wherever it is; only the requests
+    # naming their session_id are sequenced, and only against the others served by this process
+    session_id = request.json.get('session_id', None)
+    key = (session['conn_str'], session_id) if session_id else None
+    return request_sequencer.start(key, request.json.get('sequence', None))
+
+
+def autocomplete_ticket(db, dialect, ticket):
+    # wait for a pause in the typing before doing any work
+    if ticket.superseded() or (AUTOCOMPLETE_DEBOUNCE > 0 and ticket.cancelled.wait(AUTOCOMPLETE_DEBOUNCE)):
+        raise RequestSuperseded()
+
     index_engine = select_index()
 
+    # every stage gets a share of the total time, past it we answer with what we have
+    deadline = Deadline(float(TOTAL_AUTOCOMPLETE_TIME), ticket.cancelled)
     embeddings = select_embeddings()
-    docsearch = index_engine.read_index(db, embeddings)
+    try:
+        docsearch = deadline.run(INDEX_SHARE, index_engine.read_index, db, embeddings, name=session['conn_str'])
+    except DeadlineExceeded:
+        # the load goes on in the background and lands in the cache for the next request
+        logger.warning("Deadline exceeded while loading the index")
+        return jsonify({'suggestions': []})
     if docsearch is not None:
         query = request.json.get('query', None)
         if query:
             # execute query autocompletion
             result = autocomplete_query_suggestions(
-                query.strip(), docsearch, dialect)
+                query.strip(), docsearch, dialect, session['conn_str'], index_engine.version, deadline,
+                request.json.get('conn_str', None))
+            # get ahead of the next keystrokes, in the background
+            schedule_prefetch(query.strip(), docsearch, dialect, session['conn_str'], index_engine.version)
             response = jsonify({'suggestions': result})
             return response
         else:
@@ -112,13 +164,69 @@ def autocomplete():
         return make_response(jsonify({'error': 'Error retrieving index'}), 500)
 
 
+@api_bp.route('/autocomplete/stream', methods=['OPTIONS', 'POST'])
+@cross_origin(origin='http://localhost:3000', supports_credentials=True)
+def autocomplete_stream():
+    if request.method == 'OPTIONS':
+        return make_response(jsonify({}), 200)
+
+    db, error = connect_to_db(request)
+    dialect = request.json.get('dialect', 'postgresql')
+    if error:
+        return error
+
+    query = request.json.get('query', None)
+    if not query:
+        return make_response(jsonify({'error': 'No query provided'}), 400)
+    index_engine = select_index()
+
+    # the same stage budgets and sequencing as /autocomplete, the stream ends with what we have once
+    # they are spent, or as soon as a newer request of the session arrives
+    ticket = request_ticket()
+    deadline = Deadline(float(TOTAL_AUTOCOMPLETE_TIME), ticket.cancelled)
+    embeddings = select_embeddings()
+    try:
+        docsearch = deadline.run(INDEX_SHARE, index_engine.read_index, db, embeddings, name=session['conn_str'])
+    except DeadlineExceeded:
+        # the load goes on in the background and lands in the cache for the next request
+        logger.warning("Deadline exceeded while loading the index")
+        events = iter([('suggestions', {'suggestions': []})])
+    except RequestSuperseded:
+        events = iter([])
+    else:
+        if docsearch is None:
+            request_sequencer.finish(ticket)
+            return make_response(jsonify({'error': 'Error retrieving index'}), 500)
+        # server-sent events: tokens as the llm produces them, then the final suggestions
+        events = stream_autocomplete_suggestions(
+            query.strip(), docsearch, dialect, session['conn_str'], index_engine.version, deadline,
+            request.json.get('conn_str', None))
+
+    def generate():
+        try:
+            for event, data in events:
+                yield 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data))
+        except RequestSuperseded:
+            pass
+        except Exception as e:
+            logger.exception(e)
+            yield 'event: error\ndata: {}\n\n'.format(json.dumps({'error': 'Error generating suggestions'}))
+        finally:
+            request_sequencer.finish(ticket)
+        if ticket.superseded():
+            yield 'event: suggestions\ndata: {}\n\n'.format(json.dumps({'suggestions': [], 'superseded': True}))
+        yield 'event: done\ndata: {}\n\n'
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @api_bp.route('/repair', methods=['OPTIONS', 'POST'])
 @cross_origin(origin='http://localhost:3000', supports_credentials=True)
 def repair():
     if request.method == 'OPTIONS':
         return make_response(jsonify({}), 200)
 
-    # st = time.time()
     db, error = connect_to_db(request)
     dialect = request.json.get('dialect', 'postgresql')
     if error:
@@ -126,15 +234,21 @@ def repair():
 
     index_engine = select_index()
 
+    deadline = Deadline(float(TOTAL_REPAIR_TIME))
     embeddings = select_embeddings()
-    docsearch = index_engine.read_index(db, embeddings)
+    try:
+        docsearch = deadline.run(INDEX_SHARE, index_engine.read_index, db, embeddings, name=session['conn_str'])
+    except DeadlineExceeded:
+        logger.warning("Deadline exceeded while loading the index")
+        return jsonify({'suggestions': []})
     if docsearch is not None:
         query = request.json.get('query', None)
         error_message = request.json.get('error_message', None)
         if query and error_message:
             # execute query repair
             result = repair_query_suggestions(
-                query.strip(), error_message.strip(), docsearch, dialect)
+                query.strip(), error_message.strip(), docsearch, dialect, session['conn_str'], index_engine.version, deadline,
+                request.json.get('conn_str', None))
             response = jsonify({'suggestions': result})
             return response
         else:
@@ -143,6 +257,20 @@ def repair():
         return make_response(jsonify({'error': 'Error retrieving index'}), 500)
 
 
+@api_bp.route('/embeddings', methods=['POST'])
+def embed():
+    # only served by the dedicated embedding worker
+    if not os.environ.get('EMBEDDING_SERVER'):
+        return make_response(jsonify({'error': 'Not found'}), 404)
+
+    texts = request.json.get('texts', None)
+    if not isinstance(texts, list):
+        return make_response(jsonify({'error': 'No texts provided'}), 400)
+
+    embeddings = select_embeddings()
+    return jsonify({'embeddings': embeddings.embed_documents(texts)})
+
+
 @api_bp.route('/add', methods=['OPTIONS', 'POST'])
 @cross_origin(origin='http://localhost:3000', supports_credentials=True)
 def add():
@@ -153,17 +281,55 @@ def add():
     if error:
         return error
 
+    # accepts a single query, or a list of them
+    queries = request.json.get('queries', None) or []
+    query = request.json.get('query', None) or ''
+    if not isinstance(queries, list) or not all(isinstance(item, str) for item in queries) \
+            or not isinstance(query, str):
+        return make_response(jsonify({'error': 'queries must be a list of strings, and query a string'}), 400)
+    queries = [query for query in queries + [query] if query.strip()]
+    if len(queries) == 0:
+        return make_response(jsonify({'error': 'No query provided'}), 400)
+
     index_engine = select_index()
-    embeddings = select_embeddings()
-    docsearch = index_engine.read_index(db, embeddings)
-    if docsearch is not None:
-        query = request.json.get('query', None)
-        if query:
-            docsearch.add_texts([query], [{'type': 'query'}])
-            index_engine.write_index(db, docsearch)
-            response = jsonify({"status": 'OK'})
-            return response
-        else:
-            return make_response(jsonify({'error': 'No query provided'}), 400)
-    else:
+    name = session['conn_str']
+    if index_engine.index_version(db, "index-{}".format(name), name) is None:
         return make_response(jsonify({'error': 'Cannot query without docsearch base'}), 500)
+
+    # embedded and persisted in batches, without blocking the request
+    write_buffer.add(name, db, index_engine, select_embeddings(),
+                     queries, [{'type': 'query'} for _ in queries])
+    return make_response(jsonify({"status": 'OK', "queued": len(queries)}), 202)
+
+
+@api_bp.route('/index/ann', methods=['OPTIONS', 'POST'])
+@cross_origin(origin='http://localhost:3000', supports_credentials=True)
+def ann_report():
+    if request.method == 'OPTIONS':
+        return make_response(jsonify({}), 200)
+
+    db, error = connect_to_db(request)
+    if error:
+        return error
+
+    index_engine = select_index()
+    if not isinstance(index_engine, FaissEngine):
+        return make_response(jsonify({'error': 'Only available for FAISS'}), 400)
+    docsearch = index_engine.read_index(db, select_embeddings())
+    if docsearch is None:
+        return make_response(jsonify({'error': 'Error retrieving index'}), 500)
+
+    # recall@k and latency of every index type on this database's vectors, to tune the thresholds
+    report = ann.evaluate(docsearch, int(request.json.get('sample', 100)), int(request.json.get('k', 10)))
+    return jsonify(report)
+
+
+@api_bp.route('/index/residency', methods=['GET'])
+def residency_report():
+    # tenants and bytes in each tier across the server, to size the memory and disk budgets
+    try:
+        db = init_db() if os.environ.get('USE_DATABASE') else None
+    except Exception as e:
+        logger.exception(e)
+        db = None
+    return jsonify(residency.stats(db))
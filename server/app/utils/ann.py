@@ -0,0 +1,170 @@
+import math
+import os
+import time
+import faiss
+import numpy as np
+
+# 'auto' picks the index type by document count, or one of flat, hnsw, ivf, ivfpq for all indexes
+INDEX_TYPE = os.environ.get('INDEX_TYPE', 'auto')
+HNSW_THRESHOLD = int(os.environ.get('ANN_HNSW_THRESHOLD', 10000))
+IVF_THRESHOLD = int(os.environ.get('ANN_IVF_THRESHOLD', 100000))
+IVFPQ_THRESHOLD = int(os.environ.get('ANN_IVFPQ_THRESHOLD', 1000000))
+HNSW_M = int(os.environ.get('ANN_HNSW_M', 32))
+HNSW_EF_SEARCH = int(os.environ.get('ANN_HNSW_EF_SEARCH', 64))
+IVF_NPROBE = int(os.environ.get('ANN_IVF_NPROBE', 16))
+
+# from least to most approximate, indexes are only ever upgraded along this order
+INDEX_TYPES = ['flat', 'hnsw', 'ivf', 'ivfpq']
+
+# an ivf index is retrained once it holds this many times the documents it was trained for
+RETRAIN_GROWTH = 4
+
+
+def choose_type(count):
+    if INDEX_TYPE in INDEX_TYPES:
+        return INDEX_TYPE
+    if count >= IVFPQ_THRESHOLD:
+        return 'ivfpq'
+    if count >= IVF_THRESHOLD:
+        return 'ivf'
+    if count >= HNSW_THRESHOLD:
+        return 'hnsw'
+    return 'flat'
+
+
+def index_type(index):
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return 'hnsw'
+    if isinstance(index, faiss.IndexIVFPQ):
+        return 'ivfpq'
+    if isinstance(index, faiss.IndexIVF):
+        return 'ivf'
+    return 'flat'
+
+
+def nlist_for(count):
+    # about 4 * sqrt(n) lists, with enough training points for each of them
+    return max(1, min(int(4 * math.sqrt(count)), count // 39))
+
+
+def pq_subquantizers(dimension):
+    # the largest divisor of the dimension up to 64, each sub-vector gets one byte
+    for m in range(min(64, dimension), 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+
+def buildable_type(kind, count):
+    # trained types need enough documents to train on, otherwise the next simpler one is built
+    if kind == 'ivfpq' and count < 256 * 39:
+        kind = 'ivf'
+    if kind == 'ivf' and count < 39:
+        kind = 'flat'
+    return kind
+
+
+def build_index(kind, vectors, metric=faiss.METRIC_L2):
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    count, dimension = vectors.shape
+    kind = buildable_type(kind, count)
+    if kind == 'hnsw':
+        index = faiss.IndexHNSWFlat(dimension, HNSW_M, metric)
+        index.hnsw.efConstruction = max(40, 2 * HNSW_M)
+    elif kind == 'ivfpq':
+        quantizer = faiss.IndexFlat(dimension, metric)
+        index = faiss.IndexIVFPQ(quantizer, dimension, nlist_for(count), pq_subquantizers(dimension), 8, metric)
+        index.train(vectors)
+    elif kind == 'ivf':
+        quantizer = faiss.IndexFlat(dimension, metric)
+        index = faiss.IndexIVFFlat(quantizer, dimension, nlist_for(count), metric)
+        index.train(vectors)
+    else:
+        index = faiss.IndexFlat(dimension, metric)
+    tune(index)
+    if count > 0:
+        index.add(vectors)
+    return index
+
+
+def tune(index):
+    # search parameters come from the environment, not from the stored index
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    elif isinstance(index, faiss.IndexIVF):
+        index.nprobe = min(IVF_NPROBE, index.nlist)
+
+
+def reconstruct_vectors(index):
+    # approximate for pq, which is only ever the last upgrade
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype=np.float32)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def target_type(docsearch):
+    # the type the index should be upgraded or retrained to, None when it is fine as it is
+    index = docsearch.index
+    current = index_type(index)
+    target = buildable_type(choose_type(index.ntotal), index.ntotal)
+    if INDEX_TYPES.index(target) > INDEX_TYPES.index(current) or (INDEX_TYPE in INDEX_TYPES and target != current):
+        return target
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and nlist_for(index.ntotal) >= ivf.nlist * RETRAIN_GROWTH:
+        return current
+    return None
+
+
+def convert(docsearch, kind):
+    # positions are kept, so index_to_docstore_id stays valid
+    vectors = reconstruct_vectors(docsearch.index)
+    docsearch.index = build_index(kind, vectors, docsearch.index.metric_type)
+    return docsearch
+
+
+def remove_documents(docsearch, ids):
+    if index_type(docsearch.index) == 'flat':
+        docsearch.delete(ids)
+        return docsearch
+    # hnsw can't remove vectors, and ivf keeps the labels of the vectors after the removed ones,
+    # which then don't match index_to_docstore_id anymore: the index is rebuilt without them
+    removed = set(ids)
+    positions = sorted(docsearch.index_to_docstore_id.items())
+    keep = [i for i, doc_id in positions if doc_id not in removed]
+    vectors = reconstruct_vectors(docsearch.index)[keep]
+    docsearch.index = build_index(index_type(docsearch.index), vectors, docsearch.index.metric_type)
+    docsearch.docstore.delete([doc_id for _, doc_id in positions if doc_id in removed])
+    docsearch.index_to_docstore_id = {i: docsearch.index_to_docstore_id[position] for i, position in enumerate(keep)}
+    return docsearch
+
+
+def evaluate(docsearch, sample=100, k=10):
+    # recall@k against exact search, and search latency, of every index type on this index's vectors
+    vectors = reconstruct_vectors(docsearch.index)
+    count = len(vectors)
+    report = {'documents': count, 'current': index_type(docsearch.index), 'recommended': choose_type(count), 'types': {}}
+    if count == 0:
+        return report
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(count, size=min(sample, count), replace=False)]
+    queries = queries + rng.normal(scale=1e-3, size=queries.shape).astype(np.float32)
+    exact = None
+    for kind in INDEX_TYPES:
+        start = time.perf_counter()
+        index = build_index(kind, vectors, docsearch.index.metric_type)
+        build_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        _, found = index.search(queries, min(k, count))
+        latency = (time.perf_counter() - start) / len(queries)
+        if exact is None:
+            exact = found
+        recall = np.mean([len(set(found[i]) & set(exact[i])) / len(exact[i]) for i in range(len(queries))])
+        report['types'][kind] = {'built_as': index_type(index), 'recall': round(float(recall), 4),
+                                 'latency_ms': round(latency * 1000, 4), 'build_seconds': round(build_seconds, 3),
+                                 'bytes': len(faiss.serialize_index(index))}
+    return report
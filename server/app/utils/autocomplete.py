@@ -1,14 +1,22 @@
 import json
 import logging
 import sys
-import requests
-from requests.auth import HTTPBasicAuth
-from . import extract_queries_from_result
+from . import extract_candidates, extract_queries_from_result
+from .completion_cache import completion_cache
+from .embeddings import select_embeddings
+from .indexes import select_index
+from .llm_client import llm_client
+from .metrics import record_prompt, span
+from .prompt import build_table_info
+from .prefix import normalize, prefix_index_for
+from .deadline import RETRIEVAL_SHARE, DeadlineExceeded, run_stage
+from .retrieval import best_stored_query, lexical_documents, retrieval_cache, retrieve_documents
+from .sequencing import RequestSuperseded
+from .validation import rank_candidates
 from langchain import PromptTemplate, LLMChain
 from langchain.chat_models import ChatOpenAI
 from langchain.llms import OpenAI
 import os
-import logging
 from difflib import SequenceMatcher
 
 logger = logging.getLogger(__name__)
@@ -65,18 +73,14 @@ The output needs to be just a JSON list with this format:
 Only provide this list without any additional output.
 """)
 
-MAX_SIMILARITY_RATIO = os.environ.get('MAX_SIMILARITY_RATIO', 0.55)
+MAX_SIMILARITY_RATIO = float(os.environ.get('MAX_SIMILARITY_RATIO', 0.55))
 
 
-def predict(llm, query, docsearch, dialect):    
-    # different search types
-    if (os.environ.get('SEARCH_TYPE', 'similarity') == 'mmr'):
-        docs = docsearch.max_marginal_relevance_search(
-            query, k=int(os.environ.get('DOCS_TO_RETRIEVE', 5)))
-    else:
-        docs = docsearch.similarity_search(
-            query, k=int(os.environ.get('DOCS_TO_RETRIEVE', 5)))
+# generation stops at the end of the first query, we don't pay for anything past it
+STOP_SEQUENCES = [';']
+
 
+def stored_query_match(query, docs):
     for doc in docs:
         if (doc.metadata['type'] == 'query' and doc.page_content):
             if (doc.page_content.strip().startswith(query.strip())):
@@ -85,88 +89,266 @@ def predict(llm, query, docsearch, dialect):
                 if s.ratio() > MAX_SIMILARITY_RATIO:
                     # very similar, will match
                     return doc.page_content
+    return None
+
+
+def predict(llm, query, docs, dialect):
+    # every answer the llm gave, when asked for several
+    stored_query = stored_query_match(query, docs)
+    if stored_query is not None:
+        return [stored_query]
 
     #  no queries stored, go with llm
     prompt = PromptTemplate(
         input_variables=["query", "table_info", "dialect"], template=CUSTOM_TEMPLATE)
     llm_chain = LLMChain(llm=llm, prompt=prompt)
-    res = llm_chain.predict(table_info=docs, query=query, dialect=dialect)
-    logger.info("Result from LLM: "+res)
+    table_info = build_table_info(docs)
+    record_prompt('autocomplete', prompt.format(table_info=table_info, query=query, dialect=dialect))
+    with span('llm_autocomplete'):
+        result = llm_chain.generate([{'table_info': table_info, 'query': query, 'dialect': dialect, 'stop': STOP_SEQUENCES}])
+    res = [generation.text for generation in result.generations[0]]
+    logger.info("Result from LLM: {}".format(res))
     return res
 
-def autocomplete_chat(query, docsearch, dialect):
+
+def stream_chat(query, docs, dialect, timeout=None):
+    llm = ChatOpenAI(temperature=os.environ.get('TEMPERATURE', 0.9),
+                     model_name=os.environ.get('LLM_MODEL', 'gpt-3.5-turbo'), streaming=True,
+                     **llm_timeout_args(timeout))
+    prompt = PromptTemplate(
+        input_variables=["query", "table_info", "dialect"], template=CUSTOM_TEMPLATE)
+    text = prompt.format(query=query, table_info=build_table_info(docs), dialect=dialect)
+    record_prompt('autocomplete', text)
+    with span('llm_autocomplete'):
+        for chunk in llm.stream(text, stop=STOP_SEQUENCES):
+            token = chunk.content
+            if ';' in token:
+                # closing the stream as soon as the query is complete
+                yield token.split(';')[0] + ';'
+                return
+            yield token
+
+
+def llm_timeout_args(timeout):
+    # no retries once bound to a deadline, they would only outlive it
+    if timeout is None:
+        return {}
+    return {'request_timeout': timeout, 'max_retries': 0}
+
+
+def autocomplete_chat(query, docs, dialect, timeout=None, cancelled=None):
+    answers = int(os.environ.get('OPENAI_NUM_ANSWERS', 1))
+    # several answers can't be streamed, a superseded request only stops waiting for them
+    if cancelled is not None and answers == 1:
+        return cancellable_chat(query, docs, dialect, timeout, cancelled)
     llm = ChatOpenAI(temperature=os.environ.get('TEMPERATURE', 0.9),
-                     model_name=os.environ.get('LLM_MODEL', 'gpt-3.5-turbo'), n=int(os.environ.get('OPENAI_NUM_ANSWERS', 1)))
-    res = predict(llm, query, docsearch, dialect)
-    final_queries = extract_queries_from_result(res)
+                     model_name=os.environ.get('LLM_MODEL', 'gpt-3.5-turbo'), n=answers,
+                     **llm_timeout_args(timeout))
+    res = predict(llm, query, docs, dialect)
+    if cancelled is not None and cancelled.is_set():
+        raise RequestSuperseded()
+    final_queries = extract_candidates(res)
     return final_queries
 
-def autocomplete_selfhosted(query, docsearch, dialect):
-    # different search types
-    if (os.environ.get('SEARCH_TYPE', 'similarity') == 'mmr'):
-        docs = docsearch.max_marginal_relevance_search(
-            query, k=int(os.environ.get('DOCS_TO_RETRIEVE', 5)))
-    else:
-        docs = docsearch.similarity_search(
-            query, k=int(os.environ.get('DOCS_TO_RETRIEVE', 5)))
 
+def cancellable_chat(query, docs, dialect, timeout, cancelled):
+    # streamed, so a superseded request closes the llm call as soon as it is noticed
+    stored_query = stored_query_match(query, docs)
+    if stored_query is not None:
+        return extract_queries_from_result(stored_query)
+    result = ''
+    for token in stream_chat(query, docs, dialect, timeout):
+        if cancelled.is_set():
+            raise RequestSuperseded()
+        result += token
+    logger.info("Result from LLM: "+result)
+    return extract_queries_from_result(result)
+
+
+def autocomplete_selfhosted(query, docs, dialect, timeout=None, cancelled=None):
     prompt = PromptTemplate(
         input_variables=["query", "table_info", "dialect"], template=CUSTOM_TEMPLATE)
-    query = prompt.format(query=query, table_info=docs, dialect=dialect)
-
-    # issue a request to an external API
-    request = {
-        'prompt': query,
-        'temperature': float(os.environ.get('TEMPERATURE', 1.3)),
-        'top_p': 0.1,
-        'typical_p': 1,
-        'repetition_penalty': 1.18,
-        'top_k': 40,
-        'min_length': 0,
-        'no_repeat_ngram_size': 0,
-        'num_beams': 1,
-        'penalty_alpha': 0,
-        'length_penalty': 1,
-        'early_stopping': False,
-        'seed': -1,
-        'add_bos_token': True,
-        'truncation_length': 2048,
-        'ban_eos_token': False,
-        'skip_special_tokens': True,
-        'stopping_strings': []
-    }
+    query = prompt.format(query=query, table_info=build_table_info(docs), dialect=dialect)
 
     try:
-        response = requests.post(os.environ.get('LLM_HOST', ''), json=request, auth=HTTPBasicAuth(
-            os.environ.get('LLM_USER', ''), os.environ.get('LLM_PASSWORD', '')))
-        if response.status_code == 200:
-            result = response.json()['results'][0]['text']
-            logger.info("Result from LLM: "+result)
-            final_queries = extract_queries_from_result(result)
-            return final_queries
+        results = llm_client.complete_candidates(query, 'autocomplete', timeout, cancelled, stopping_strings=STOP_SEQUENCES)
+        logger.info("Result from LLM: {}".format(results))
+        return extract_candidates(results)
+    except RequestSuperseded:
+        raise
     except Exception as e:
-        logger.exception("Error in autocomplete_selfhosted: "+e)
+        logger.exception(e)
 
     return None
 
 
-def autocomplete_query_suggestions(query, docsearch, dialect):
-    if os.environ.get('AUTOCOMPLETE_METHOD', 'chat') == 'chat':
-        queries = autocomplete_chat(query, docsearch, dialect)
-    elif os.environ.get('AUTOCOMPLETE_METHOD', 'chat') == 'selfhosted':
-        queries = autocomplete_selfhosted(query, docsearch, dialect)
+def generate_suggestions(query, docs, dialect, timeout=None, cancelled=None):
+    if os.environ.get('AUTOCOMPLETE_METHOD', 'chat') == 'selfhosted':
+        return autocomplete_selfhosted(query, docs, dialect, timeout, cancelled)
+    return autocomplete_chat(query, docs, dialect, timeout, cancelled)
+
+
+def prefix_suggestions(query, docsearch):
+    # stored queries starting with the typed text, found without any embedding or llm call
+    try:
+        prefix_index = prefix_index_for(select_index(), docsearch)
+        return prefix_index.complete(query, MAX_SIMILARITY_RATIO, int(os.environ.get('PREFIX_SUGGESTIONS', 3)))
+    except Exception as e:
+        logger.exception(e)
+        return []
+
+
+def autocomplete_query_suggestions(query, docsearch, dialect, tenant=None, version=None, deadline=None, conn_str=None):
+    queries = prefix_suggestions(query, docsearch)
+    if len(queries) > 0:
+        logger.info("Returned stored queries are: ")
+        logger.info(queries)
+        return queries
+
+    # answers already given for this index version
+    key = None
+    if tenant is not None and version is not None:
+        key = ('autocomplete', tenant, version, dialect, normalize(query), None)
+        queries = completion_cache.get(key)
+        if queries is not None:
+            logger.info("Returned cached queries are: ")
+            logger.info(queries)
+            return queries
+
+    # retrieval may have been done ahead of time, by the speculative prefetch or a previous request
+    retrieval_key = (tenant, version, normalize(query)) if key is not None else None
+    retrieved = retrieval_cache.get(retrieval_key) if retrieval_key is not None else None
+    if retrieved is None:
+        # queries naming all their tables get their schema from the lexical index, without embedding
+        docs = lexical_documents(docsearch, query)
+        if docs is not None:
+            retrieved = (None, docs)
+            if retrieval_key is not None:
+                retrieval_cache.put(retrieval_key, None, docs)
+    if retrieved is not None:
+        embedding, docs = retrieved
     else:
-        queries = autocomplete_chat(query, docsearch, dialect)
+        # the query embedding is computed once, for the near-duplicate lookup and the retrieval
+        try:
+            embedding = run_stage(deadline, RETRIEVAL_SHARE, select_embeddings().embed_query, query)
+        except DeadlineExceeded:
+            logger.warning("Deadline exceeded while embedding the query")
+            return []
+    if key is not None:
+        queries = completion_cache.get_similar(key, embedding)
+        if queries is not None:
+            logger.info("Returned cached queries for a similar hint are: ")
+            logger.info(queries)
+            return queries
+    if retrieved is None:
+        try:
+            docs = run_stage(deadline, RETRIEVAL_SHARE, retrieve_documents, docsearch, query, embedding)
+        except DeadlineExceeded:
+            logger.warning("Deadline exceeded while retrieving documents")
+            return []
+        if retrieval_key is not None:
+            retrieval_cache.put(retrieval_key, embedding, docs)
+
+    timeout = deadline.remaining() if deadline is not None else None
+    cancelled = deadline.cancelled if deadline is not None else None
+    try:
+        queries = run_stage(deadline, None, generate_suggestions, query, docs, dialect, timeout, cancelled)
+    except DeadlineExceeded:
+        # not cached, next time the llm may be faster
+        queries = best_stored_query(docs)
+        logger.warning("Deadline exceeded while generating, returned stored queries are: ")
+        logger.info(queries)
+        return queries
+    # several candidates come out of one llm call, the ones valid for this schema first
+    queries = rank_candidates(queries, docsearch, dialect, conn_str, deadline.remaining() if deadline is not None else None)
     logger.info("Returned queries are: ")
     logger.info(queries)
+
+    if key is not None and queries and any(queries):
+        completion_cache.put(key, queries, embedding)
     return queries
 
 
+def stream_autocomplete_suggestions(query, docsearch, dialect, tenant=None, version=None, deadline=None, conn_str=None):
+    # yields (event, data) pairs: tokens as they arrive, then the final suggestions
+    queries = prefix_suggestions(query, docsearch)
+    if len(queries) > 0:
+        yield 'suggestions', {'suggestions': queries}
+        return
+
+    key = None
+    if tenant is not None and version is not None:
+        key = ('autocomplete', tenant, version, dialect, normalize(query), None)
+        queries = completion_cache.get(key)
+        if queries is not None:
+            yield 'suggestions', {'suggestions': queries}
+            return
+
+    # the schema of the tables named in the query needs no embedding
+    embedding = None
+    docs = lexical_documents(docsearch, query)
+    if docs is None:
+        try:
+            embedding = run_stage(deadline, RETRIEVAL_SHARE, select_embeddings().embed_query, query)
+        except DeadlineExceeded:
+            logger.warning("Deadline exceeded while embedding the query")
+            yield 'suggestions', {'suggestions': []}
+            return
+        if key is not None:
+            queries = completion_cache.get_similar(key, embedding)
+            if queries is not None:
+                yield 'suggestions', {'suggestions': queries}
+                return
+        try:
+            docs = run_stage(deadline, RETRIEVAL_SHARE, retrieve_documents, docsearch, query, embedding)
+        except DeadlineExceeded:
+            logger.warning("Deadline exceeded while retrieving documents")
+            yield 'suggestions', {'suggestions': []}
+            return
+
+    stored_query = stored_query_match(query, docs)
+    if stored_query is not None:
+        yield 'suggestions', {'suggestions': extract_queries_from_result(stored_query)}
+        return
+
+    timeout = deadline.remaining() if deadline is not None else None
+    try:
+        if os.environ.get('AUTOCOMPLETE_METHOD', 'chat') == 'selfhosted':
+            # the self-hosted api answers at once, already stopped at the first semicolon
+            queries = run_stage(deadline, None, autocomplete_selfhosted, query, docs, dialect, timeout)
+        else:
+            result = ''
+            tokens = stream_chat(query, docs, dialect, timeout)
+            for token in tokens:
+                result += token
+                yield 'token', {'token': token}
+                if deadline is not None and deadline.cancelled is not None and deadline.cancelled.is_set():
+                    tokens.close()
+                    raise RequestSuperseded()
+                if deadline is not None and deadline.remaining() <= 0:
+                    tokens.close()
+                    raise DeadlineExceeded()
+            logger.info("Result from LLM: "+result)
+            queries = extract_queries_from_result(result)
+    except DeadlineExceeded:
+        # not cached, next time the llm may be faster
+        logger.warning("Deadline exceeded while generating")
+        yield 'suggestions', {'suggestions': best_stored_query(docs)}
+        return
+    queries = rank_candidates(queries, docsearch, dialect, conn_str, deadline.remaining() if deadline is not None else None)
+
+    if key is not None and queries and any(queries):
+        completion_cache.put(key, queries, embedding)
+    yield 'suggestions', {'suggestions': queries}
+
+
 def predict_queries(llm, schema, dialect):
     prompt = PromptTemplate(
         input_variables=["table_info", "dialect"], template=SAMPLE_QUERIES_TEMPLATE)
     llm_chain = LLMChain(llm=llm, prompt=prompt)
-    res = llm_chain.predict(dialect=dialect, table_info=schema)
+    record_prompt('queries', prompt.format(dialect=dialect, table_info=schema))
+    with span('llm_queries'):
+        res = llm_chain.predict(dialect=dialect, table_info=schema)
     logger.info("Result from LLM: "+res)
 
     return res
@@ -189,41 +371,16 @@ def queries_selfhosted(schema, dialect):
         input_variables=["table_info", "dialect"], template=SAMPLE_QUERIES_TEMPLATE)
     query = prompt.format(table_info=schema, dialect=dialect)
 
-    # issue a request to an external API
-    request = {
-        'prompt': query,
-        'temperature': float(os.environ.get('TEMPERATURE', 1.3)),
-        'top_p': 0.1,
-        'typical_p': 1,
-        'repetition_penalty': 1.18,
-        'top_k': 40,
-        'min_length': 0,
-        'no_repeat_ngram_size': 0,
-        'num_beams': 1,
-        'penalty_alpha': 0,
-        'length_penalty': 1,
-        'early_stopping': False,
-        'seed': -1,
-        'add_bos_token': True,
-        'truncation_length': 2048,
-        'ban_eos_token': False,
-        'skip_special_tokens': True,
-        'stopping_strings': []
-    }
-
     try:
-        response = requests.post(os.environ.get('LLM_HOST', ''), json=request, auth=HTTPBasicAuth(
-            os.environ.get('LLM_USER', ''), os.environ.get('LLM_PASSWORD', '')))
-        if response.status_code == 200:
-            result = response.json()['results'][0]['text']
-            logger.info("Result from LLM: "+result)
-            try:
-                final_queries = json.loads(result)
-            except:
-                return []
-            return final_queries
+        result = llm_client.complete(query, 'queries')
+        logger.info("Result from LLM: "+result)
+        try:
+            final_queries = json.loads(result)
+        except:
+            return []
+        return final_queries
     except Exception as e:
-        logger.exception("Error in autocomplete_selfhosted: "+e)
+        logger.exception(e)
 
     return None
 
@@ -0,0 +1,97 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from .metrics import record_cache
+
+
+class CompletionCache:
+    # llm suggestions keyed by (kind, tenant, index version, dialect, normalized query, error message)
+    def __init__(self, max_entries, ttl, min_similarity):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.min_similarity = min_similarity
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            self._check_version(key)
+            entry = self._entries.get(key)
+            if entry is None or entry['expires'] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                record_cache('completion', False)
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            record_cache('completion', True)
+            return entry['suggestions']
+
+    def get_similar(self, key, embedding):
+        # near-duplicate lookup among the entries sharing everything but the query text
+        if self.min_similarity <= 0 or embedding is None:
+            return None
+        query = _unit(embedding)
+        now = time.monotonic()
+        best = None
+        best_similarity = self.min_similarity
+        with self._lock:
+            for entry_key, entry in self._entries.items():
+                if entry['embedding'] is None or entry['expires'] < now or _group(entry_key) != _group(key):
+                    continue
+                similarity = float(np.dot(query, entry['embedding']))
+                if similarity >= best_similarity:
+                    best, best_similarity = entry_key, similarity
+            if best is None:
+                record_cache('completion_similar', False)
+                return None
+            self._entries.move_to_end(best)
+            self.similar_hits += 1
+            record_cache('completion_similar', True)
+            return self._entries[best]['suggestions']
+
+    def put(self, key, suggestions, embedding=None):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._check_version(key)
+            self._entries[key] = {'suggestions': suggestions, 'expires': time.monotonic() + self.ttl,
+                                  'embedding': _unit(embedding) if embedding is not None else None}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits,
+                    'similar_hits': self.similar_hits, 'misses': self.misses}
+
+    def _check_version(self, key):
+        # a new index version for a tenant drops everything cached for the previous ones
+        _, tenant, version = key[:3]
+        if self._versions.get(tenant, version) != version:
+            for entry_key in [k for k in self._entries.keys() if k[1] == tenant and k[2] != version]:
+                del self._entries[entry_key]
+        self._versions[tenant] = version
+
+
+def _group(key):
+    # every part of the key except the normalized query
+    return key[:4] + key[5:]
+
+
+def _unit(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+completion_cache = CompletionCache(int(os.environ.get('COMPLETION_CACHE_SIZE', 1000)),
+                                   float(os.environ.get('COMPLETION_CACHE_TTL', 600)),
+                                   float(os.environ.get('COMPLETION_CACHE_SIMILARITY', 0.97)))
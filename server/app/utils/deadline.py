@@ -0,0 +1,64 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from .sequencing import RequestSuperseded
+
+# shared by all the requests, a stage that runs out of time is left behind and the request moves on
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('DEADLINE_WORKERS', 32)))
+
+# share of the total time each stage gets at most, generation gets whatever is left
+INDEX_SHARE = float(os.environ.get('DEADLINE_INDEX_SHARE', 0.3))
+RETRIEVAL_SHARE = float(os.environ.get('DEADLINE_RETRIEVAL_SHARE', 0.2))
+
+# how often a running stage checks whether its request was superseded
+POLL_INTERVAL = 0.05
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    def __init__(self, seconds, cancelled=None):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+        self.cancelled = cancelled
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    def budget(self, share=None):
+        if share is None:
+            return self.remaining()
+        return min(self.remaining(), self.seconds * share)
+
+    def check(self):
+        if self.cancelled is not None and self.cancelled.is_set():
+            raise RequestSuperseded()
+
+    def run(self, share, fn, *args, **kwargs):
+        self.check()
+        timeout = self.budget(share)
+        if timeout <= 0:
+            raise DeadlineExceeded()
+        future = _executor.submit(fn, *args, **kwargs)
+        expires = time.monotonic() + timeout
+        while True:
+            remaining = max(0.0, expires - time.monotonic())
+            done, _ = wait([future], timeout=min(remaining, POLL_INTERVAL) if self.cancelled is not None else remaining)
+            if done:
+                return future.result()
+            if self.cancelled is not None and self.cancelled.is_set():
+                future.cancel()
+                raise RequestSuperseded()
+            if time.monotonic() >= expires:
+                future.cancel()
+                raise DeadlineExceeded()
+
+
+def run_stage(deadline, share, fn, *args, **kwargs):
+    # without a deadline the stage just runs inline
+    if deadline is None:
+        return fn(*args, **kwargs)
+    return deadline.run(share, fn, *args, **kwargs)
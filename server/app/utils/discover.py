@@ -0,0 +1,78 @@
+import hashlib
+import logging
+from .ann import remove_documents
+
+logger = logging.getLogger(__name__)
+
+
+def table_hash(info):
+    return hashlib.sha256(info.encode('utf-8')).hexdigest()
+
+
+def sync_schema_documents(index_engine, docsearch, tables_info, embeddings, name=None, batch_size=None, progress=None):
+    # diff the incoming tables against the indexed ones, only embedding new or changed tables;
+    # progress is called with the tables embedded so far and the ones to embed, before and after every batch
+    counts = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+    existing = {}
+    samples = {}
+    stale_ids = []
+    if docsearch is not None:
+        for doc_id, doc in index_engine.documents(docsearch).items():
+            if doc.metadata.get('type') == 'query' and doc.metadata.get('source') == 'sample':
+                samples.setdefault(doc.metadata.get('table'), []).append(doc_id)
+                continue
+            if doc.metadata.get('type') != 'schema':
+                # keep the stored queries
+                continue
+            table = doc.metadata.get('table')
+            if table is None or table in existing:
+                # indexed before tables were tracked, will be indexed again
+                stale_ids.append(doc_id)
+            else:
+                existing[table] = (doc_id, doc.metadata.get('hash'))
+
+    texts = []
+    metadatas = []
+    changed_tables = []
+    for table, info in tables_info.items():
+        info_hash = table_hash(info)
+        if table in existing:
+            doc_id, previous_hash = existing.pop(table)
+            if previous_hash == info_hash:
+                counts['unchanged'] += 1
+                continue
+            stale_ids.append(doc_id)
+            # generated for the previous version of the table
+            stale_ids += samples.get(table, [])
+            counts['updated'] += 1
+        else:
+            counts['added'] += 1
+        texts.append(info)
+        metadatas.append({'type': 'schema', 'table': table, 'hash': info_hash})
+        changed_tables.append(table)
+
+    # tables that are not in the schema anymore, with their sample queries
+    removed_tables = list(existing.keys())
+    for table, (doc_id, _) in existing.items():
+        stale_ids.append(doc_id)
+        stale_ids += samples.get(table, [])
+        counts['removed'] += 1
+
+    if docsearch is not None and len(stale_ids) > 0:
+        docsearch = remove_documents(docsearch, stale_ids)
+    batch_size = batch_size or max(1, len(texts))
+    if progress is not None:
+        progress(0, len(texts))
+    for start in range(0, len(texts), batch_size):
+        batch_texts = texts[start:start + batch_size]
+        batch_metadatas = metadatas[start:start + batch_size]
+        if docsearch is None:
+            docsearch = index_engine.read_index_contents(
+                batch_texts, embeddings, batch_metadatas, name=name)
+        else:
+            docsearch.add_texts(batch_texts, batch_metadatas)
+        if progress is not None:
+            progress(start + len(batch_texts), len(texts))
+
+    logger.info("Schema synced: {}".format(counts))
+    return docsearch, counts, changed_tables, removed_tables
@@ -1,13 +1,176 @@
+import hashlib
+import logging
 import os
+import threading
+import numpy as np
+import requests
 from langchain.embeddings import OpenAIEmbeddings, HuggingFaceEmbeddings
+from langchain.embeddings.base import Embeddings
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from .metrics import span
 
+logger = logging.getLogger(__name__)
 
-def select_embeddings():
+# embeddings are built once per process and shared by routes and background threads
+_embeddings = None
+_embeddings_lock = threading.Lock()
+
+
+class RemoteEmbeddings(Embeddings):
+    # delegates to the dedicated embedding worker, so web workers don't each load a model
+    def __init__(self, host):
+        self.host = host.rstrip('/')
+        self.session = requests.Session()
+        self.timeout = float(os.environ.get('EMBEDDING_TIMEOUT', 30))
+
+    def embed_documents(self, texts):
+        if len(texts) == 0:
+            return []
+        return self._post(texts)
+
+    def embed_query(self, text):
+        return self._post([text])[0]
+
+    def _post(self, texts):
+        response = self.session.post(
+            self.host + '/embeddings', json={'texts': texts}, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()['embeddings']
+
+
+class TimedEmbeddings(Embeddings):
+    # stage timings of every embedding call, whichever model or cache answers it
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def embed_documents(self, texts):
+        with span('embed_documents'):
+            return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        with span('embed_query'):
+            return self.embeddings.embed_query(text)
+
+
+class CachedEmbeddings(Embeddings):
+    # content-addressed cache of document embeddings, stored as float32 blobs in the sqlpal_db
+    def __init__(self, embeddings, model):
+        self.embeddings = embeddings
+        self.model = model
+        self.hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts):
+        hashes = [hashlib.sha256(text.encode('utf-8')).hexdigest() for text in texts]
+        vectors = {}
+        try:
+            vectors = self._lookup(set(hashes))
+        except Exception as e:
+            logger.exception(e)
+
+        # embed all the misses in a single call, once per distinct text
+        missing = {}
+        for text, text_hash in zip(texts, hashes):
+            if text_hash not in vectors and text_hash not in missing:
+                missing[text_hash] = text
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        if len(missing) > 0:
+            computed = self.embeddings.embed_documents(list(missing.values()))
+            new_vectors = dict(zip(missing.keys(), computed))
+            try:
+                self._store(new_vectors)
+            except Exception as e:
+                logger.exception(e)
+            vectors.update(new_vectors)
+
+        return [list(vectors[text_hash]) for text_hash in hashes]
+
+    def embed_query(self, text):
+        # keystrokes are rarely repeated, only documents go through the cache
+        return self.embeddings.embed_query(text)
+
+    def _lookup(self, hashes):
+        from . import init_db
+        from .indexes import EmbeddingCache
+        vectors = {}
+        if len(hashes) == 0:
+            return vectors
+        hashes = list(hashes)
+        with Session(bind=init_db()._engine) as sess:
+            for i in range(0, len(hashes), 1000):
+                rows = sess.execute(select(EmbeddingCache.text_hash, EmbeddingCache.vector).where(
+                    EmbeddingCache.model == self.model, EmbeddingCache.text_hash.in_(hashes[i:i + 1000])))
+                for text_hash, vector in rows:
+                    vectors[text_hash] = np.frombuffer(vector, dtype=np.float32).tolist()
+        return vectors
+
+    def _store(self, vectors):
+        from . import init_db
+        from .indexes import EmbeddingCache
+        rows = [{'model': self.model, 'text_hash': text_hash,
+                 'vector': np.asarray(vector, dtype=np.float32).tobytes()} for text_hash, vector in vectors.items()]
+        with Session(bind=init_db()._engine) as sess:
+            for i in range(0, len(rows), 1000):
+                sess.execute(insert(EmbeddingCache).values(
+                    rows[i:i + 1000]).on_conflict_do_nothing())
+            sess.commit()
+
+
+def embedding_method():
+    # the embedding worker always computes them locally
+    if os.environ.get('EMBEDDING_SERVER'):
+        return os.environ.get('EMBEDDING_WORKER_METHOD', 'huggingface')
+    return os.environ.get('EMBEDDING_METHOD', 'openai')
+
+
+def build_embeddings(method):
     embeddings = None
-    if os.environ.get('EMBEDDING_METHOD', 'openai') == 'huggingface':
+    if method == 'huggingface':
         embeddings = HuggingFaceEmbeddings()
-    elif os.environ.get('EMBEDDING_METHOD', 'openai') == 'openai':
+    elif method == 'openai':
         embeddings = OpenAIEmbeddings(model=os.environ.get(
             'OPENAI_EMBEDDINGS_MODEL', 'text-embedding-ada-002'))
+    elif method == 'remote':
+        embeddings = RemoteEmbeddings(os.environ.get(
+            'EMBEDDING_HOST', 'http://127.0.0.1:8089'))
+
+    return embeddings
+
+
+def embedding_model_name(method):
+    if method == 'huggingface':
+        return 'huggingface:' + HuggingFaceEmbeddings.__fields__['model_name'].default
+    elif method == 'openai':
+        return 'openai:' + os.environ.get('OPENAI_EMBEDDINGS_MODEL', 'text-embedding-ada-002')
+    return method
+
+
+def select_embeddings():
+    global _embeddings
+    if _embeddings is None:
+        with _embeddings_lock:
+            if _embeddings is None:
+                method = embedding_method()
+                embeddings = build_embeddings(method)
+                cache = os.environ.get('USE_DATABASE') and os.environ.get('EMBEDDING_CACHE', 'True') != 'False'
+                # the embedding worker caches under the model it actually runs, the web workers can't know it
+                if embeddings is not None and cache and method != 'remote':
+                    embeddings = CachedEmbeddings(
+                        embeddings, embedding_model_name(method))
+                if embeddings is not None:
+                    embeddings = TimedEmbeddings(embeddings)
+                _embeddings = embeddings
+    return _embeddings
+
 
+def warm_up_embeddings():
+    embeddings = select_embeddings()
+    # local models pay their first inference cost here instead of on the first keystroke
+    if embeddings is not None and (embedding_method() == 'huggingface' or os.environ.get('EMBEDDINGS_WARMUP')):
+        embeddings.embed_query('SELECT 1;')
+        logger.info("Embeddings warmed up")
     return embeddings
@@ -0,0 +1,64 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from .metrics import record_cache
+
+logger = logging.getLogger(__name__)
+
+
+class IndexCache:
+    # process-wide LRU of loaded indexes, bounded by the size of their persisted copy
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['version'] != version:
+                self.misses += 1
+                record_cache('index', False)
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            record_cache('index', True)
+            return entry['docsearch']
+
+    def put(self, key, version, docsearch, size):
+        if self.max_bytes <= 0 or size > self.max_bytes:
+            # too big to be cached, just drop any previous copy
+            self.invalidate(key)
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = {'version': version,
+                                  'docsearch': docsearch, 'size': size}
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                old_key, _ = next(iter(self._entries.items()))
+                self._remove(old_key)
+                self.evictions += 1
+                logger.info("Evicted index {} from cache".format(old_key))
+
+    def invalidate(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.total_bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry['size']
+
+
+index_cache = IndexCache(int(os.environ.get('INDEX_CACHE_MAX_BYTES', 512 * 1024 * 1024)))
@@ -1,12 +1,26 @@
 import logging
+import mmap
 import os
+import struct
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+import faiss
 from flask import session
 from langchain import FAISS
-from sqlalchemy import Column, Integer, LargeBinary, String
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+from sqlalchemy import BigInteger, Column, Float, Index, Integer, LargeBinary, String, Text, delete, func, select, text, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import Session
-from sqlalchemy import inspect
 from langchain.vectorstores import Chroma
 from sqlalchemy.ext.declarative import declarative_base
+from .index_cache import index_cache
+from . import ann, serialization
+from .metrics import record_index, span, timed
+from .prefix import add_to_prefix_index, copy_prefix_index
+from .residency import cold_path, residency
 
 logger = logging.getLogger(__name__)
 
@@ -14,10 +28,78 @@ Base = declarative_base()
 
 
 class IndexContent(Base):
+    # one current snapshot per tenant
     __tablename__ = 'index_content'
     id = Column(Integer, primary_key=True)
-    name = Column(String(54))
+    name = Column(String(54), unique=True)
     content = Column(LargeBinary)
+    version = Column(Integer, nullable=False, default=0, server_default='0')
+    snapshot_version = Column(Integer, nullable=False,
+                              default=0, server_default='0')
+
+
+class IndexDelta(Base):
+    # documents appended after the snapshot, replayed on load
+    __tablename__ = 'index_delta'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(54), index=True)
+    version = Column(Integer, nullable=False)
+    content = Column(LargeBinary)
+
+
+class SampleQueryTask(Base):
+    # tables waiting for sample queries, so generation resumes after a restart
+    __tablename__ = 'sample_query_task'
+    name = Column(String(54), primary_key=True)
+    table_name = Column(String(256), primary_key=True)
+    table_info = Column(Text)
+    dialect = Column(String(32))
+
+
+class DiscoverJob(Base):
+    # discover jobs and their progress, shared by the web workers and the job processes
+    __tablename__ = 'discover_job'
+    id = Column(String(32), primary_key=True)
+    name = Column(String(54), nullable=False)
+    status = Column(String(16), nullable=False)
+    tables_total = Column(Integer, nullable=False, default=0)
+    tables_changed = Column(Integer, nullable=False, default=0)
+    tables_embedded = Column(Integer, nullable=False, default=0)
+    queries_generated = Column(Integer, nullable=False, default=0)
+    bytes_persisted = Column(BigInteger, nullable=False, default=0)
+    sample_tables_total = Column(Integer, nullable=False, default=0)
+    sample_tables_done = Column(Integer, nullable=False, default=0)
+    counts = Column(Text)  # json
+    error = Column(Text)
+    created_at = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False)
+    # at most one queued or running job per tenant
+    __table_args__ = (Index('discover_job_active', 'name', unique=True,
+                            postgresql_where=text("status IN ('queued', 'running')")),)
+
+
+class EmbeddingCache(Base):
+    __tablename__ = 'embedding_cache'
+    model = Column(String(128), primary_key=True)
+    text_hash = Column(String(64), primary_key=True)
+    vector = Column(LargeBinary)  # float32 array
+
+
+def migrate(engine):
+    # bring tables created before versioning to the current layout, keeping the newest copy
+    with engine.begin() as conn:
+        conn.execute(text(
+            "ALTER TABLE index_content ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0"))
+        conn.execute(text(
+            "ALTER TABLE index_content ADD COLUMN IF NOT EXISTS snapshot_version INTEGER NOT NULL DEFAULT 0"))
+        conn.execute(text(
+            "DELETE FROM index_content a USING index_content b WHERE a.name = b.name AND a.id < b.id"))
+        conn.execute(text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS index_content_name_key ON index_content (name)"))
+        conn.execute(text(
+            "ALTER TABLE discover_job ADD COLUMN IF NOT EXISTS sample_tables_total INTEGER NOT NULL DEFAULT 0"))
+        conn.execute(text(
+            "ALTER TABLE discover_job ADD COLUMN IF NOT EXISTS sample_tables_done INTEGER NOT NULL DEFAULT 0"))
 
 
 def select_index():
@@ -30,36 +112,101 @@ def select_index():
     return index_engine
 
 
+# version of the stored index each loaded copy corresponds to
+_loaded_versions = weakref.WeakKeyDictionary()
+# without a database, the version of the local file each loaded copy was read from
+_loaded_files = weakref.WeakKeyDictionary()
+
+# compactions run in the background, one at a time
+_compaction_executor = ThreadPoolExecutor(max_workers=1)
+_compactions = set()
+_compactions_lock = threading.Lock()
+_upgrades = set()
+
+LEGACY_SNAPSHOT_MAGIC = b'SQLPAL\x01'
+
+# writers losing the race to a newer snapshot start over from it this many times
+WRITE_ATTEMPTS = int(os.environ.get('INDEX_WRITE_ATTEMPTS', 3))
+
+
+class IndexConflict(Exception):
+    pass
+
+
 class IndexEngine:
     def __init__(self):
         self.index_folder = os.environ.get('INDEX_FOLDER', '/tmp/indexes')
+        # version of the last index read, only known when it can be cached
+        self.version = None
 
-    def retrieve_index(self, db, filename):
+    @timed('retrieve_index')
+    def retrieve_index(self, db, filename, name=None):
+        # restores the stored snapshot locally and returns the deltas to replay, with the version they lead to
+        name = name or session['conn_str']
         content = None
+        deltas = []
+        version = 0
         if os.environ.get('USE_DATABASE'):
             try:
-                tables = inspect(db._engine).get_table_names()
-                if IndexContent.__tablename__ in tables:
-                    sess = Session(bind=db._engine)
-                    row = sess.query(IndexContent).filter_by(
-                        name=session['conn_str']).first()
+                with Session(bind=db._engine) as sess:
+                    row = sess.query(IndexContent).filter_by(name=name).first()
                     if row:
                         content = row.content
+                        version = row.version
+                        deltas = self.read_deltas(
+                            sess, name, row.snapshot_version)
             except Exception as e:
                 logger.exception(e)
 
             if content is not None:
-                # write to local file
-                filepath = os.path.join(self.index_folder, filename)
-                with open(filepath, 'wb') as f:
-                    f.write(content)
+                self.restore_snapshot(content, self.index_folder, filename)
+        return deltas, version
+
+    def restore_snapshot(self, content, folder, filename):
+        # write to local file
+        filepath = os.path.join(folder, filename)
+        with open(filepath, 'wb') as f:
+            f.write(content)
+
+    def read_deltas(self, sess, name, after_version):
+        rows = sess.execute(select(IndexDelta.version, IndexDelta.content).where(
+            IndexDelta.name == name, IndexDelta.version > after_version).order_by(IndexDelta.version))
+        return [(version, serialization.decode_delta(content)) for version, content in rows]
 
-    def save_to_db(self, db, filepath):
+    def index_version(self, db, filename, name=None):
+        # cheap etag of the stored copy, used to validate the in-memory cache
+        name = name or session['conn_str']
+        if os.environ.get('USE_DATABASE'):
+            try:
+                with Session(bind=db._engine) as sess:
+                    row = sess.query(IndexContent.version).filter_by(
+                        name=name).first()
+                if row:
+                    return 'db-{}'.format(row[0])
+            except Exception as e:
+                logger.exception(e)
+            return None
+
+        try:
+            filepath = os.path.join(self.index_folder, filename + '.faiss')
+            return 'file-{}'.format(os.stat(filepath).st_mtime_ns)
+        except OSError:
+            return None
+
+    def index_size(self, filename):
+        size = 0
+        for suffix in ('.faiss', '.pkl'):
+            try:
+                size += os.path.getsize(os.path.join(self.index_folder, filename + suffix))
+            except OSError:
+                pass
+        return size
+
+    @timed('save_to_db')
+    def save_to_db(self, db, filepath, name=None):
+        name = name or session['conn_str']
         if os.environ.get('USE_DATABASE'):
             content = None
-            # add suffix for faiss
-            if os.environ.get('INDEX_ENGINE', 'FAISS') == 'FAISS':
-                filepath = filepath + '.pkl'
             try:
                 with open(filepath, 'rb') as f:
                     content = f.read()
@@ -67,49 +214,382 @@ class IndexEngine:
                 logger.exception(e)
 
             if content is not None:
-                tables = inspect(db._engine).get_table_names()
-                if IndexContent.__tablename__ not in tables:
-                    try:
-                        Base.metadata.create_all(bind=db._engine)
-                    except Exception as e:
-                        logger.exception(e)
-                sess = Session(bind=db._engine)
-                new_file = IndexContent(
-                    name=session['conn_str'], content=content)
-                sess.add(new_file)
-                sess.commit()
+                with Session(bind=db._engine) as sess:
+                    self.upsert_snapshot(sess, name, content)
+                    sess.commit()
+
+    def upsert_snapshot(self, sess, name, content, version=None):
+        # the version bump happens under the row lock taken by the upsert
+        next_version = IndexContent.version + 1
+        if version is not None:
+            next_version = func.greatest(next_version, version)
+        version = sess.execute(insert(IndexContent).values(
+            name=name, content=content, version=version or 1, snapshot_version=version or 1).on_conflict_do_update(
+            index_elements=[IndexContent.name],
+            set_={'content': content, 'version': next_version,
+                  'snapshot_version': next_version}).returning(IndexContent.version)).scalar()
+        sess.execute(delete(IndexDelta).where(
+            IndexDelta.name == name, IndexDelta.version <= version))
+        return version
 
 
 class FaissEngine(IndexEngine):
-    def read_index(self, db, embeddings):
-        filename = "index-{}".format(session['conn_str'])
-        self.retrieve_index(db, filename)
+    def index_path(self, name):
+        return os.path.join(self.index_folder, "index-{}.sqlpal".format(name))
 
-        # now read as usual from a file
+    def index_version(self, db, filename, name=None):
+        name = name or session['conn_str']
+        if os.environ.get('USE_DATABASE'):
+            return super().index_version(db, filename, name)
         try:
-            docsearch = FAISS.load_local(
-                self.index_folder, embeddings, filename)
+            return 'file-{}'.format(self.stat_local(name).st_mtime_ns)
+        except OSError:
+            return super().index_version(db, filename, name)
+
+    def stat_local(self, name):
+        # demoted indexes are brought back from the cold tier on their first use
+        try:
+            return os.stat(self.index_path(name))
+        except FileNotFoundError:
+            if not residency.rehydrate(name):
+                raise
+            return os.stat(self.index_path(name))
+
+    def index_size(self, filename):
+        try:
+            return os.path.getsize(os.path.join(self.index_folder, filename + '.sqlpal'))
+        except OSError:
+            return super().index_size(filename)
+
+    @timed('read_index')
+    def read_index(self, db, embeddings, use_cache=True, name=None):
+        name = name or session['conn_str']
+        filename = "index-{}".format(name)
+        residency.touch(name)
+
+        # reuse the loaded index while the stored copy has not changed
+        # writers get a private copy, so readers never see a half-modified index
+        version = self.index_version(db, filename, name)
+        self.version = version
+        if version is not None:
+            docsearch = index_cache.get(name, version)
+            if docsearch is not None:
+                return docsearch if use_cache else self.copy(docsearch)
+
+        try:
+            with span('load_index'):
+                docsearch = self.load(db, embeddings, name)
         except Exception as e:
-            logger.info("Index does not exist, starting from new one")
+            logger.exception(e)
             docsearch = None
+        if docsearch is None:
+            logger.info("Index does not exist, starting from new one")
+            return None
+        record_index(docsearch.index.ntotal, self.index_size(filename))
+        if not os.environ.get('USE_DATABASE'):
+            _loaded_files[docsearch] = version
 
+        if version is not None and use_cache:
+            index_cache.put(name, version, docsearch,
+                            self.index_size(filename))
         return docsearch
 
-    def write_index(self, db, docsearch):
-        filename = "index-{}".format(session['conn_str'])
-        filepath = os.path.join(self.index_folder, filename)
-        docsearch.save_local(self.index_folder, filename)
-        self.save_to_db(db, filepath)
+    def load(self, db, embeddings, name):
+        if not os.environ.get('USE_DATABASE'):
+            docsearch = self.load_local(embeddings, name)
+            if docsearch is None:
+                # indexes saved by langchain before the native format
+                try:
+                    docsearch = FAISS.load_local(
+                        self.index_folder, embeddings, "index-{}".format(name))
+                except Exception:
+                    docsearch = None
+            if docsearch is not None:
+                ann.tune(docsearch.index)
+            return docsearch
 
-    def read_index_contents(self, texts, embeddings, metadatas):
+        # a consistent view of snapshot and deltas, even if a compaction commits meanwhile
+        with Session(bind=db._engine.execution_options(isolation_level='REPEATABLE READ')) as sess:
+            row = sess.execute(select(IndexContent.version, IndexContent.snapshot_version).where(
+                IndexContent.name == name)).first()
+            if row is None:
+                return None
+            deltas = self.read_deltas(sess, name, row.snapshot_version)
+
+            # the local copy is shared by all the workers, only pull the blob when it is outdated
+            docsearch = self.load_local(embeddings, name, row.snapshot_version)
+            if docsearch is None:
+                content = sess.execute(select(IndexContent.content).where(
+                    IndexContent.name == name)).scalar()
+                docsearch = self.load_content(
+                    content, embeddings, name, row.snapshot_version)
+
+        self.replay(docsearch, deltas)
+        _loaded_versions[docsearch] = row.version
+        ann.tune(docsearch.index)
+        return docsearch
+
+    def load_local(self, embeddings, name, expected_version=None):
+        try:
+            self.stat_local(name)
+            with open(self.index_path(name), 'rb') as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if not serialization.is_native(buffer):
+            return None
+        if expected_version is not None and serialization.read_version(buffer) != expected_version:
+            return None
+        return serialization.load(buffer, embeddings)
+
+    def load_content(self, content, embeddings, name, version):
+        if not serialization.is_native(content):
+            # snapshots stored before the native format
+            filename = "index-{}".format(name)
+            with TemporaryDirectory() as tmp:
+                self.restore_snapshot(content, tmp, filename)
+                return FAISS.load_local(tmp, embeddings, filename)
+
+        self.write_local(name, serialization.with_version(content, version))
+        return serialization.load(content, embeddings)
+
+    def write_local(self, name, content, expected_version=None, check=False):
+        # atomic rename, so workers mapping the previous file are not affected;
+        # when checked, only replaces the file this copy was loaded from
+        path = self.index_path(name)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            with residency.locked():
+                if check and self.local_version(name) != expected_version:
+                    os.remove(tmp_path)
+                    raise IndexConflict("Index {} was written since it was loaded".format(name))
+                os.replace(tmp_path, path)
+                residency.discard_cold(name)
+        except OSError as e:
+            logger.exception(e)
+        residency.schedule_sweep()
+
+    def local_version(self, name):
+        # same as index_version, without bringing a demoted index back
+        for path in (self.index_path(name), cold_path(name)):
+            try:
+                return 'file-{}'.format(os.stat(path).st_mtime_ns)
+            except OSError:
+                pass
+        return None
+
+    def replay(self, docsearch, deltas):
+        for _, (texts, metadatas, vectors) in deltas:
+            docsearch.add_embeddings(
+                list(zip(texts, vectors.tolist())), metadatas)
+            add_to_prefix_index(docsearch, texts, metadatas)
+
+    def restore_snapshot(self, content, folder, filename):
+        # legacy snapshots held langchain's faiss index and docstore pickle files
+        if content[:len(LEGACY_SNAPSHOT_MAGIC)] != LEGACY_SNAPSHOT_MAGIC:
+            # older rows only stored the docstore
+            with open(os.path.join(folder, filename + '.pkl'), 'wb') as f:
+                f.write(content)
+            return
+        offset = len(LEGACY_SNAPSHOT_MAGIC)
+        for suffix in ('.faiss', '.pkl'):
+            size = struct.unpack_from('<Q', content, offset)[0]
+            offset += 8
+            with open(os.path.join(folder, filename + suffix), 'wb') as f:
+                f.write(content[offset:offset + size])
+            offset += size
+
+    def copy(self, docsearch):
+        docsearch_copy = FAISS(docsearch.embedding_function, faiss.clone_index(docsearch.index),
+                               InMemoryDocstore(dict(docsearch.docstore._dict)), dict(docsearch.index_to_docstore_id))
+        if docsearch in _loaded_versions:
+            _loaded_versions[docsearch_copy] = _loaded_versions[docsearch]
+        if docsearch in _loaded_files:
+            _loaded_files[docsearch_copy] = _loaded_files[docsearch]
+        copy_prefix_index(docsearch, docsearch_copy)
+        return docsearch_copy
+
+    @timed('write_index')
+    def write_index(self, db, docsearch, name=None):
+        name = name or session['conn_str']
+        filename = "index-{}".format(name)
+        index_cache.invalidate(name)
+
+        if os.environ.get('USE_DATABASE'):
+            with Session(bind=db._engine) as sess:
+                # lock the tenant row, and catch up with deltas other workers appended since this copy was loaded
+                row = sess.execute(select(IndexContent.version, IndexContent.snapshot_version).where(
+                    IndexContent.name == name).with_for_update()).first()
+                loaded_version = _loaded_versions.get(docsearch, 0)
+                if row is not None and row.version > loaded_version:
+                    if row.snapshot_version > loaded_version:
+                        # the deltas since were folded into a newer snapshot, or another writer replaced it:
+                        # its changes can't be replayed, the writer has to start over from it
+                        raise IndexConflict("Index {} has a snapshot newer than {}".format(name, loaded_version))
+                    self.replay(docsearch, self.read_deltas(
+                        sess, name, loaded_version))
+
+                version = row.version + 1 if row is not None else 1
+                content = serialization.dump(docsearch, version)
+                version = self.upsert_snapshot(sess, name, content, version)
+                sess.commit()
+            _loaded_versions[docsearch] = version
+            self.write_local(name, serialization.with_version(content, version))
+        else:
+            self.write_local(name, serialization.dump(docsearch), _loaded_files.get(docsearch), check=True)
+        record_index(docsearch.index.ntotal, self.index_size(filename))
+
+        # the written copy is the newest one, keep it warm for the next reads
+        version = self.index_version(db, filename, name)
+        if not os.environ.get('USE_DATABASE'):
+            _loaded_files[docsearch] = version
+        if version is not None:
+            index_cache.put(name, version, docsearch,
+                            self.index_size(filename))
+        self.schedule_upgrade(db, docsearch, name)
+
+    @timed('add_texts')
+    def add_texts(self, db, docsearch, embeddings, texts, metadatas, name=None):
+        # embeds the new documents once, and persists them as a small delta instead of the whole index
+        name = name or session['conn_str']
+        vectors = embeddings.embed_documents(texts)
+        docsearch.add_embeddings(list(zip(texts, vectors)), metadatas)
+        add_to_prefix_index(docsearch, texts, metadatas)
+
+        result = None
+        if os.environ.get('USE_DATABASE') and docsearch in _loaded_versions:
+            result = self.append_delta(
+                db, name, serialization.encode_delta(texts, metadatas, vectors))
+        if result is None:
+            self.write_index(db, docsearch, name)
+            return docsearch
+
+        version, previous_version, delta_count = result
+        if previous_version == _loaded_versions[docsearch]:
+            # nobody else wrote in between, so this copy is exactly the stored version
+            _loaded_versions[docsearch] = version
+            index_cache.put(name, 'db-{}'.format(version), docsearch,
+                            self.index_size("index-{}".format(name)))
+        else:
+            index_cache.invalidate(name)
+
+        if delta_count >= int(os.environ.get('INDEX_COMPACTION_THRESHOLD', 50)):
+            self.schedule_compaction(db, embeddings, name)
+        self.schedule_upgrade(db, docsearch, name)
+        return docsearch
+
+    @timed('append_delta')
+    def append_delta(self, db, name, content):
+        with Session(bind=db._engine) as sess:
+            row = sess.execute(select(IndexContent.version).where(
+                IndexContent.name == name).with_for_update()).first()
+            if row is None:
+                return None
+            version = row.version + 1
+            sess.execute(update(IndexContent).where(
+                IndexContent.name == name).values(version=version))
+            sess.add(IndexDelta(name=name, version=version, content=content))
+            delta_count = sess.execute(select(func.count()).select_from(
+                IndexDelta).where(IndexDelta.name == name)).scalar()
+            sess.commit()
+        return version, row.version, delta_count
+
+    def schedule_compaction(self, db, embeddings, name):
+        with _compactions_lock:
+            if name in _compactions:
+                return
+            _compactions.add(name)
+        _compaction_executor.submit(self.compact, db, embeddings, name)
+
+    def compact(self, db, embeddings, name):
+        # fold the deltas into a new snapshot, built from the stored copy and not from memory
+        try:
+            with Session(bind=db._engine.execution_options(isolation_level='REPEATABLE READ')) as sess:
+                row = sess.query(IndexContent).filter_by(name=name).first()
+                if row is None:
+                    return
+                deltas = self.read_deltas(sess, name, row.snapshot_version)
+                snapshot_version = row.snapshot_version
+                content = row.content
+            if len(deltas) == 0:
+                return
+
+            if serialization.is_native(content):
+                docsearch = serialization.load(content, embeddings)
+            else:
+                filename = "index-{}".format(name)
+                with TemporaryDirectory() as tmp:
+                    self.restore_snapshot(content, tmp, filename)
+                    docsearch = FAISS.load_local(tmp, embeddings, filename)
+            self.replay(docsearch, deltas)
+            compacted_version = deltas[-1][0]
+            content = serialization.dump(docsearch, compacted_version)
+
+            with Session(bind=db._engine) as sess:
+                # only applies if no other snapshot was written in the meantime, the head version is kept
+                result = sess.execute(update(IndexContent).where(
+                    IndexContent.name == name, IndexContent.snapshot_version == snapshot_version).values(
+                    content=content, snapshot_version=compacted_version))
+                if result.rowcount == 1:
+                    sess.execute(delete(IndexDelta).where(
+                        IndexDelta.name == name, IndexDelta.version <= compacted_version))
+                sess.commit()
+            logger.info("Compacted {} deltas for index {}".format(
+                len(deltas), name))
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            with _compactions_lock:
+                _compactions.discard(name)
+
+    def schedule_upgrade(self, db, docsearch, name):
+        # the index type follows the document count, changing it is left to the background thread
+        if ann.target_type(docsearch) is None:
+            return
+        with _compactions_lock:
+            if name in _upgrades:
+                return
+            _upgrades.add(name)
+        _compaction_executor.submit(self.upgrade, db, self.copy(docsearch), name)
+
+    def upgrade(self, db, docsearch, name):
+        try:
+            kind = ann.target_type(docsearch)
+            if kind is None:
+                return
+            previous = ann.index_type(docsearch.index)
+            ann.convert(docsearch, kind)
+            self.write_index(db, docsearch, name)
+            logger.info("Index {} of {} documents upgraded from {} to {}".format(
+                name, docsearch.index.ntotal, previous, ann.index_type(docsearch.index)))
+        except IndexConflict:
+            # written in between, the next write schedules the upgrade again
+            logger.info("Index {} changed while being upgraded".format(name))
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            with _compactions_lock:
+                _upgrades.discard(name)
+
+    def read_index_contents(self, texts, embeddings, metadatas, name=None):
         docsearch = FAISS.from_texts(texts, embeddings, metadatas)
+        kind = ann.target_type(docsearch)
+        if kind is not None:
+            ann.convert(docsearch, kind)
         return docsearch
 
+    def documents(self, docsearch):
+        return {doc_id: docsearch.docstore.search(doc_id) for doc_id in docsearch.index_to_docstore_id.values()}
+
 
 class ChromaEngine(IndexEngine):
-    def read_index(self, db, embeddings):
-        filename = "index-{}".format(session['conn_str'])
-        self.retrieve_index(db, filename)
+    @timed('read_index')
+    def read_index(self, db, embeddings, use_cache=True, name=None):
+        name = name or session['conn_str']
+        filename = "index-{}".format(name)
+        self.retrieve_index(db, filename, name)
 
         # now read as usual from a file
         try:
@@ -121,15 +601,35 @@ class ChromaEngine(IndexEngine):
 
         return vectordb
 
-    def write_index(self, db, vectordb):
+    def index_version(self, db, filename, name=None):
+        # chroma keeps its own persistence, the folder tells whether there is an index at all
+        try:
+            return 'chroma-{}'.format(os.stat(self.index_folder).st_mtime_ns)
+        except OSError:
+            return None
+
+    @timed('write_index')
+    def write_index(self, db, vectordb, name=None):
         vectordb.persist()
-        filename = "index-{}".format(session['conn_str'])
+        name = name or session['conn_str']
+        filename = "index-{}".format(name)
         filepath = os.path.join(self.index_folder, filename)
-        self.save_to_db(db, filepath)
+        self.save_to_db(db, filepath, name)
 
-    def read_index_contents(self, texts, embeddings, metadatas):
-        filename = "index-{}".format(session['conn_str'])
+    @timed('add_texts')
+    def add_texts(self, db, vectordb, embeddings, texts, metadatas, name=None):
+        vectordb.add_texts(texts, metadatas)
+        self.write_index(db, vectordb, name)
+        return vectordb
+
+    def read_index_contents(self, texts, embeddings, metadatas, name=None):
+        filename = "index-{}".format(name or session['conn_str'])
 
         vectordb = Chroma.from_texts(
             texts=texts, embedding=embeddings, persist_directory=self.index_folder, collection_name=filename, metadatas=metadatas)
         return vectordb
+
+    def documents(self, vectordb):
+        result = vectordb.get()
+        return {doc_id: Document(page_content=text, metadata=metadata or {})
+                for doc_id, text, metadata in zip(result['ids'], result['documents'], result['metadatas'])}
@@ -0,0 +1,382 @@
+import fcntl
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from .indexes import DiscoverJob
+from .residency import JOB_FILE, file_lock, jobs_folder, scan
+
+logger = logging.getLogger(__name__)
+
+# processes embedding and writing the discovered schemas, at most this many run a job at once on the host
+# whichever web worker submitted it; 0 runs the jobs on a thread of the web process
+DISCOVER_WORKERS = int(os.environ.get('DISCOVER_WORKERS', 2))
+DISCOVER_BATCH_SIZE = int(os.environ.get('DISCOVER_BATCH_SIZE', 100))
+# a queued or running job not updated for this long is considered dead, and no longer blocks its tenant
+DISCOVER_JOB_TIMEOUT = float(os.environ.get('DISCOVER_JOB_TIMEOUT', 3600))
+# finished jobs can be looked up for this long, older ones are deleted when a new job is created
+DISCOVER_JOB_TTL = float(os.environ.get('DISCOVER_JOB_TTL', 86400))
+# job processes keep their embedding model between jobs, and are stopped once idle for this long
+DISCOVER_WORKERS_IDLE = float(os.environ.get('DISCOVER_WORKERS_IDLE', 300))
+
+ACTIVE = ('queued', 'running')
+PROGRESS = ('tables_total', 'tables_changed', 'tables_embedded', 'queries_generated', 'bytes_persisted',
+            'sample_tables_total', 'sample_tables_done')
+
+
+def new_job(name, tables_total):
+    now = time.time()
+    job = {'id': uuid.uuid4().hex, 'name': name, 'status': 'queued', 'counts': None, 'error': None,
+           'created_at': now, 'updated_at': now}
+    job.update({field: 0 for field in PROGRESS})
+    job['tables_total'] = tables_total
+    return job
+
+
+def stale(job):
+    return job['status'] in ACTIVE and job['updated_at'] < time.time() - DISCOVER_JOB_TIMEOUT
+
+
+class DatabaseJobStore:
+    def __init__(self, engine):
+        self.engine = engine
+
+    def create(self, name, tables_total):
+        # None when the tenant already has a job queued or running
+        job = new_job(name, tables_total)
+        with Session(bind=self.engine) as sess:
+            sess.execute(delete(DiscoverJob).where(
+                DiscoverJob.status.not_in(ACTIVE), DiscoverJob.updated_at < time.time() - DISCOVER_JOB_TTL))
+            sess.execute(update(DiscoverJob).where(
+                DiscoverJob.name == name, DiscoverJob.status.in_(ACTIVE),
+                DiscoverJob.updated_at < time.time() - DISCOVER_JOB_TIMEOUT).values(
+                status='failed', error='Timed out', updated_at=time.time()))
+            sess.commit()
+            try:
+                sess.add(DiscoverJob(**job))
+                sess.commit()
+            except IntegrityError:
+                sess.rollback()
+                return None
+        return job
+
+    def get(self, job_id):
+        with Session(bind=self.engine) as sess:
+            row = sess.get(DiscoverJob, job_id)
+            return self._to_dict(row) if row is not None else None
+
+    def active(self, name):
+        with Session(bind=self.engine) as sess:
+            row = sess.execute(select(DiscoverJob).where(
+                DiscoverJob.name == name, DiscoverJob.status.in_(ACTIVE))).scalar()
+            return self._to_dict(row) if row is not None else None
+
+    def update(self, job_id, **fields):
+        if 'counts' in fields:
+            fields['counts'] = json.dumps(fields['counts'])
+        with Session(bind=self.engine) as sess:
+            sess.execute(update(DiscoverJob).where(DiscoverJob.id == job_id).values(
+                updated_at=time.time(), **fields))
+            sess.commit()
+
+    def increment(self, job_id, **counts):
+        values = {getattr(DiscoverJob, field): getattr(DiscoverJob, field) + count for field, count in counts.items()}
+        values[DiscoverJob.updated_at] = time.time()
+        with Session(bind=self.engine) as sess:
+            sess.execute(update(DiscoverJob).where(DiscoverJob.id == job_id).values(values))
+            sess.commit()
+
+    def _to_dict(self, row):
+        job = {column.name: getattr(row, column.name) for column in DiscoverJob.__table__.columns}
+        job['counts'] = json.loads(job['counts']) if job['counts'] else None
+        return job
+
+
+class FileJobStore:
+    # one json file per job, next to the indexes; every change happens under a lock shared by all the processes
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def create(self, name, tables_total):
+        job = new_job(name, tables_total)
+        with self._locked():
+            self._expire()
+            active = self._active(name)
+            if active is not None and not stale(active):
+                return None
+            if active is not None:
+                active.update(status='failed', error='Timed out', updated_at=time.time())
+                self._write(active)
+            self._write(job)
+            with open(self._active_path(name), 'w') as f:
+                f.write(job['id'])
+        return job
+
+    def get(self, job_id):
+        try:
+            with open(self._path(job_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def active(self, name):
+        return self._active(name)
+
+    def update(self, job_id, **fields):
+        with self._locked():
+            job = self.get(job_id)
+            if job is None:
+                return
+            job.update(fields, updated_at=time.time())
+            self._write(job)
+            if job['status'] not in ACTIVE:
+                try:
+                    with open(self._active_path(job['name'])) as f:
+                        if f.read() == job_id:
+                            os.remove(self._active_path(job['name']))
+                except OSError:
+                    pass
+
+    def increment(self, job_id, **counts):
+        with self._locked():
+            job = self.get(job_id)
+            if job is None:
+                return
+            for field, count in counts.items():
+                # jobs written before the field existed start from 0
+                job[field] = job.get(field, 0) + count
+            job['updated_at'] = time.time()
+            self._write(job)
+
+    def _expire(self):
+        # written last when they finished, only the old files are read
+        cutoff = time.time() - DISCOVER_JOB_TTL
+        for job_id, stat in scan(self.folder, JOB_FILE).items():
+            if stat.st_mtime >= cutoff:
+                continue
+            job = self.get(job_id)
+            if job is not None and job['status'] in ACTIVE and not stale(job):
+                continue
+            try:
+                os.remove(self._path(job_id))
+            except OSError:
+                pass
+
+    def _active(self, name):
+        try:
+            with open(self._active_path(name)) as f:
+                job = self.get(f.read())
+        except OSError:
+            return None
+        return job if job is not None and job['status'] in ACTIVE else None
+
+    def _write(self, job):
+        # replaced at once, readers never see a half-written file
+        tmp_path = self._path(job['id']) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp_path, self._path(job['id']))
+
+    def _locked(self):
+        return file_lock(os.path.join(self.folder, '.lock'))
+
+    def _path(self, job_id):
+        return os.path.join(self.folder, '{}.json'.format(job_id))
+
+    def _active_path(self, name):
+        return os.path.join(self.folder, '{}.active'.format(name))
+
+
+def job_store(db):
+    if os.environ.get('USE_DATABASE') and db is not None:
+        return DatabaseJobStore(db._engine)
+    return FileJobStore(jobs_folder())
+
+
+@contextmanager
+def job_slot():
+    # one of the DISCOVER_WORKERS slots of the host, every web worker has its own pool of job processes
+    folder = jobs_folder()
+    os.makedirs(folder, exist_ok=True)
+    while True:
+        for slot in range(max(1, DISCOVER_WORKERS)):
+            f = open(os.path.join(folder, '.slot-{}'.format(slot)), 'w')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                continue
+            with f:
+                yield
+            return
+        time.sleep(1)
+
+
+def run_job(job_id, name, tables_info, job_process=False):
+    # runs in a job process: embeds the changed tables and writes the new index version,
+    # requests keep being served from the previous version until the write swaps it in;
+    # returns the added or updated tables and the removed ones, None when the job failed
+    if not job_process:
+        return sync_job(job_id, name, tables_info)
+
+    # stays queued until a slot of the host is free, the embedding model stays loaded for the next job
+    with job_slot():
+        return sync_job(job_id, name, tables_info)
+
+
+def sync_job(job_id, name, tables_info):
+    from . import init_db
+    from .discover import sync_schema_documents
+    from .embeddings import select_embeddings
+    from .indexes import WRITE_ATTEMPTS, IndexConflict, select_index
+
+    db = init_db() if os.environ.get('USE_DATABASE') else None
+    store = job_store(db)
+    try:
+        store.update(job_id, status='running')
+        index_engine = select_index()
+        embeddings = select_embeddings()
+
+        def progress(embedded, total):
+            store.update(job_id, tables_embedded=embedded, tables_changed=total)
+
+        for attempt in range(WRITE_ATTEMPTS):
+            docsearch = index_engine.read_index(db, embeddings, use_cache=False, name=name)
+            docsearch, counts, changed_tables, removed_tables = sync_schema_documents(
+                index_engine, docsearch, tables_info, embeddings, name, DISCOVER_BATCH_SIZE, progress)
+            try:
+                if docsearch is not None:
+                    index_engine.write_index(db, docsearch, name)
+                break
+            except IndexConflict:
+                # the index changed while the tables were embedded, synced again from the newer one
+                if attempt == WRITE_ATTEMPTS - 1:
+                    raise
+                logger.info("Index {} changed during discover, syncing again".format(name))
+        store.update(job_id, status='done', counts=counts,
+                     bytes_persisted=index_engine.index_size("index-{}".format(name)) if docsearch is not None else 0)
+        return {'changed': changed_tables, 'removed': removed_tables}
+    except Exception as e:
+        logger.exception(e)
+        store.update(job_id, status='failed', error=str(e))
+        return None
+
+
+class DiscoverJobs:
+    def __init__(self, workers):
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+        # jobs submitted and not finished yet, the job processes are stopped a while after it drops to 0
+        self._pending = 0
+        # what follows a job in the web process: warming the index and scheduling its sample queries
+        self._followups = ThreadPoolExecutor(max_workers=1)
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                if self.workers > 0:
+                    # spawned, not forked, so the children don't inherit the locks and threads of the web process
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=1)
+            return self._executor
+
+    def reset(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+
+    def release(self, executor):
+        with self._lock:
+            self._pending -= 1
+            if self._pending > 0 or self.workers == 0:
+                return
+        timer = threading.Timer(DISCOVER_WORKERS_IDLE, self.stop_idle, [executor])
+        timer.daemon = True
+        timer.start()
+
+    def stop_idle(self, executor):
+        # the job processes exit, and their embedding models with them
+        with self._lock:
+            if self._pending > 0 or self._executor is not executor:
+                return
+            self._executor = None
+        executor.shutdown(wait=False)
+
+    def submit(self, db, name, tables_info, dialect, schema_dict):
+        # returns the new job, or None and the job the tenant already has running
+        store = job_store(db)
+        job = store.create(name, len(tables_info))
+        if job is None:
+            return None, store.active(name)
+        with self._lock:
+            self._pending += 1
+        executor = self.executor()
+        try:
+            future = executor.submit(run_job, job['id'], name, tables_info, self.workers > 0)
+        except BrokenProcessPool as e:
+            self.reset(executor)
+            self.release(executor)
+            store.update(job['id'], status='failed', error=str(e))
+            raise
+        future.add_done_callback(lambda future: self._followups.submit(
+            self.finish, future, executor, db, job['id'], name, tables_info, dialect, schema_dict))
+        return job, None
+
+    def get(self, db, job_id):
+        return job_store(db).get(job_id)
+
+    def finish(self, future, executor, db, job_id, name, tables_info, dialect, schema_dict):
+        from .embeddings import select_embeddings
+        from .indexes import select_index
+        from .lexical import lexical_index_for
+        from .sample_queries import forget_sample_queries, schedule_sample_queries
+
+        self.release(executor)
+        store = job_store(db)
+        try:
+            tables = future.result()
+            if tables is None:
+                return
+        except Exception as e:
+            # the job process died
+            logger.exception(e)
+            if isinstance(e, BrokenProcessPool):
+                self.reset(executor)
+            store.update(job_id, status='failed', error=str(e))
+            return
+
+        try:
+            index_engine = select_index()
+            embeddings = select_embeddings()
+            docsearch = index_engine.read_index(db, embeddings, name=name)
+            if docsearch is None:
+                return
+            # lexical index of the new table and column names, ready for the first autocomplete
+            lexical_index_for(index_engine, docsearch)
+
+            # sample queries of the added and updated tables are generated in the background and written to
+            # the index as they arrive, the ones of the updated and removed tables were dropped by the job;
+            # the job is done by then, its sample_tables_* fields tell how far the generation is
+            if os.environ.get('GET_SAMPLE_QUERIES', False):
+                forget_sample_queries(db, name, tables['removed'])
+                changed = {table: tables_info[table] for table in tables['changed']}
+                schedule_sample_queries(db, index_engine, embeddings, docsearch, name, changed, dialect,
+                                        schema_dict, lambda **counts: store.increment(job_id, **counts))
+        except Exception as e:
+            logger.exception(e)
+
+
+discover_jobs = DiscoverJobs(DISCOVER_WORKERS)
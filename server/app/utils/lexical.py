@@ -0,0 +1,123 @@
+import math
+import re
+import threading
+import weakref
+
+# lexical index over the table and column names of the schema documents, one per loaded index
+_indexes = weakref.WeakKeyDictionary()
+_indexes_lock = threading.Lock()
+
+IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_$]*')
+TABLE_REFERENCE = re.compile(
+    r'\b(?:from|join|update|into)\s+([^(\s].*?)(?=\b(?:where|join|on|using|group|order|limit|left|right|inner|outer|full|cross|set|values|union)\b|[();]|$)',
+    re.IGNORECASE | re.DOTALL)
+
+# words of the sql grammar and the ddl that say nothing about which table is meant
+KEYWORDS = {
+    'select', 'from', 'where', 'and', 'or', 'not', 'in', 'is', 'null', 'as', 'on', 'join', 'inner', 'left',
+    'right', 'outer', 'full', 'cross', 'group', 'by', 'order', 'having', 'limit', 'offset', 'distinct', 'insert',
+    'into', 'values', 'update', 'set', 'delete', 'create', 'table', 'primary', 'key', 'foreign', 'references',
+    'default', 'constraint', 'unique', 'index', 'asc', 'desc', 'like', 'between', 'case', 'when', 'then', 'else',
+    'end', 'union', 'all', 'exists', 'count', 'sum', 'avg', 'min', 'max', 'with', 'true', 'false', 'int',
+    'integer', 'char', 'varchar', 'text', 'numeric', 'decimal', 'float', 'double', 'date', 'timestamp', 'boolean',
+    'bigint', 'smallint', 'serial', 'engine', 'charset', 'collate', 'auto_increment', 'unsigned', 'enum',
+}
+
+# bm25 parameters
+K1 = 1.2
+B = 0.75
+
+
+def identifiers(text):
+    terms = []
+    for word in IDENTIFIER.findall(text.lower()):
+        if word in KEYWORDS:
+            continue
+        terms.append(word)
+        # snake_case names also match on their parts
+        if '_' in word:
+            terms += [part for part in word.split('_') if part and part not in KEYWORDS]
+    return terms
+
+
+def referenced_tables(query):
+    # tables named after from/join/update/into, without quotes, schema prefixes or aliases
+    tables = []
+    for match in TABLE_REFERENCE.finditer(query):
+        for reference in match.group(1).split(','):
+            name = reference.strip().split()[0] if reference.strip() else ''
+            name = re.sub(r'["`\[\]]', '', name).split('.')[-1].lower()
+            if name and name not in KEYWORDS and name not in tables:
+                tables.append(name)
+    return tables
+
+
+class LexicalIndex:
+    # inverted index from identifier to the schema documents using it, ranked with bm25
+    def __init__(self, documents):
+        self._docs = []
+        self._tables = {}
+        self._postings = {}
+        self._lengths = []
+        for doc in documents:
+            table = doc.metadata.get('table')
+            terms = identifiers(doc.page_content) + (identifiers(table) if table else [])
+            i = len(self._docs)
+            self._docs.append(doc)
+            self._lengths.append(len(terms))
+            if table:
+                self._tables[table.lower()] = i
+            for term in terms:
+                postings = self._postings.setdefault(term, {})
+                postings[i] = postings.get(i, 0) + 1
+        self._average_length = (sum(self._lengths) / len(self._lengths)) if self._lengths else 0
+
+    def tables(self, names):
+        # schema documents of the named tables, None if any of them is unknown
+        docs = []
+        for name in names:
+            i = self._tables.get(name)
+            if i is None:
+                return None
+            docs.append(self._docs[i])
+        return docs
+
+    def search(self, query, k):
+        scores = {}
+        for term in set(identifiers(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (len(self._docs) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for i, tf in postings.items():
+                norm = K1 * (1 - B + B * self._lengths[i] / (self._average_length or 1))
+                scores[i] = scores.get(i, 0) + idf * tf * (K1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda score: -score[1])
+        return [self._docs[i] for i, _ in ranked[:k]]
+
+    def __len__(self):
+        return len(self._docs)
+
+
+def lexical_index_for(index_engine, docsearch):
+    with _indexes_lock:
+        lexical_index = _indexes.get(docsearch)
+    if lexical_index is None:
+        lexical_index = LexicalIndex([doc for doc in index_engine.documents(docsearch).values()
+                                      if doc.metadata.get('type') == 'schema'])
+        with _indexes_lock:
+            lexical_index = _indexes.setdefault(docsearch, lexical_index)
+    return lexical_index
+
+
+def reciprocal_rank_fusion(rankings, k, constant=60):
+    # merges several rankings of documents, a document ranked high in any of them ends up high
+    scores = {}
+    docs = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            key = (doc.page_content, doc.metadata.get('type'), doc.metadata.get('table'))
+            docs.setdefault(key, doc)
+            scores[key] = scores.get(key, 0) + 1.0 / (constant + rank + 1)
+    ranked = sorted(scores.items(), key=lambda score: -score[1])
+    return [docs[key] for key, _ in ranked[:k]]
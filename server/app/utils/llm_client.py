@@ -0,0 +1,142 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from .metrics import record_prompt, span
+from .sequencing import RequestSuperseded
+
+logger = logging.getLogger(__name__)
+
+# generation parameters sent to the self-hosted backend, overridable per endpoint with
+# LLM_AUTOCOMPLETE_PARAMS, LLM_REPAIR_PARAMS and LLM_QUERIES_PARAMS (json objects)
+DEFAULT_PARAMS = {
+    'top_p': 0.1,
+    'typical_p': 1,
+    'repetition_penalty': 1.18,
+    'top_k': 40,
+    'min_length': 0,
+    'no_repeat_ngram_size': 0,
+    'num_beams': 1,
+    'penalty_alpha': 0,
+    'length_penalty': 1,
+    'early_stopping': False,
+    'seed': -1,
+    'add_bos_token': True,
+    'truncation_length': 2048,
+    'ban_eos_token': False,
+    'skip_special_tokens': True,
+    'stopping_strings': []
+}
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class LLMClientError(Exception):
+    pass
+
+
+def endpoint_params(endpoint):
+    params = dict(DEFAULT_PARAMS)
+    params['temperature'] = float(os.environ.get('TEMPERATURE', 1.3))
+    overrides = os.environ.get('LLM_{}_PARAMS'.format(endpoint.upper()))
+    if overrides:
+        try:
+            params.update(json.loads(overrides))
+        except ValueError:
+            logger.error("Invalid LLM_{}_PARAMS, using the defaults".format(endpoint.upper()))
+    return params
+
+
+class LLMClient:
+    # one keep-alive session for every call to the backend, with bounded concurrency and retries
+    def __init__(self, host, user, password, pool_size, connect_timeout, read_timeout, retries, backoff, max_concurrency):
+        self.host = host
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        self.session.auth = (user, password)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+
+    def complete(self, prompt, endpoint, timeout=None, cancelled=None, **params):
+        # returns the generated text, timeout bounds the whole call including the retries,
+        # and a set cancelled event drops the call while it waits for a connection or a retry
+        return self.complete_candidates(prompt, endpoint, timeout, cancelled, **params)[0]
+
+    def complete_candidates(self, prompt, endpoint, timeout=None, cancelled=None, **params):
+        # every result the backend returns, when it generates several
+        record_prompt(endpoint, prompt)
+        with span('llm_' + endpoint):
+            return self._complete(prompt, endpoint, timeout, cancelled, **params)
+
+    def _complete(self, prompt, endpoint, timeout, cancelled, **params):
+        request = endpoint_params(endpoint)
+        request.update(params)
+        request['prompt'] = prompt
+        expires = time.monotonic() + timeout if timeout is not None else None
+
+        attempt = 0
+        while True:
+            remaining = expires - time.monotonic() if expires is not None else None
+            if remaining is not None and remaining <= 0:
+                raise LLMClientError("Timed out waiting for the LLM backend")
+            if not self._acquire(remaining, cancelled):
+                raise LLMClientError("Timed out waiting for a free LLM connection")
+            try:
+                remaining = expires - time.monotonic() if expires is not None else None
+                read_timeout = min(self.read_timeout, remaining) if remaining is not None else self.read_timeout
+                response = self.session.post(self.host, json=request, timeout=(
+                    min(self.connect_timeout, read_timeout), read_timeout))
+                if response.status_code == 200:
+                    return [result['text'] for result in response.json()['results']]
+                if response.status_code not in RETRY_STATUS:
+                    raise LLMClientError("LLM backend answered {}".format(response.status_code))
+                error = LLMClientError("LLM backend answered {}".format(response.status_code))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                self._semaphore.release()
+
+            if attempt >= self.retries:
+                raise error
+            # exponential backoff with full jitter, so retries from many requests spread out
+            delay = random.uniform(0, self.backoff * (2 ** attempt))
+            if expires is not None and time.monotonic() + delay >= expires:
+                raise error
+            logger.warning("LLM backend call failed, retrying: {}".format(error))
+            if cancelled is None:
+                time.sleep(delay)
+            elif cancelled.wait(delay):
+                raise RequestSuperseded()
+            attempt += 1
+
+    def _acquire(self, timeout, cancelled):
+        if cancelled is None:
+            return self._semaphore.acquire(timeout=timeout if timeout is not None else -1)
+        expires = time.monotonic() + timeout if timeout is not None else None
+        while not self._semaphore.acquire(timeout=0.05):
+            if cancelled.is_set():
+                raise RequestSuperseded()
+            if expires is not None and time.monotonic() >= expires:
+                return False
+        if cancelled.is_set():
+            self._semaphore.release()
+            raise RequestSuperseded()
+        return True
+
+
+llm_client = LLMClient(os.environ.get('LLM_HOST', ''), os.environ.get('LLM_USER', ''), os.environ.get('LLM_PASSWORD', ''),
+                       int(os.environ.get('LLM_POOL_SIZE', 32)),
+                       float(os.environ.get('LLM_CONNECT_TIMEOUT', 3)),
+                       float(os.environ.get('LLM_READ_TIMEOUT', 60)),
+                       int(os.environ.get('LLM_RETRIES', 2)),
+                       float(os.environ.get('LLM_BACKOFF', 0.5)),
+                       int(os.environ.get('LLM_MAX_CONCURRENCY', 16)))
@@ -0,0 +1,84 @@
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+from .tokens import count_tokens
+
+# several gunicorn workers share their samples through the files in this folder, which has to exist and be empty at start
+MULTIPROCESS = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192)
+DOCUMENT_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000, 10000000)
+BYTE_BUCKETS = tuple(1024 * 4 ** i for i in range(12))
+
+request_seconds = Histogram('sqlpal_request_seconds', 'Time to answer a request, by route', ['route'],
+                            buckets=LATENCY_BUCKETS)
+stage_seconds = Histogram('sqlpal_stage_seconds', 'Time spent in each stage of the requests and background work',
+                          ['stage'], buckets=LATENCY_BUCKETS)
+prompt_tokens = Histogram('sqlpal_prompt_tokens', 'Tokens of the prompts sent to the LLM, by endpoint', ['endpoint'],
+                          buckets=TOKEN_BUCKETS)
+index_documents = Histogram('sqlpal_index_documents', 'Documents of the indexes loaded or written',
+                            buckets=DOCUMENT_BUCKETS)
+index_bytes = Histogram('sqlpal_index_bytes', 'Size on disk of the indexes loaded or written', buckets=BYTE_BUCKETS)
+cache_lookups = Counter('sqlpal_cache_lookups_total', 'Cache lookups, by cache and result', ['cache', 'result'])
+residency_events = Counter('sqlpal_residency_events_total',
+                           'Tenant indexes demoted from memory, dropped to the database only, or rehydrated', ['event'])
+
+# collectors sampling their values at scrape time, the same in every process
+_collectors = []
+
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.labels(stage).observe(time.perf_counter() - start)
+
+
+def timed(stage):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_cache(cache, hit):
+    cache_lookups.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+def record_prompt(endpoint, prompt):
+    prompt_tokens.labels(endpoint).observe(count_tokens(prompt))
+
+
+def record_index(documents, size=None):
+    index_documents.observe(documents)
+    if size:
+        index_bytes.observe(size)
+
+
+def record_residency(event):
+    residency_events.labels(event).inc()
+
+
+def register_collector(collector):
+    _collectors.append(collector)
+    if not MULTIPROCESS:
+        REGISTRY.register(collector)
+
+
+def render_metrics():
+    # text exposition format, merged from every worker process when there are several
+    registry = REGISTRY
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        for collector in _collectors:
+            registry.register(collector)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
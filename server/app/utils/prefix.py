@@ -0,0 +1,85 @@
+import bisect
+import re
+import threading
+import weakref
+
+# prefix index of the stored queries, one per loaded index
+_indexes = weakref.WeakKeyDictionary()
+_indexes_lock = threading.Lock()
+
+# how many candidates sharing the prefix are ranked at most
+MAX_SCAN = 256
+
+
+def normalize(query):
+    return re.sub(r'\s+', ' ', query.strip()).lower()
+
+
+class PrefixIndex:
+    # sorted array of normalized queries, searched with bisect
+    def __init__(self, keys=None, queries=None):
+        self._keys = keys or []
+        self._queries = queries or []
+        self._lock = threading.Lock()
+
+    def add(self, queries):
+        with self._lock:
+            for query in queries:
+                key = normalize(query)
+                i = bisect.bisect_left(self._keys, key)
+                if i < len(self._keys) and self._keys[i] == key:
+                    continue
+                self._keys.insert(i, key)
+                self._queries.insert(i, query)
+
+    def complete(self, prefix, min_ratio, limit):
+        key = normalize(prefix)
+        if not key:
+            return []
+        matches = []
+        with self._lock:
+            i = bisect.bisect_left(self._keys, key)
+            end = min(i + MAX_SCAN, len(self._keys))
+            while i < end and self._keys[i].startswith(key):
+                # same as SequenceMatcher's ratio when one string is a prefix of the other
+                ratio = 2.0 * len(key) / (len(key) + len(self._keys[i]))
+                if ratio > min_ratio:
+                    matches.append((ratio, self._queries[i]))
+                i += 1
+        matches.sort(key=lambda match: -match[0])
+        return [query for _, query in matches[:limit]]
+
+    def copy(self):
+        with self._lock:
+            return PrefixIndex(list(self._keys), list(self._queries))
+
+    def __len__(self):
+        return len(self._keys)
+
+
+def prefix_index_for(index_engine, docsearch):
+    with _indexes_lock:
+        prefix_index = _indexes.get(docsearch)
+    if prefix_index is None:
+        prefix_index = PrefixIndex()
+        prefix_index.add([doc.page_content for doc in index_engine.documents(docsearch).values()
+                          if doc.metadata.get('type') == 'query' and doc.page_content])
+        with _indexes_lock:
+            prefix_index = _indexes.setdefault(docsearch, prefix_index)
+    return prefix_index
+
+
+def copy_prefix_index(docsearch, docsearch_copy):
+    with _indexes_lock:
+        prefix_index = _indexes.get(docsearch)
+        if prefix_index is not None:
+            _indexes[docsearch_copy] = prefix_index.copy()
+
+
+def add_to_prefix_index(docsearch, texts, metadatas):
+    # only kept up to date once built, otherwise it is built on first use
+    with _indexes_lock:
+        prefix_index = _indexes.get(docsearch)
+    if prefix_index is not None:
+        prefix_index.add([text for text, metadata in zip(texts, metadatas)
+                          if (metadata or {}).get('type') == 'query' and text])
@@ -0,0 +1,78 @@
+import os
+import re
+from .metrics import timed
+from .tokens import count_tokens
+
+# tokens the schema and example queries may take in a prompt, the template itself not included
+PROMPT_TOKEN_BUDGET = int(os.environ.get('PROMPT_TOKEN_BUDGET', 1500))
+
+CREATE_TABLE = re.compile(
+    r'create\s+(?:temporary\s+|temp\s+)?table\s+(?:if\s+not\s+exists\s+)?([\w."`\[\]]+)\s*\((.*)\)', re.IGNORECASE | re.DOTALL)
+CONSTRAINTS = ('primary', 'foreign', 'constraint', 'unique', 'key', 'index', 'check', 'fulltext', 'spatial')
+# first word of the type, with its arguments like numeric(10, 2) or varchar (20)
+COLUMN_TYPE = re.compile(r'[^\s(]+(?:\s*\([^)]*\))?')
+
+
+def split_columns(body):
+    # top-level commas only, types like numeric(10,2) keep theirs
+    parts = []
+    depth = 0
+    current = ''
+    for char in body:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        if char == ',' and depth == 0:
+            parts.append(current)
+            current = ''
+        else:
+            current += char
+    parts.append(current)
+    return [part.strip() for part in parts if part.strip()]
+
+
+def render_schema(doc):
+    # table(col type, ...) from a create table statement, or the text itself collapsed to one line
+    text = re.sub(r'\s+', ' ', doc.page_content).strip()
+    match = CREATE_TABLE.search(text)
+    if match is None:
+        return text
+    name = re.sub(r'["`\[\]]', '', match.group(1))
+    columns = []
+    for column in split_columns(match.group(2)):
+        words = column.split()
+        if words[0].lower() in CONSTRAINTS:
+            continue
+        column_type = COLUMN_TYPE.match(column[len(words[0]):].strip())
+        column_type = [re.sub(r'\s+', '', column_type.group(0))] if column_type else []
+        columns.append(' '.join([re.sub(r'["`\[\]]', '', words[0])] + column_type))
+    return '{}({})'.format(name, ', '.join(columns))
+
+
+@timed('prompt')
+def build_table_info(docs, budget=None):
+    # schema documents rendered compactly and deduplicated, added by relevance until the token budget is spent
+    budget = PROMPT_TOKEN_BUDGET if budget is None else budget
+    tables = []
+    queries = []
+    seen = set()
+    used = 0
+    for doc in docs or []:
+        if doc.metadata.get('type') == 'query':
+            text = re.sub(r'\s+', ' ', doc.page_content).strip()
+        else:
+            text = render_schema(doc)
+        if not text or text in seen:
+            continue
+        tokens = count_tokens(text) + 1
+        if budget > 0 and used + tokens > budget:
+            continue
+        seen.add(text)
+        used += tokens
+        (queries if doc.metadata.get('type') == 'query' else tables).append(text)
+
+    info = '\n'.join(tables)
+    if len(queries) > 0:
+        info += '\n\nExample queries:\n' + '\n'.join(queries)
+    return info
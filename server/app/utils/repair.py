@@ -2,12 +2,20 @@ import logging
 import os
 import sys
 
-from . import extract_queries_from_result
+from . import extract_candidates
+from .completion_cache import completion_cache
+from .embeddings import select_embeddings
+from .llm_client import llm_client
+from .metrics import record_prompt, span
+from .prompt import build_table_info
+from .prefix import normalize
+from .autocomplete import llm_timeout_args
+from .deadline import RETRIEVAL_SHARE, DeadlineExceeded, run_stage
+from .retrieval import best_stored_query, lexical_documents, retrieve_documents
+from .validation import rank_candidates
 from langchain.chat_models import ChatOpenAI
 from langchain.llms import OpenAI
 from langchain import PromptTemplate, LLMChain
-import requests
-from requests.auth import HTTPBasicAuth
 
 REPAIR_TEMPLATE = os.environ.get('REPAIR_PROMPT', """
 You are an smart SQL assistant, capable of fixing SQL queries based on instructions and feedback. Follow that guidelines:
@@ -42,85 +50,91 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logger.setLevel(logging.INFO)
 
-def predict_repair(llm, query, error_message, docsearch, dialect):    
-    # different search types
-    if (os.environ.get('SEARCH_TYPE', 'similarity') == 'mmr'):
-        docs = docsearch.max_marginal_relevance_search(
-            query, k=int(os.environ.get('DOCS_TO_RETRIEVE', 5)))
-    else:
-        docs = docsearch.similarity_search(
-            query, k=int(os.environ.get('DOCS_TO_RETRIEVE', 5)))
-
+def predict_repair(llm, query, error_message, docs, dialect):
     #  no queries stored, go with llm
     prompt = PromptTemplate(
         input_variables=["query", "error_message", "table_info", "dialect"], template=REPAIR_TEMPLATE)
     llm_chain = LLMChain(llm=llm, prompt=prompt)
-    res = llm_chain.predict(table_info=docs, query=query, error_message=error_message, dialect=dialect)
-    logger.info("Result from LLM: "+res)
+    table_info = build_table_info(docs)
+    record_prompt('repair', prompt.format(table_info=table_info, query=query, error_message=error_message, dialect=dialect))
+    with span('llm_repair'):
+        result = llm_chain.generate([{'table_info': table_info, 'query': query, 'error_message': error_message,
+                                      'dialect': dialect, 'stop': [';']}])
+    res = [generation.text for generation in result.generations[0]]
+    logger.info("Result from LLM: {}".format(res))
     return res
 
-def repair_chat(query, error_message, docsearch, dialect):
+def repair_chat(query, error_message, docs, dialect, timeout=None):
     llm = ChatOpenAI(temperature=os.environ.get('TEMPERATURE', 0.9),
-                     model_name=os.environ.get('REPAIR_MODEL', 'gpt-3.5-turbo'), n=int(os.environ.get('OPENAI_NUM_ANSWERS', 1)))
-    res = predict_repair(llm, query, error_message, docsearch, dialect)
-    final_queries = extract_queries_from_result(res)
+                     model_name=os.environ.get('REPAIR_MODEL', 'gpt-3.5-turbo'), n=int(os.environ.get('OPENAI_NUM_ANSWERS', 1)),
+                     **llm_timeout_args(timeout))
+    res = predict_repair(llm, query, error_message, docs, dialect)
+    final_queries = extract_candidates(res)
     return final_queries
 
-def repair_selfhosted(query, error_message, docsearch, dialect):
-    # different search types
-    if (os.environ.get('SEARCH_TYPE', 'similarity') == 'mmr'):
-        docs = docsearch.max_marginal_relevance_search(
-            query, k=int(os.environ.get('DOCS_TO_RETRIEVE', 5)))
-    else:
-        docs = docsearch.similarity_search(
-            query, k=int(os.environ.get('DOCS_TO_RETRIEVE', 5)))
-
+def repair_selfhosted(query, error_message, docs, dialect, timeout=None):
     prompt = PromptTemplate(
         input_variables=["query", "table_info", "dialect"], template=REPAIR_TEMPLATE)
-    query = prompt.format(query=query, error_message=error_message, table_info=docs, dialect=dialect)
-
-    # issue a request to an external API
-    request = {
-        'prompt': query,
-        'temperature': float(os.environ.get('TEMPERATURE', 1.3)),
-        'top_p': 0.1,
-        'typical_p': 1,
-        'repetition_penalty': 1.18,
-        'top_k': 40,
-        'min_length': 0,
-        'no_repeat_ngram_size': 0,
-        'num_beams': 1,
-        'penalty_alpha': 0,
-        'length_penalty': 1,
-        'early_stopping': False,
-        'seed': -1,
-        'add_bos_token': True,
-        'truncation_length': 2048,
-        'ban_eos_token': False,
-        'skip_special_tokens': True,
-        'stopping_strings': []
-    }
+    query = prompt.format(query=query, error_message=error_message, table_info=build_table_info(docs), dialect=dialect)
 
     try:
-        response = requests.post(os.environ.get('LLM_HOST', ''), json=request, auth=HTTPBasicAuth(
-            os.environ.get('LLM_USER', ''), os.environ.get('LLM_PASSWORD', '')))
-        if response.status_code == 200:
-            result = response.json()['results'][0]['text']
-            logger.info("Result from LLM: "+result)
-            final_queries = extract_queries_from_result(result)
-            return final_queries
+        results = llm_client.complete_candidates(query, 'repair', timeout, stopping_strings=[';'])
+        logger.info("Result from LLM: {}".format(results))
+        return extract_candidates(results)
     except Exception as e:
-        logger.exception("Error in autocomplete_selfhosted: "+e)
+        logger.exception(e)
 
     return None
 
-def repair_query_suggestions(query, error_message, docsearch, dialect):
-    if os.environ.get('REPAIR_METHOD', 'chat') == 'chat':
-        queries = repair_chat(query, error_message, docsearch, dialect)
-    elif os.environ.get('REPAIR_METHOD', 'chat') == 'selfhosted':
-        queries = repair_selfhosted(query, error_message, docsearch, dialect)
+def repair_query_suggestions(query, error_message, docsearch, dialect, tenant=None, version=None, deadline=None, conn_str=None):
+    # answers already given for this index version
+    key = None
+    if tenant is not None and version is not None:
+        key = ('repair', tenant, version, dialect, normalize(query), normalize(error_message))
+        queries = completion_cache.get(key)
+        if queries is not None:
+            logger.info("Returned cached queries are: ")
+            logger.info(queries)
+            return queries
+
+    # a query naming all its tables gets their schema from the lexical index, without embedding
+    embedding = None
+    docs = lexical_documents(docsearch, query)
+    if docs is None:
+        # the query embedding is computed once, for the near-duplicate lookup and the retrieval
+        try:
+            embedding = run_stage(deadline, RETRIEVAL_SHARE, select_embeddings().embed_query, query)
+        except DeadlineExceeded:
+            logger.warning("Deadline exceeded while embedding the query")
+            return []
+        if key is not None:
+            queries = completion_cache.get_similar(key, embedding)
+            if queries is not None:
+                logger.info("Returned cached queries for a similar query are: ")
+                logger.info(queries)
+                return queries
+        try:
+            docs = run_stage(deadline, RETRIEVAL_SHARE, retrieve_documents, docsearch, query, embedding)
+        except DeadlineExceeded:
+            logger.warning("Deadline exceeded while retrieving documents")
+            return []
+
+    timeout = deadline.remaining() if deadline is not None else None
+    if os.environ.get('REPAIR_METHOD', 'chat') == 'selfhosted':
+        generate = repair_selfhosted
     else:
-        queries = repair_chat(query, error_message, docsearch, dialect)
+        generate = repair_chat
+    try:
+        queries = run_stage(deadline, None, generate, query, error_message, docs, dialect, timeout)
+    except DeadlineExceeded:
+        queries = best_stored_query(docs)
+        logger.warning("Deadline exceeded while generating, returned stored queries are: ")
+        logger.info(queries)
+        return queries
+    queries = rank_candidates(queries, docsearch, dialect, conn_str, deadline.remaining() if deadline is not None else None)
     logger.info("Returned queries are: ")
     logger.info(queries)
+
+    if key is not None and queries and any(queries):
+        completion_cache.put(key, queries, embedding)
     return queries
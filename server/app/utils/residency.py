@@ -0,0 +1,315 @@
+import fcntl
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from prometheus_client.core import GaugeMetricFamily
+from .index_cache import index_cache
+from .metrics import record_residency, register_collector, span
+
+logger = logging.getLogger(__name__)
+
+# the indexes under INDEX_FOLDER (a tmpfs) are the hot tier, the least recently used ones past its budget are
+# compressed to the cold folder on disk; with a database, cold copies past their budget are dropped and reloaded from it
+INDEX_HOT_MAX_BYTES = int(os.environ.get('INDEX_HOT_MAX_BYTES', 1024 * 1024 * 1024))
+INDEX_COLD_MAX_BYTES = int(os.environ.get('INDEX_COLD_MAX_BYTES', 10 * 1024 * 1024 * 1024))
+# tenants not used for this long are demoted even under the budget, 0 only demotes past the budget
+INDEX_IDLE_SECONDS = float(os.environ.get('INDEX_IDLE_SECONDS', 0))
+# tenants used more recently than this are never demoted, so a budget too small for the working set doesn't thrash
+INDEX_MIN_RESIDENCY_SECONDS = float(os.environ.get('INDEX_MIN_RESIDENCY_SECONDS', 300))
+INDEX_COMPRESSION_LEVEL = int(os.environ.get('INDEX_COMPRESSION_LEVEL', 6))
+
+# the last use of a tenant is written at most this often by each process, and the tiers checked at most this often
+TOUCH_INTERVAL = 60
+SWEEP_INTERVAL = 60
+
+HOT_FILE = re.compile(r'^index-(.+)\.sqlpal$')
+COLD_FILE = re.compile(r'^index-(.+)\.sqlpal\.z$')
+JOB_FILE = re.compile(r'^(\w+)\.json$')
+
+
+def hot_folder():
+    return os.environ.get('INDEX_FOLDER', '/tmp/indexes')
+
+
+def cold_folder():
+    return os.environ.get('INDEX_COLD_FOLDER', '/tmp/sqlpal-cold')
+
+
+def hot_path(name):
+    return os.path.join(hot_folder(), 'index-{}.sqlpal'.format(name))
+
+
+def cold_path(name):
+    return os.path.join(cold_folder(), 'index-{}.sqlpal.z'.format(name))
+
+
+def seen_path(name):
+    return os.path.join(hot_folder(), 'residency', name)
+
+
+def jobs_folder():
+    # the discover jobs without a database share the hot tier, and its budget, with the indexes
+    return os.path.join(hot_folder(), 'jobs')
+
+
+@contextmanager
+def file_lock(path):
+    # released when the file is closed
+    with open(path, 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def scan(folder, pattern):
+    files = {}
+    try:
+        entries = os.scandir(folder)
+    except OSError:
+        return files
+    with entries:
+        for entry in entries:
+            match = pattern.match(entry.name)
+            if match is not None:
+                try:
+                    files[match.group(1)] = entry.stat()
+                except OSError:
+                    pass
+    return files
+
+
+def jobs_bytes():
+    return sum(stat.st_size for stat in scan(jobs_folder(), JOB_FILE).values())
+
+
+def last_used(name, stat):
+    try:
+        seen = os.stat(seen_path(name)).st_mtime
+    except OSError:
+        seen = 0
+    return max(seen, stat.st_mtime)
+
+
+class Residency:
+    # moves the tenant indexes between the tiers, shared by every process through the files and a lock
+    def __init__(self, hot_max_bytes, cold_max_bytes):
+        self.hot_max_bytes = hot_max_bytes
+        self.cold_max_bytes = cold_max_bytes
+        self.demotions = 0
+        self.drops = 0
+        self.rehydrations = 0
+        self._touched = {}
+        self._last_sweep = 0
+        self._sweeping = False
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def locked(self):
+        # taken to swap files in and out of the hot tier, so a demotion never races a write
+        return file_lock(os.path.join(hot_folder(), '.residency.lock'))
+
+    def touch(self, name):
+        now = time.time()
+        with self._lock:
+            if now - self._touched.get(name, 0) < TOUCH_INTERVAL:
+                return
+            self._touched[name] = now
+        path = seen_path(name)
+        try:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                open(path, 'a').close()
+        except OSError as e:
+            logger.warning("Could not record the use of index {}: {}".format(name, e))
+        self.schedule_sweep()
+
+    def schedule_sweep(self):
+        if self.hot_max_bytes <= 0 and INDEX_IDLE_SECONDS <= 0:
+            return
+        with self._lock:
+            if self._sweeping or time.time() - self._last_sweep < SWEEP_INTERVAL:
+                return
+            self._sweeping = True
+            self._last_sweep = time.time()
+        self._executor.submit(self.sweep)
+
+    def sweep(self):
+        try:
+            now = time.time()
+            hot = scan(hot_folder(), HOT_FILE)
+            total = sum(stat.st_size for stat in hot.values()) + jobs_bytes()
+            used = {name: last_used(name, stat) for name, stat in hot.items()}
+            # least recently used first
+            for name in sorted(hot, key=used.get):
+                idle = now - used[name]
+                over_budget = self.hot_max_bytes > 0 and total > self.hot_max_bytes
+                if idle < INDEX_MIN_RESIDENCY_SECONDS or not (
+                        over_budget or (INDEX_IDLE_SECONDS > 0 and idle > INDEX_IDLE_SECONDS)):
+                    break
+                if self.demote(name):
+                    total -= hot[name].st_size
+            if self.hot_max_bytes > 0 and total > self.hot_max_bytes:
+                logger.warning("Indexes in use take {} bytes, over the budget of {}".format(total, self.hot_max_bytes))
+            self.trim_cold()
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            with self._lock:
+                self._sweeping = False
+
+    def demote(self, name):
+        # compressed outside of the lock, and only swapped in if the index was not written meanwhile
+        path = hot_path(name)
+        try:
+            before = os.stat(path)
+            with open(path, 'rb') as f:
+                content = f.read()
+        except OSError:
+            return False
+
+        # with a database, a tenant without a cold copy is reloaded from it
+        tmp_path = None
+        if self.cold_max_bytes > 0 or not os.environ.get('USE_DATABASE'):
+            os.makedirs(cold_folder(), exist_ok=True)
+            tmp_path = '{}.{}.tmp'.format(cold_path(name), os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(zlib.compress(content, INDEX_COMPRESSION_LEVEL))
+            # restored on rehydration, so the version of the index and the copies cached from it stay valid
+            os.utime(tmp_path, ns=(before.st_atime_ns, before.st_mtime_ns))
+
+        with self.locked():
+            try:
+                current = os.stat(path)
+            except OSError:
+                current = None
+            if current is None or (current.st_ino, current.st_mtime_ns) != (before.st_ino, before.st_mtime_ns):
+                if tmp_path is not None:
+                    os.remove(tmp_path)
+                return False
+            if tmp_path is not None:
+                os.replace(tmp_path, cold_path(name))
+            os.remove(path)
+
+        index_cache.invalidate(name)
+        with self._lock:
+            self.demotions += 1
+            if tmp_path is None:
+                self.drops += 1
+        record_residency('demoted')
+        if tmp_path is None:
+            record_residency('dropped')
+        logger.info("Demoted index {} of {} bytes to {}".format(
+            name, before.st_size, 'disk' if tmp_path is not None else 'the database'))
+        return True
+
+    def trim_cold(self):
+        cold = scan(cold_folder(), COLD_FILE)
+        total = sum(stat.st_size for stat in cold.values())
+        if total <= self.cold_max_bytes:
+            return
+        if not os.environ.get('USE_DATABASE'):
+            # the cold copies are the only ones
+            logger.warning("Demoted indexes take {} bytes, over the budget of {}".format(total, self.cold_max_bytes))
+            return
+
+        used = {name: last_used(name, stat) for name, stat in cold.items()}
+        for name in sorted(cold, key=used.get):
+            if total <= self.cold_max_bytes:
+                break
+            with self.locked():
+                try:
+                    os.remove(cold_path(name))
+                except OSError:
+                    continue
+            total -= cold[name].st_size
+            with self._lock:
+                self.drops += 1
+            record_residency('dropped')
+            logger.info("Dropped the demoted copy of index {}".format(name))
+
+    def rehydrate(self, name):
+        # brings a demoted index back to the hot tier, True when it is there
+        if not os.path.exists(cold_path(name)):
+            return False
+        try:
+            with span('rehydrate_index'), self.locked():
+                path = hot_path(name)
+                if os.path.exists(path):
+                    return True
+                try:
+                    with open(cold_path(name), 'rb') as f:
+                        stat = os.fstat(f.fileno())
+                        content = zlib.decompress(f.read())
+                except FileNotFoundError:
+                    return False
+                tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+                with open(tmp_path, 'wb') as f:
+                    f.write(content)
+                os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+                os.replace(tmp_path, path)
+                os.remove(cold_path(name))
+        except (OSError, zlib.error) as e:
+            logger.exception(e)
+            return False
+
+        with self._lock:
+            self.rehydrations += 1
+        record_residency('rehydrated')
+        logger.info("Rehydrated index {}".format(name))
+        return True
+
+    def discard_cold(self, name):
+        # an index just written makes its demoted copy outdated, called under the lock
+        try:
+            os.remove(cold_path(name))
+        except FileNotFoundError:
+            pass
+
+    def stats(self, db=None):
+        hot = scan(hot_folder(), HOT_FILE)
+        cold = scan(cold_folder(), COLD_FILE)
+        jobs = jobs_bytes()
+        with self._lock:
+            stats = {
+                'hot': {'tenants': len(hot), 'bytes': sum(stat.st_size for stat in hot.values()) + jobs,
+                        'jobs_bytes': jobs, 'max_bytes': self.hot_max_bytes},
+                'cold': {'tenants': len(cold), 'bytes': sum(stat.st_size for stat in cold.values()),
+                         'max_bytes': self.cold_max_bytes},
+                'demotions': self.demotions, 'drops': self.drops, 'rehydrations': self.rehydrations,
+            }
+        if db is not None:
+            from sqlalchemy import func, select
+            from sqlalchemy.orm import Session
+            from .indexes import IndexContent
+
+            try:
+                with Session(bind=db._engine) as sess:
+                    stored = sess.execute(select(func.count()).select_from(IndexContent)).scalar()
+                stats['database'] = {'tenants': stored, 'db_only': max(stored - len(set(hot) | set(cold)), 0)}
+            except Exception as e:
+                logger.exception(e)
+        stats['cache'] = index_cache.stats()
+        return stats
+
+
+class ResidencyCollector:
+    # sampled from the folders at scrape time, the same whichever worker answers
+    def collect(self):
+        tenants = GaugeMetricFamily('sqlpal_residency_tenants', 'Tenant indexes in each tier', labels=['tier'])
+        size = GaugeMetricFamily('sqlpal_residency_bytes', 'Size of the tenant indexes in each tier', labels=['tier'])
+        for tier, folder, pattern in (('hot', hot_folder(), HOT_FILE), ('cold', cold_folder(), COLD_FILE)):
+            files = scan(folder, pattern)
+            tenants.add_metric([tier], len(files))
+            size.add_metric([tier], sum(stat.st_size for stat in files.values()) + (jobs_bytes() if tier == 'hot' else 0))
+        yield tenants
+        yield size
+
+
+residency = Residency(INDEX_HOT_MAX_BYTES, INDEX_COLD_MAX_BYTES)
+register_collector(ResidencyCollector())
@@ -0,0 +1,104 @@
+import os
+import threading
+from collections import OrderedDict
+from .indexes import select_index
+from .lexical import lexical_index_for, reciprocal_rank_fusion, referenced_tables
+from .metrics import record_cache, span, timed
+
+# lexical hits on table and column names are merged with the vector ones
+HYBRID_RETRIEVAL = os.environ.get('HYBRID_RETRIEVAL', 'True') != 'False'
+
+
+def retrieve_documents(docsearch, query, embedding=None):
+    k = int(os.environ.get('DOCS_TO_RETRIEVE', 5))
+    docs = vector_documents(docsearch, query, embedding, k)
+    if not HYBRID_RETRIEVAL:
+        return docs
+    lexical_index = lexical_index_for(select_index(), docsearch)
+    if len(lexical_index) == 0:
+        return docs
+    with span('lexical_search'):
+        lexical_docs = lexical_index.search(query, k)
+    return reciprocal_rank_fusion([docs, lexical_docs], k)
+
+
+@timed('vector_search')
+def vector_documents(docsearch, query, embedding, k):
+    # different search types, reusing the query embedding when it was already computed
+    if embedding is None:
+        if (os.environ.get('SEARCH_TYPE', 'similarity') == 'mmr'):
+            return docsearch.max_marginal_relevance_search(query, k=k)
+        return docsearch.similarity_search(query, k=k)
+
+    if (os.environ.get('SEARCH_TYPE', 'similarity') == 'mmr'):
+        return docsearch.max_marginal_relevance_search_by_vector(embedding, k=k)
+    return docsearch.similarity_search_by_vector(embedding, k=k)
+
+
+@timed('lexical_search')
+def lexical_documents(docsearch, query):
+    # schema of the tables the query names itself, found without any embedding call;
+    # None when it names none, or one the index doesn't know (yet)
+    if not HYBRID_RETRIEVAL:
+        return None
+    names = referenced_tables(query)
+    if len(names) == 0:
+        return None
+    lexical_index = lexical_index_for(select_index(), docsearch)
+    docs = lexical_index.tables(names)
+    if docs is None:
+        return None
+    # plus the tables of the other identifiers, like the columns being typed
+    k = max(int(os.environ.get('DOCS_TO_RETRIEVE', 5)), len(docs))
+    docs += [doc for doc in lexical_index.search(query, k) if doc not in docs]
+    return docs[:k]
+
+
+def best_stored_query(docs):
+    # fallback when there is no time left for the llm: the closest stored query, if any
+    for doc in docs or []:
+        if doc.metadata.get('type') == 'query' and doc.page_content:
+            return [doc.page_content]
+    return []
+
+
+class RetrievalCache:
+    # query embedding and retrieved documents, keyed by (tenant, index version, normalized query)
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                record_cache('retrieval', False)
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            record_cache('retrieval', True)
+            return entry
+
+    def put(self, key, embedding, docs):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (embedding, docs)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+retrieval_cache = RetrievalCache(int(os.environ.get('RETRIEVAL_CACHE_SIZE', 1000)))
@@ -0,0 +1,133 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from .autocomplete import SAMPLE_QUERIES_TEMPLATE, generate_queries_for_schema
+from .indexes import SampleQueryTask
+from .tokens import TokenRateLimiter, count_tokens
+from .write_buffer import write_buffer
+
+logger = logging.getLogger(__name__)
+
+# bounded pool, so many tables are generated at once without flooding the llm
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('SAMPLE_QUERIES_CONCURRENCY', 4)))
+rate_limiter = TokenRateLimiter(
+    int(os.environ.get('SAMPLE_QUERIES_TOKENS_PER_MINUTE', 90000)))
+OUTPUT_TOKENS = int(os.environ.get('SAMPLE_QUERIES_OUTPUT_TOKENS', 1000))
+
+_in_progress = set()
+_in_progress_lock = threading.Lock()
+
+
+def tables_with_sample_queries(index_engine, docsearch):
+    tables = set()
+    for doc in index_engine.documents(docsearch).values():
+        if doc.metadata.get('type') == 'query' and doc.metadata.get('source') == 'sample':
+            tables.add(doc.metadata.get('table'))
+    return tables
+
+
+def schedule_sample_queries(db, index_engine, embeddings, docsearch, name, tables_info, dialect, schema_dict, progress=None):
+    # skip the tables that already got their sample queries; progress is called with the counts to add,
+    # sample_tables_total for every table scheduled, then sample_tables_done and queries_generated as they end
+    done = tables_with_sample_queries(index_engine, docsearch)
+    tables = {table: info for table, info in tables_info.items() if table not in done}
+    if len(tables) == 0:
+        return 0
+
+    if os.environ.get('USE_DATABASE'):
+        try:
+            with Session(bind=db._engine) as sess:
+                rows = [{'name': name, 'table_name': table, 'table_info': info, 'dialect': dialect}
+                        for table, info in tables.items()]
+                for i in range(0, len(rows), 1000):
+                    statement = insert(SampleQueryTask).values(rows[i:i + 1000])
+                    sess.execute(statement.on_conflict_do_update(
+                        index_elements=[SampleQueryTask.name, SampleQueryTask.table_name],
+                        set_={'table_info': statement.excluded.table_info, 'dialect': statement.excluded.dialect}))
+                sess.commit()
+        except Exception as e:
+            logger.exception(e)
+
+    scheduled = 0
+    for table, info in tables.items():
+        if submit(db, index_engine, embeddings, name, table, info, dialect, schema_dict, progress):
+            scheduled += 1
+    logger.info("Scheduled sample queries for {} tables".format(scheduled))
+    return scheduled
+
+
+def resume_sample_queries(db, index_engine, embeddings):
+    # pick up the tables left pending by a previous run
+    with Session(bind=db._engine) as sess:
+        tasks = sess.execute(select(SampleQueryTask.name, SampleQueryTask.table_name,
+                                    SampleQueryTask.table_info, SampleQueryTask.dialect)).all()
+    for task in tasks:
+        submit(db, index_engine, embeddings, task.name,
+               task.table_name, task.table_info, task.dialect, {})
+    if len(tasks) > 0:
+        logger.info("Resumed sample queries for {} tables".format(len(tasks)))
+
+
+def submit(db, index_engine, embeddings, name, table, info, dialect, schema_dict, progress=None):
+    with _in_progress_lock:
+        if (name, table) in _in_progress:
+            return False
+        _in_progress.add((name, table))
+    if progress is not None:
+        progress(sample_tables_total=1)
+    _executor.submit(generate_for_table, db, index_engine,
+                     embeddings, name, table, info, dialect, schema_dict, progress)
+    return True
+
+
+def generate_for_table(db, index_engine, embeddings, name, table, info, dialect, schema_dict, progress=None):
+    try:
+        prompt = SAMPLE_QUERIES_TEMPLATE.format(table_info=info, dialect=dialect)
+        rate_limiter.acquire(count_tokens(prompt) + OUTPUT_TOKENS)
+        queries = generate_queries_for_schema(info, schema_dict, dialect)
+        queries = [query for query in (queries or []) if isinstance(query, str) and query.strip()]
+        if len(queries) == 0:
+            complete(db, name, table, 0, progress)
+            return
+
+        # embedded in one batch, and written to the stored index with the other pending additions
+        write_buffer.add(name, db, index_engine, embeddings, queries,
+                         [{'type': 'query', 'source': 'sample', 'table': table} for _ in queries],
+                         callback=lambda: complete(db, name, table, len(queries), progress),
+                         errback=lambda: release(name, table, progress))
+    except Exception as e:
+        logger.exception(e)
+        release(name, table, progress)
+
+
+def forget_sample_queries(db, name, tables):
+    # tables not in the schema anymore are not resumed
+    if os.environ.get('USE_DATABASE') and len(tables) > 0:
+        with Session(bind=db._engine) as sess:
+            sess.execute(delete(SampleQueryTask).where(
+                SampleQueryTask.name == name, SampleQueryTask.table_name.in_(tables)))
+            sess.commit()
+
+
+def release(name, table, progress=None):
+    # stays pending, and can be scheduled again; the job that scheduled it is done with it
+    with _in_progress_lock:
+        _in_progress.discard((name, table))
+    if progress is not None:
+        progress(sample_tables_done=1)
+
+
+def complete(db, name, table, count=0, progress=None):
+    release(name, table)
+    if progress is not None:
+        progress(sample_tables_done=1, queries_generated=count)
+    if os.environ.get('USE_DATABASE'):
+        with Session(bind=db._engine) as sess:
+            sess.execute(delete(SampleQueryTask).where(
+                SampleQueryTask.name == name, SampleQueryTask.table_name == table))
+            sess.commit()
@@ -0,0 +1,53 @@
+import threading
+
+
+class RequestSuperseded(Exception):
+    pass
+
+
+class Ticket:
+    def __init__(self, key, sequence):
+        self.key = key
+        self.sequence = sequence
+        self.cancelled = threading.Event()
+
+    def superseded(self):
+        return self.cancelled.is_set()
+
+
+class RequestSequencer:
+    # latest autocomplete request of every session in this process, a newer one cancels the one in flight
+    def __init__(self):
+        self.superseded = 0
+        self._latest = {}
+        self._lock = threading.Lock()
+
+    def start(self, key, sequence=None):
+        # without a key the request is not sequenced, and never cancelled
+        ticket = Ticket(key, sequence)
+        if key is None:
+            return ticket
+        with self._lock:
+            previous = self._latest.get(key)
+            if previous is not None and sequence is not None and previous.sequence is not None and sequence < previous.sequence:
+                # arrived after a newer one from the same session
+                ticket.cancelled.set()
+                self.superseded += 1
+                return ticket
+            self._latest[key] = ticket
+            if previous is not None and not previous.superseded():
+                previous.cancelled.set()
+                self.superseded += 1
+        return ticket
+
+    def finish(self, ticket):
+        with self._lock:
+            if self._latest.get(ticket.key) is ticket:
+                del self._latest[ticket.key]
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': len(self._latest), 'superseded': self.superseded}
+
+
+request_sequencer = RequestSequencer()
@@ -0,0 +1,82 @@
+import json
+import struct
+import faiss
+import numpy as np
+from langchain import FAISS
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+
+# layout: magic, header (version, faiss size, docstore size), raw faiss index, docstore
+# docstore: count, text lengths, utf-8 texts, json with ids and metadatas
+MAGIC = b'SQLPAL\x02'
+HEADER = struct.Struct('<QQQ')
+HEADER_SIZE = len(MAGIC) + HEADER.size
+
+
+def is_native(content):
+    return bytes(content[:len(MAGIC)]) == MAGIC
+
+
+def read_version(content):
+    return HEADER.unpack_from(content, len(MAGIC))[0]
+
+
+def with_version(content, version):
+    return MAGIC + struct.pack('<Q', version) + bytes(content[len(MAGIC) + 8:])
+
+
+def dump(docsearch, version=0):
+    index_bytes = faiss.serialize_index(docsearch.index)
+    ids = [docsearch.index_to_docstore_id[i]
+           for i in range(docsearch.index.ntotal)]
+    docs = [docsearch.docstore.search(doc_id) for doc_id in ids]
+    texts = [doc.page_content.encode('utf-8') for doc in docs]
+    meta = json.dumps({'ids': ids, 'metadatas': [
+                      doc.metadata for doc in docs]}).encode('utf-8')
+    docstore = b''.join([struct.pack('<I', len(texts)),
+                         np.asarray([len(t) for t in texts], dtype=np.uint32).tobytes(),
+                         b''.join(texts),
+                         struct.pack('<I', len(meta)), meta])
+    return b''.join([MAGIC, HEADER.pack(version, index_bytes.nbytes, len(docstore)),
+                     index_bytes.tobytes(), docstore])
+
+
+def load(content, embeddings):
+    # reads straight from the buffer (bytes from the db, or a memory-mapped file), nothing is unpickled
+    view = memoryview(content)
+    _, index_size, _ = HEADER.unpack_from(view, len(MAGIC))
+    offset = HEADER_SIZE
+    index = faiss.deserialize_index(np.frombuffer(
+        view, dtype=np.uint8, count=index_size, offset=offset))
+    offset += index_size
+
+    count = struct.unpack_from('<I', view, offset)[0]
+    offset += 4
+    lengths = np.frombuffer(view, dtype=np.uint32,
+                            count=count, offset=offset).tolist()
+    offset += 4 * count
+    texts = []
+    for length in lengths:
+        texts.append(str(view[offset:offset + length], 'utf-8'))
+        offset += length
+
+    meta_size = struct.unpack_from('<I', view, offset)[0]
+    offset += 4
+    meta = json.loads(str(view[offset:offset + meta_size], 'utf-8'))
+
+    docstore = InMemoryDocstore({doc_id: Document(page_content=text, metadata=metadata)
+                                 for doc_id, text, metadata in zip(meta['ids'], texts, meta['metadatas'])})
+    return FAISS(embeddings, index, docstore, dict(enumerate(meta['ids'])))
+
+
+def encode_delta(texts, metadatas, vectors):
+    header = json.dumps({'texts': texts, 'metadatas': metadatas}).encode('utf-8')
+    return struct.pack('<I', len(header)) + header + np.asarray(vectors, dtype=np.float32).tobytes()
+
+
+def decode_delta(content):
+    size = struct.unpack_from('<I', content)[0]
+    header = json.loads(bytes(content[4:4 + size]).decode('utf-8'))
+    vectors = np.frombuffer(content, dtype=np.float32, offset=4 + size)
+    vectors = vectors.reshape(len(header['texts']), -1) if len(header['texts']) > 0 else vectors
+    return header['texts'], header['metadatas'], vectors
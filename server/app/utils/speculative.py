@@ -0,0 +1,127 @@
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .autocomplete import CUSTOM_TEMPLATE, generate_suggestions
+from .completion_cache import completion_cache
+from .embeddings import select_embeddings
+from .indexes import select_index
+from .prompt import build_table_info
+from .prefix import normalize, prefix_index_for
+from .retrieval import lexical_documents, retrieval_cache, retrieve_documents
+from .tokens import TokenRateLimiter, count_tokens
+from .validation import rank_candidates
+
+logger = logging.getLogger(__name__)
+
+# off by default, 'retrieval' precomputes the retrieval of the likely next queries, 'llm' their completions too
+SPECULATIVE_MODE = os.environ.get('SPECULATIVE_MODE', '')
+CANDIDATES = int(os.environ.get('SPECULATIVE_CANDIDATES', 3))
+MAX_PENDING = int(os.environ.get('SPECULATIVE_MAX_PENDING', 16))
+TOKENS_PER_MINUTE = int(os.environ.get('SPECULATIVE_TOKENS_PER_MINUTE', 20000))
+OUTPUT_TOKENS = int(os.environ.get('SPECULATIVE_OUTPUT_TOKENS', 100))
+
+# low priority: a single thread, and work is dropped rather than queued when it falls behind
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('SPECULATIVE_WORKERS', 1)))
+_pending = 0
+_pending_lock = threading.Lock()
+
+_budgets = {}
+_budgets_lock = threading.Lock()
+
+TABLE_KEYWORDS = {'from', 'join', 'into', 'update', 'table'}
+
+
+def tenant_budget(tenant):
+    with _budgets_lock:
+        budget = _budgets.get(tenant)
+        if budget is None:
+            budget = _budgets[tenant] = TokenRateLimiter(TOKENS_PER_MINUTE)
+        return budget
+
+
+def continuations(query, docsearch, docs):
+    # the table names and stored query prefixes that most likely follow the typed text
+    typed = normalize(query)
+    candidates = []
+
+    tables = []
+    for doc in docs or []:
+        table = doc.metadata.get('table')
+        if doc.metadata.get('type') == 'schema' and table and table not in tables:
+            tables.append(table)
+    words = re.findall(r'[\w.]+', typed)
+    if words and words[-1] in TABLE_KEYWORDS:
+        candidates += ['{} {}'.format(typed, table.lower()) for table in tables]
+    elif len(words) > 1 and words[-2] in TABLE_KEYWORDS:
+        partial = words[-1]
+        head = typed[:len(typed) - len(partial)]
+        candidates += [head + table.lower() for table in tables
+                       if table.lower().startswith(partial) and table.lower() != partial]
+
+    # next word of the stored queries starting with the typed text
+    prefix_index = prefix_index_for(select_index(), docsearch)
+    for stored in prefix_index.complete(query, 0, CANDIDATES * 4):
+        rest = normalize(stored)[len(typed):]
+        match = re.match(r'\s*\S+', rest)
+        if match:
+            candidates.append(typed + match.group(0))
+
+    unique = []
+    for candidate in candidates:
+        if candidate != typed and candidate not in unique:
+            unique.append(candidate)
+    return unique[:CANDIDATES]
+
+
+def schedule_prefetch(query, docsearch, dialect, tenant, version):
+    global _pending
+    if SPECULATIVE_MODE not in ('retrieval', 'llm') or tenant is None or version is None:
+        return
+    with _pending_lock:
+        if _pending >= MAX_PENDING:
+            return
+        _pending += 1
+    _executor.submit(prefetch, query, docsearch, dialect, tenant, version)
+
+
+def prefetch(query, docsearch, dialect, tenant, version):
+    global _pending
+    try:
+        retrieved = retrieval_cache.get((tenant, version, normalize(query)))
+        for candidate in continuations(query, docsearch, retrieved[1] if retrieved else []):
+            prefetch_candidate(candidate, docsearch, dialect, tenant, version)
+    except Exception as e:
+        logger.exception(e)
+    finally:
+        with _pending_lock:
+            _pending -= 1
+
+
+def prefetch_candidate(candidate, docsearch, dialect, tenant, version):
+    retrieval_key = (tenant, version, candidate)
+    retrieved = retrieval_cache.get(retrieval_key)
+    if retrieved is None:
+        embedding = None
+        docs = lexical_documents(docsearch, candidate)
+        if docs is None:
+            embedding = select_embeddings().embed_query(candidate)
+            docs = retrieve_documents(docsearch, candidate, embedding)
+        retrieval_cache.put(retrieval_key, embedding, docs)
+    else:
+        embedding, docs = retrieved
+    if SPECULATIVE_MODE != 'llm':
+        return
+
+    key = ('autocomplete', tenant, version, dialect, candidate, None)
+    if completion_cache.get(key) is not None:
+        return
+    # spending is capped per tenant, past it only the retrieval is prefetched
+    prompt = CUSTOM_TEMPLATE.format(query=candidate, table_info=build_table_info(docs), dialect=dialect)
+    if not tenant_budget(tenant).try_acquire(count_tokens(prompt) + OUTPUT_TOKENS):
+        return
+    queries = rank_candidates(generate_suggestions(candidate, docs, dialect), docsearch, dialect)
+    if queries and any(queries):
+        completion_cache.put(key, queries, embedding)
@@ -0,0 +1,62 @@
+import logging
+import threading
+import time
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+_encoding = None
+_encoding_failed = False
+
+
+def count_tokens(text):
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed:
+        try:
+            _encoding = tiktoken.get_encoding('cl100k_base')
+        except Exception as e:
+            # the encoding is downloaded on first use, without network it is only tried once
+            logger.warning('Token encoding not available, estimating token counts: %s', e)
+            _encoding_failed = True
+    if _encoding is None:
+        # rough estimate when the encoding is not available
+        return len(text) // 4 + 1
+    return len(_encoding.encode(text))
+
+
+class TokenRateLimiter:
+    # token bucket refilled continuously up to the per-minute limit, 0 disables it
+    def __init__(self, tokens_per_minute):
+        self.capacity = tokens_per_minute
+        self.tokens = tokens_per_minute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens +
+                          (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def acquire(self, tokens):
+        if self.capacity <= 0:
+            return
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) * 60 / self.capacity
+            time.sleep(wait)
+
+    def try_acquire(self, tokens):
+        if self.capacity <= 0:
+            return True
+        with self._lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
@@ -0,0 +1,239 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from sqlalchemy import create_engine, text
+from .indexes import select_index
+from .lexical import IDENTIFIER, KEYWORDS, TABLE_REFERENCE, referenced_tables
+from .metrics import span
+from .prompt import CONSTRAINTS, CREATE_TABLE, split_columns
+
+logger = logging.getLogger(__name__)
+
+# candidates are checked against the schema of the index, and optionally planned with EXPLAIN on the user database
+VALIDATE_WITH_EXPLAIN = os.environ.get('VALIDATE_WITH_EXPLAIN', 'False') != 'False'
+VALIDATION_TIMEOUT = float(os.environ.get('VALIDATION_TIMEOUT_MS', 500)) / 1000
+EXPLAIN_POOL_SIZE = int(os.environ.get('EXPLAIN_POOL_SIZE', 2))
+EXPLAIN_MAX_ENGINES = int(os.environ.get('EXPLAIN_MAX_ENGINES', 32))
+EXPLAIN_DIALECTS = {'postgresql', 'mysql'}
+# statements EXPLAIN only plans, never EXPLAIN ANALYZE or anything else
+EXPLAIN_STATEMENTS = {'select', 'with', 'insert', 'update', 'delete'}
+
+# shared by all the requests, candidates taking too long are ranked as not validated
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('VALIDATION_WORKERS', 8)))
+
+# symbol table of the schema documents, one per loaded index
+_symbols = weakref.WeakKeyDictionary()
+_symbols_lock = threading.Lock()
+
+# pooled engines of the user databases, the least recently used ones are disposed
+_engines = OrderedDict()
+_engines_lock = threading.Lock()
+
+# words that are neither tables nor columns, on top of the ones the lexical index ignores
+SQL_WORDS = {
+    'ilike', 'returning', 'interval', 'current_date', 'current_time', 'current_timestamp', 'nulls', 'first', 'last',
+    'over', 'partition', 'rows', 'range', 'fetch', 'next', 'only', 'top', 'any', 'some', 'natural', 'using', 'year',
+    'month', 'day', 'hour', 'minute', 'second', 'similar', 'to', 'escape', 'filter', 'within', 'lateral', 'recursive',
+    'except', 'intersect', 'do', 'nothing', 'conflict', 'excluded', 'if', 'ignore', 'replace', 'duplicate',
+}
+
+# names the query defines itself: common table expressions with their columns, subquery and bare column aliases
+CTE = re.compile(r'(?:\bwith(?:\s+recursive)?|,)\s*["`\[]?(\w+)["`\]]?\s*(?:\(([^()]*)\))?\s*as\s*\(', re.IGNORECASE)
+PARENTHESIS_ALIAS = re.compile(r'\)\s*(?:as\s+)?["`\[]?(\w+)', re.IGNORECASE)
+SELECT_LIST = re.compile(r'\bselect\s+(.+?)\s+from\b', re.IGNORECASE | re.DOTALL)
+
+
+def strip_name(name):
+    return re.sub(r'["`\[\]]', '', name).split('.')[-1].lower()
+
+
+class SymbolTable:
+    # tables of the schema and their columns, None when only the table name is known
+    def __init__(self, documents):
+        self.tables = {}
+        for doc in documents:
+            table = doc.metadata.get('table')
+            columns = None
+            match = CREATE_TABLE.search(re.sub(r'\s+', ' ', doc.page_content))
+            if match is not None:
+                table = table or match.group(1)
+                columns = set()
+                for column in split_columns(match.group(2)):
+                    words = column.split()
+                    if words[0].lower() not in CONSTRAINTS:
+                        columns.add(strip_name(words[0]))
+            if table:
+                self.tables[strip_name(table)] = columns
+
+    def check(self, query):
+        # tables the schema doesn't have, and identifiers that are none of the columns of the tables used
+        ctes = cte_names(query)
+        tables = [table for table in referenced_tables(query) if table not in ctes]
+        unknown_tables = [table for table in tables if table not in self.tables]
+        unknown_columns = []
+        if len(tables) == 0 or len(unknown_tables) > 0 or any(self.tables[table] is None for table in tables):
+            return unknown_tables, unknown_columns
+
+        columns = set()
+        for table in tables:
+            columns |= self.tables[table]
+        query = re.sub(r"'(?:[^']|'')*'", ' ', query)
+        names = aliases(query)
+        for match in IDENTIFIER.finditer(query):
+            word = match.group(0).lower()
+            if word in KEYWORDS or word in SQL_WORDS or word in self.tables or word in columns or word in names:
+                continue
+            # function calls
+            if query[match.end():].lstrip().startswith('('):
+                continue
+            if word not in unknown_columns:
+                unknown_columns.append(word)
+        return unknown_tables, unknown_columns
+
+    def __len__(self):
+        return len(self.tables)
+
+
+def cte_names(query):
+    return set(match.group(1).lower() for match in CTE.finditer(query))
+
+
+def aliases(query):
+    names = set(word.lower() for word in re.findall(r'\bas\s+["`\[]?(\w+)', query, re.IGNORECASE))
+    for match in CTE.finditer(query):
+        names.add(match.group(1).lower())
+        names |= set(strip_name(column) for column in (match.group(2) or '').split(',') if column.strip())
+    # (select ...) t, count(*) n
+    names |= set(word.lower() for word in PARENTHESIS_ALIAS.findall(query)
+                 if word.lower() not in KEYWORDS and word.lower() not in SQL_WORDS)
+    # select name n, price * 2 total
+    for match in SELECT_LIST.finditer(query):
+        for item in match.group(1).split(','):
+            words = item.split()
+            if len(words) > 1 and IDENTIFIER.fullmatch(words[-1]) and words[-1].lower() not in KEYWORDS \
+                    and re.search(r'[\w)"`\]\']$', words[-2]) \
+                    and (words[-2].lower() == 'end' or words[-2].lower() not in KEYWORDS | SQL_WORDS):
+                names.add(words[-1].lower())
+    for match in TABLE_REFERENCE.finditer(query):
+        for reference in match.group(1).split(','):
+            words = [word for word in reference.split() if word.lower() != 'as']
+            if len(words) > 1:
+                names.add(strip_name(words[1]))
+    return names
+
+
+def symbol_table_for(index_engine, docsearch):
+    with _symbols_lock:
+        symbols = _symbols.get(docsearch)
+    if symbols is None:
+        symbols = SymbolTable([doc for doc in index_engine.documents(docsearch).values()
+                               if doc.metadata.get('type') == 'schema'])
+        with _symbols_lock:
+            symbols = _symbols.setdefault(docsearch, symbols)
+    return symbols
+
+
+def explain_engine(conn_str):
+    key = hashlib.sha256(conn_str.encode('utf-8')).hexdigest()
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is not None:
+            _engines.move_to_end(key)
+            return engine
+    engine = create_engine(conn_str, pool_size=EXPLAIN_POOL_SIZE, max_overflow=0,
+                           pool_timeout=VALIDATION_TIMEOUT, pool_pre_ping=True)
+    with _engines_lock:
+        existing = _engines.get(key)
+        if existing is not None:
+            engine.dispose()
+            return existing
+        _engines[key] = engine
+        while len(_engines) > EXPLAIN_MAX_ENGINES:
+            _, old_engine = _engines.popitem(last=False)
+            old_engine.dispose()
+    return engine
+
+
+def explainable(query):
+    # a single statement of the kinds EXPLAIN only plans
+    query = query.strip().rstrip(';')
+    first = re.match(r'\s*(\w+)', query)
+    if first is None or first.group(1).lower() not in EXPLAIN_STATEMENTS:
+        return False
+    return ';' not in re.sub(r"'(?:[^']|'')*'", ' ', query)
+
+
+def explain(conn_str, dialect, query):
+    # True when the database can plan the query, False when it can't, None when it could not be asked
+    if dialect not in EXPLAIN_DIALECTS or not explainable(query):
+        return None
+    try:
+        conn = explain_engine(conn_str).connect()
+    except Exception as e:
+        logger.warning("Could not connect to explain queries: {}".format(e))
+        return None
+    with conn:
+        transaction = conn.begin()
+        try:
+            try:
+                if dialect == 'postgresql':
+                    conn.execute(text("SET TRANSACTION READ ONLY"))
+                    conn.execute(text("SET LOCAL statement_timeout = {}".format(int(VALIDATION_TIMEOUT * 1000))))
+                else:
+                    conn.execute(text("SET SESSION max_execution_time = {}".format(int(VALIDATION_TIMEOUT * 1000))))
+                    conn.execute(text("START TRANSACTION READ ONLY"))
+            except Exception as e:
+                logger.warning("Could not start a read only transaction to explain queries: {}".format(e))
+                return None
+            # only planned, never run, in a read only transaction that is rolled back anyway
+            conn.execute(text('EXPLAIN ' + query.strip().rstrip(';')))
+            return True
+        except Exception as e:
+            logger.info("Error while explaining query: " + str(e))
+            return False
+        finally:
+            transaction.rollback()
+
+
+def validate(query, symbols, dialect, conn_str):
+    unknown_tables, unknown_columns = symbols.check(query)
+    explained = None
+    if conn_str and len(unknown_tables) == 0:
+        explained = explain(conn_str, dialect, query)
+    return unknown_tables, unknown_columns, explained
+
+
+def rank_candidates(queries, docsearch, dialect, conn_str=None, timeout=None):
+    # valid candidates first, the ones the database could plan and with the fewest unknown identifiers ahead,
+    # then in the order the llm gave them; the invalid ones are dropped as long as any candidate is valid
+    if not queries or len(queries) == 0:
+        return queries
+    symbols = symbol_table_for(select_index(), docsearch)
+    if len(symbols) == 0 and not (VALIDATE_WITH_EXPLAIN and conn_str):
+        return queries
+    conn_str = conn_str if VALIDATE_WITH_EXPLAIN else None
+
+    with span('validate'):
+        futures = [_executor.submit(validate, query, symbols, dialect, conn_str) for query in queries]
+        wait(futures, timeout=min(VALIDATION_TIMEOUT, timeout) if timeout is not None else VALIDATION_TIMEOUT)
+
+    ranked = []
+    for i, (query, future) in enumerate(zip(queries, futures)):
+        unknown_tables, unknown_columns, explained = [], [], None
+        if future.done() and future.exception() is None:
+            unknown_tables, unknown_columns, explained = future.result()
+        else:
+            future.cancel()
+        # unknown columns only rank a candidate lower, they can be names the check doesn't follow
+        valid = len(unknown_tables) == 0 and explained is not False
+        ranked.append((not valid, explained is not True, len(unknown_columns), i, query))
+    ranked.sort()
+    if not ranked[0][0]:
+        ranked = [candidate for candidate in ranked if not candidate[0]]
+    return [candidate[-1] for candidate in ranked]
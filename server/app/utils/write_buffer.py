@@ -0,0 +1,133 @@
+import atexit
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .indexes import WRITE_ATTEMPTS, IndexConflict
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBuffer:
+    # groups added documents per tenant, and persists them once a size or time threshold is reached
+    def __init__(self, max_size, max_delay):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._pending = {}
+        self._timers = {}
+        # tenants with a flush running, the next one waits for it so they don't overwrite each other
+        self._flushing = set()
+        self._closing = False
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._executor = ThreadPoolExecutor(
+            max_workers=int(os.environ.get('ADD_BUFFER_WORKERS', 2)))
+
+    def add(self, name, db, index_engine, embeddings, texts, metadatas, callback=None, errback=None):
+        # the optional callback runs once the documents are persisted, the errback if they could not be
+        with self._lock:
+            entry = self._pending.setdefault(
+                name, {'db': db, 'index_engine': index_engine, 'embeddings': embeddings, 'documents': {},
+                       'callbacks': [], 'errbacks': []})
+            for text, metadata in zip(texts, metadatas):
+                # repeated texts in the same batch are only indexed once
+                entry['documents'].setdefault(text, metadata)
+            if callback is not None:
+                entry['callbacks'].append(callback)
+            if errback is not None:
+                entry['errbacks'].append(errback)
+
+            if len(entry['documents']) >= self.max_size:
+                self._submit(name)
+            elif name not in self._timers:
+                timer = threading.Timer(self.max_delay, self._expire, args=(name,))
+                timer.daemon = True
+                self._timers[name] = timer
+                timer.start()
+
+    def flush_all(self):
+        with self._lock:
+            self._closing = True
+            while len(self._flushing) > 0:
+                self._idle.wait()
+            entries = [(name, self._take(name)) for name in list(self._pending.keys())]
+        for name, entry in entries:
+            self._flush(name, entry)
+
+    def drain(self):
+        # persists everything added so far and waits for it, the buffer keeps accepting documents
+        with self._lock:
+            while not self._closing and (len(self._pending) > 0 or len(self._flushing) > 0):
+                for name in list(self._pending.keys()):
+                    self._submit(name)
+                self._idle.wait()
+
+    def _expire(self, name):
+        with self._lock:
+            self._timers.pop(name, None)
+            if name in self._pending:
+                self._submit(name)
+
+    def _submit(self, name):
+        if self._closing or name in self._flushing:
+            return
+        self._flushing.add(name)
+        self._executor.submit(self._run, name, self._take(name))
+
+    def _run(self, name, entry):
+        try:
+            self._flush(name, entry)
+        finally:
+            with self._lock:
+                self._flushing.discard(name)
+                self._idle.notify_all()
+                # what was added meanwhile, unless its timer is still running
+                entry = self._pending.get(name)
+                if entry is not None and (len(entry['documents']) >= self.max_size or name not in self._timers):
+                    self._submit(name)
+
+    def _take(self, name):
+        timer = self._timers.pop(name, None)
+        if timer is not None:
+            timer.cancel()
+        return self._pending.pop(name)
+
+    def _flush(self, name, entry):
+        index_engine = entry['index_engine']
+        texts = list(entry['documents'].keys())
+        metadatas = list(entry['documents'].values())
+        try:
+            for attempt in range(WRITE_ATTEMPTS):
+                docsearch = index_engine.read_index(
+                    entry['db'], entry['embeddings'], use_cache=False, name=name)
+                if docsearch is None:
+                    logger.info("Cannot add {} documents without docsearch base {}".format(
+                        len(texts), name))
+                    self._notify(entry['errbacks'])
+                    return
+                try:
+                    index_engine.add_texts(
+                        entry['db'], docsearch, entry['embeddings'], texts, metadatas, name=name)
+                    break
+                except IndexConflict:
+                    # written by someone else meanwhile, added again to the newer index
+                    if attempt == WRITE_ATTEMPTS - 1:
+                        raise
+            logger.info("Added {} documents to index {}".format(len(texts), name))
+        except Exception as e:
+            logger.exception(e)
+            self._notify(entry['errbacks'])
+            return
+        self._notify(entry['callbacks'])
+
+    def _notify(self, callbacks):
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.exception(e)
+
+
+write_buffer = WriteBuffer(int(os.environ.get('ADD_BUFFER_SIZE', 20)),
+                           float(os.environ.get('ADD_BUFFER_SECONDS', 2)))
+atexit.register(write_buffer.flush_all)
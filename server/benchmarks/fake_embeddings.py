@@ -0,0 +1,32 @@
+import hashlib
+import re
+import time
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+
+class FakeEmbeddings(Embeddings):
+    # deterministic hashed bag of words, close texts get close vectors without any model or network
+    def __init__(self, dimension=384, latency=0.0):
+        self.dimension = dimension
+        self.latency = latency
+
+    def embed_documents(self, texts):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return self._embed(text)
+
+    def _embed(self, text):
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for token in re.findall(r'\w+', text.lower()):
+            digest = int(hashlib.md5(token.encode('utf-8')).hexdigest()[:8], 16)
+            vector[digest % self.dimension] += 1.0 if digest & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector.tolist()
@@ -0,0 +1,243 @@
+import argparse
+import json
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .schemas import FIXTURE_DIALECTS, columns, synthetic_schema
+from .stub_llm import start_stub_llm
+
+# offline end to end benchmark: the flask app with fake embeddings, a stub llm server and local index files
+# usage, from the server folder: python -m benchmarks.run --tables 1000,10000 --concurrency 1,8,32
+
+ENDPOINTS = ['discover', 'autocomplete', 'repair', 'add']
+
+
+class StageTimer:
+    # time spent in each stage, attributed to the endpoint being benchmarked
+    def __init__(self):
+        self.phase = None
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self.stages.setdefault(self.phase, {}).setdefault(stage, []).append(seconds)
+
+    def wrap(self, stage, fn):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        return timed
+
+    def reset(self, phase):
+        with self._lock:
+            self.phase = phase
+            self.stages.pop(phase, None)
+
+    def summary(self, phase):
+        with self._lock:
+            stages = dict(self.stages.get(phase, {}))
+        return {stage: {'calls': len(times), 'total_ms': round(sum(times) * 1000, 2),
+                        'mean_ms': round(sum(times) * 1000 / len(times), 3)}
+                for stage, times in stages.items()}
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    # nearest rank
+    return values[max(0, math.ceil(p / 100.0 * len(values)) - 1)]
+
+
+def setup_environment(args, llm_host, index_folder):
+    # everything must be set before the app modules read it at import time
+    os.environ['INDEX_ENGINE'] = 'FAISS'
+    os.environ['INDEX_FOLDER'] = index_folder
+    os.environ['INDEX_COLD_FOLDER'] = os.path.join(index_folder, 'cold')
+    os.environ.pop('USE_DATABASE', None)
+    os.environ.pop('GET_SAMPLE_QUERIES', None)
+    os.environ.setdefault('POSTGRES_USER', 'benchmark')
+    os.environ.setdefault('POSTGRES_PASSWORD', 'benchmark')
+    os.environ.setdefault('POSTGRES_DB', 'benchmark')
+    os.environ['AUTOCOMPLETE_METHOD'] = 'selfhosted'
+    os.environ['REPAIR_METHOD'] = 'selfhosted'
+    os.environ['QUERIES_METHOD'] = 'selfhosted'
+    os.environ['LLM_HOST'] = llm_host
+    # jobs on a thread of this process, where the fake embeddings are
+    os.environ['DISCOVER_WORKERS'] = '0'
+    os.environ.setdefault('TOTAL_AUTOCOMPLETE_TIME', str(args.deadline))
+    os.environ.setdefault('TOTAL_REPAIR_TIME', str(args.deadline))
+    if not args.cache:
+        os.environ['COMPLETION_CACHE_SIZE'] = '0'
+        os.environ['RETRIEVAL_CACHE_SIZE'] = '0'
+
+
+def create_benchmark_app(args, timer):
+    from .fake_embeddings import FakeEmbeddings
+    from app import utils
+    from app.utils import discover, embeddings, autocomplete, repair, retrieval, llm_client
+    from app.utils.indexes import FaissEngine
+
+    # no metadata database: the indexes are local files
+    utils.init_db = lambda: None
+    embeddings._embeddings = FakeEmbeddings(args.dimension, args.embedding_latency)
+
+    for cls, stage, method in [(FaissEngine, 'index_load', 'read_index'), (FaissEngine, 'index_write', 'write_index'),
+                               (FaissEngine, 'index_add', 'add_texts'), (FakeEmbeddings, 'embedding', 'embed_query'),
+                               (FakeEmbeddings, 'embedding', 'embed_documents'), (llm_client.LLMClient, 'llm', 'complete_candidates')]:
+        setattr(cls, method, timer.wrap(stage, getattr(cls, method)))
+    retrieval.vector_documents = timer.wrap('vector_search', retrieval.vector_documents)
+    for module in (autocomplete, repair):
+        module.lexical_documents = timer.wrap('lexical_search', module.lexical_documents)
+        module.build_table_info = timer.wrap('prompt', module.build_table_info)
+
+    discover.sync_schema_documents = timer.wrap('schema_sync', discover.sync_schema_documents)
+
+    from app import create_app
+    app = create_app()
+    app.config['TESTING'] = True
+    return app
+
+
+def request_bodies(endpoint, tables, dialect, count, rng):
+    names = list(tables.keys())
+    bodies = []
+    for i in range(count):
+        table = rng.choice(names)
+        column = rng.choice(columns(tables[table]))
+        if endpoint == 'discover':
+            # a database of its own for every request
+            bodies.append({'conn_str': 'benchmark-discover-{}-{}'.format(i, rng.random()), 'dialect': dialect,
+                           'schema': {name: {} for name in names}, 'tables_info': tables})
+        elif endpoint == 'autocomplete':
+            query = rng.choice(['SELECT {} FROM {} WHERE ', 'SELECT {} FROM ', 'SELECT * FROM {1} WHERE {0} = '])
+            bodies.append({'conn_str': 'benchmark', 'dialect': dialect, 'query': query.format(column, table)})
+        elif endpoint == 'repair':
+            bodies.append({'conn_str': 'benchmark', 'dialect': dialect,
+                           'query': 'SELECT {} FROM {} WHERE;'.format(column, table),
+                           'error_message': 'syntax error at or near ";"'})
+        else:
+            bodies.append({'conn_str': 'benchmark', 'dialect': dialect,
+                           'queries': ['SELECT {} FROM {} WHERE {} IS NOT NULL LIMIT {};'.format(
+                               column, table, column, rng.randint(1, 1000))]})
+    return bodies
+
+
+def discover_and_wait(client, body):
+    # the latency of a discover is the time until its job is done
+    response = client.post('/discover', json=body)
+    if response.status_code != 202:
+        return response
+    job_id = response.json['job']['id']
+    while True:
+        response = client.post('/discover/' + job_id, json={'conn_str': body['conn_str']})
+        if response.status_code != 200 or response.json['status'] not in ('queued', 'running'):
+            return response
+        time.sleep(0.01)
+
+
+def run_phase(app, endpoint, bodies, concurrency):
+    clients = threading.local()
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def call(body):
+        if not hasattr(clients, 'client'):
+            clients.client = app.test_client()
+        start = time.perf_counter()
+        if endpoint == 'discover':
+            response = discover_and_wait(clients.client, body)
+        else:
+            response = clients.client.post('/' + endpoint, json=body)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if response.status_code >= 400 or (response.is_json and response.json.get('status') == 'failed'):
+                errors.append(response.status_code)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(call, bodies))
+    if endpoint == 'add':
+        # /add answers once queued, the phase ends when its queries are in the index
+        from app.utils.write_buffer import write_buffer
+        write_buffer.drain()
+    wall = time.perf_counter() - start
+    return {
+        'requests': len(bodies), 'errors': len(errors), 'concurrency': concurrency,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'throughput_rps': round(len(bodies) / wall, 2) if wall > 0 else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the sqlpal server')
+    parser.add_argument('--fixture', default='test_schema_pg.sql', choices=sorted(FIXTURE_DIALECTS.keys()))
+    parser.add_argument('--tables', default='100,10000', help='comma separated schema sizes')
+    parser.add_argument('--concurrency', default='1,8,32', help='comma separated concurrency levels')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS))
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint and concurrency level')
+    parser.add_argument('--discover-requests', type=int, default=4)
+    parser.add_argument('--llm-latency', type=float, default=0.2, help='seconds the stub llm takes to answer')
+    parser.add_argument('--llm-jitter', type=float, default=0.05)
+    parser.add_argument('--embedding-latency', type=float, default=0.0)
+    parser.add_argument('--dimension', type=int, default=384)
+    parser.add_argument('--deadline', type=float, default=10)
+    parser.add_argument('--cache', action='store_true', help='keep the completion and retrieval caches on')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results as json to this file')
+    args = parser.parse_args()
+
+    server, llm_host = start_stub_llm(args.llm_latency, args.llm_jitter)
+    index_folder = tempfile.mkdtemp(prefix='sqlpal-benchmark-')
+    setup_environment(args, llm_host, index_folder)
+    timer = StageTimer()
+    app = create_benchmark_app(args, timer)
+    dialect = FIXTURE_DIALECTS[args.fixture]
+    endpoints = [endpoint for endpoint in args.endpoints.split(',') if endpoint in ENDPOINTS]
+
+    results = []
+    for size in [int(size) for size in args.tables.split(',')]:
+        tables = synthetic_schema(args.fixture, size)
+        rng = random.Random(args.seed)
+
+        # the database autocomplete, repair and add work on
+        timer.reset('setup')
+        start = time.perf_counter()
+        response = discover_and_wait(app.test_client(), {
+            'conn_str': 'benchmark', 'dialect': dialect,
+            'schema': {name: {} for name in tables}, 'tables_info': tables})
+        print('Discovered {} tables in {:.2f}s ({})'.format(size, time.perf_counter() - start, response.status_code))
+
+        for endpoint in endpoints:
+            for concurrency in [int(level) for level in args.concurrency.split(',')]:
+                count = args.discover_requests if endpoint == 'discover' else args.requests
+                bodies = request_bodies(endpoint, tables, dialect, count, rng)
+                timer.reset(endpoint)
+                result = run_phase(app, endpoint, bodies, concurrency)
+                result.update({'endpoint': endpoint, 'tables': size, 'stages': timer.summary(endpoint)})
+                results.append(result)
+                print('{endpoint:>12} tables={tables:<6} c={concurrency:<3} p50={p50_ms}ms p95={p95_ms}ms '
+                      'p99={p99_ms}ms {throughput_rps} req/s errors={errors}'.format(**result))
+                for stage, summary in sorted(result['stages'].items()):
+                    print('{:>16} {:<14} calls={:<6} mean={}ms'.format('', stage, summary['calls'], summary['mean_ms']))
+
+    server.shutdown()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'llm_requests': server.requests, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
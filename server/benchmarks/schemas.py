@@ -0,0 +1,51 @@
+import os
+import re
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fixtures')
+FIXTURE_DIALECTS = {
+    'test_schema_pg.sql': 'postgresql',
+    'test_schema_mysql.sql': 'mysql',
+    'test_schema_mssql.sql': 'mssql',
+}
+CREATE_TABLE = re.compile(r'create\s+table\s+(?:if\s+not\s+exists\s+)?([\w."`\[\]]+)\s*\(', re.IGNORECASE)
+
+
+def fixture_tables(filename):
+    # {table: create statement} of a fixture, the body found by matching parentheses
+    with open(os.path.join(FIXTURES, filename), encoding='utf-8', errors='replace') as f:
+        sql = f.read()
+    tables = {}
+    for match in CREATE_TABLE.finditer(sql):
+        depth = 0
+        for end in range(match.end() - 1, len(sql)):
+            if sql[end] == '(':
+                depth += 1
+            elif sql[end] == ')':
+                depth -= 1
+                if depth == 0:
+                    break
+        name = re.sub(r'["`\[\]]', '', match.group(1)).split('.')[-1]
+        tables[name] = sql[match.start():end + 1]
+    return tables
+
+
+def synthetic_schema(filename, count):
+    # the fixture tables cloned with numbered names until there are count of them
+    base = fixture_tables(filename)
+    names = sorted(base.keys())
+    tables = {}
+    for i in range(count):
+        name = names[i % len(names)]
+        clone = name if i < len(names) else '{}_{}'.format(name, i // len(names))
+        tables[clone] = re.sub(r'\b{}\b'.format(re.escape(name)), clone, base[name], count=1)
+    return tables
+
+
+def columns(statement):
+    body = statement[statement.index('(') + 1:statement.rindex(')')]
+    names = []
+    for line in body.split(','):
+        words = line.strip().split()
+        if words and words[0].lower() not in ('primary', 'foreign', 'constraint', 'unique', 'key', 'index', 'check'):
+            names.append(re.sub(r'["`\[\]]', '', words[0]))
+    return [name for name in names if re.match(r'^\w+$', name)] or ['*']
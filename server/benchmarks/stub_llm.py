@@ -0,0 +1,47 @@
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    # answers like the self-hosted text generation api, after a configurable delay
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        latency = self.server.latency
+        if self.server.jitter > 0:
+            latency += random.uniform(0, self.server.jitter)
+        time.sleep(latency)
+
+        prompt = request.get('prompt', '')
+        tables = re.findall(r'^(\w+)\(', prompt, re.MULTILINE) or ['dual']
+        if ';' in (request.get('stopping_strings') or []):
+            text = 'SELECT * FROM {};'.format(tables[0])
+        else:
+            # sample queries are asked for as a json list
+            text = json.dumps(['SELECT * FROM {};'.format(table) for table in tables[:5]])
+
+        body = json.dumps({'results': [{'text': text}]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.requests += 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_llm(latency=0.2, jitter=0.0):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubLLMHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.jitter = jitter
+    server.requests = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}/api/v1/generate'.format(server.server_address[1])
@@ -0,0 +1,35 @@
+import os
+import shutil
+
+# async serving mode: gevent workers, every blocking call to the llm, the embeddings or the databases yields
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', 8088))
+workers = int(os.environ.get('SERVER_WORKERS', 2))
+worker_class = 'gevent'
+worker_connections = int(os.environ.get('SERVER_WORKER_CONNECTIONS', 500))
+timeout = int(os.environ.get('SERVER_TIMEOUT', 120))
+graceful_timeout = 30
+accesslog = '-'
+errorlog = '-'
+
+
+def on_starting(server):
+    # the metrics of every worker are merged from this folder, samples of a previous run must not be
+    folder = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if folder:
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder, exist_ok=True)
+
+
+def post_fork(server, worker):
+    # psycopg2 waits on the gevent hub instead of blocking the whole worker
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+    # only the first workers started resume the pending background work
+    os.environ['SERVER_WORKER_AGE'] = str(worker.age)
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,61 @@
+import os
+import tempfile
+import uuid
+import pytest
+
+# read by the app modules at import time, before any test imports them
+os.environ.setdefault('INDEX_FOLDER', tempfile.mkdtemp(prefix='sqlpal-tests-'))
+os.environ.setdefault('INDEX_COLD_FOLDER', os.path.join(os.environ['INDEX_FOLDER'], 'cold'))
+os.environ.pop('USE_DATABASE', None)
+
+
+@pytest.fixture
+def index_folder(tmp_path, monkeypatch):
+    monkeypatch.setenv('INDEX_FOLDER', str(tmp_path))
+    monkeypatch.setenv('INDEX_COLD_FOLDER', str(tmp_path / 'cold'))
+    return tmp_path
+
+
+@pytest.fixture
+def tenant():
+    # the loaded indexes are cached per process by tenant name
+    return uuid.uuid4().hex
+
+
+@pytest.fixture
+def embeddings():
+    from benchmarks.fake_embeddings import FakeEmbeddings
+    return FakeEmbeddings(32)
+
+
+@pytest.fixture
+def database(monkeypatch):
+    # the metadata database of docker-compose, the tests needing it are skipped without it
+    from app.utils import get_db_conn_str, init_db
+    if get_db_conn_str() is None:
+        pytest.skip('POSTGRES_USER, POSTGRES_PASSWORD and POSTGRES_DB are not set')
+    try:
+        db = init_db()
+    except Exception as e:
+        pytest.skip('No metadata database: {}'.format(e))
+    monkeypatch.setenv('USE_DATABASE', 'True')
+    return db
+
+
+@pytest.fixture
+def app(index_folder, embeddings, monkeypatch):
+    # the server without a metadata database, on local index files and the fake embeddings
+    from app import create_app, utils
+    from app.utils import embeddings as embeddings_module
+    for key in ('POSTGRES_USER', 'POSTGRES_PASSWORD', 'POSTGRES_DB'):
+        monkeypatch.setenv(key, 'test')
+    monkeypatch.setattr(utils, 'init_db', lambda: None)
+    monkeypatch.setattr(embeddings_module, '_embeddings', embeddings)
+    app = create_app()
+    app.config['TESTING'] = True
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
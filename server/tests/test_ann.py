@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+from langchain.vectorstores import FAISS
+from app.utils import ann
+
+
+@pytest.mark.parametrize('kind', ann.INDEX_TYPES)
+def test_remove_documents_keeps_positions(kind, embeddings):
+    texts = ['SELECT * FROM t{};'.format(i) for i in range(400)]
+    docsearch = FAISS.from_texts(texts, embeddings)
+    docsearch.index = ann.build_index(kind, ann.reconstruct_vectors(docsearch.index), docsearch.index.metric_type)
+    removed = [docsearch.index_to_docstore_id[i] for i in range(0, 200, 2)]
+
+    docsearch = ann.remove_documents(docsearch, removed)
+
+    assert docsearch.index.ntotal == 300
+    assert sorted(docsearch.index_to_docstore_id.keys()) == list(range(300))
+    vectors = ann.reconstruct_vectors(docsearch.index)
+    for position, doc_id in docsearch.index_to_docstore_id.items():
+        # every vector is still the one of the document it is mapped to
+        text = docsearch.docstore.search(doc_id).page_content
+        assert np.allclose(vectors[position], embeddings.embed_query(text), atol=1e-5)
+
+
+def test_remove_documents_then_search(embeddings):
+    texts = ['SELECT * FROM t{};'.format(i) for i in range(400)]
+    docsearch = FAISS.from_texts(texts, embeddings)
+    docsearch.index = ann.build_index('ivf', ann.reconstruct_vectors(docsearch.index), docsearch.index.metric_type)
+    docsearch = ann.remove_documents(docsearch, [docsearch.index_to_docstore_id[i] for i in range(100)])
+
+    vector = embeddings.embed_query('SELECT * FROM t250;')
+    found = docsearch.similarity_search_by_vector(vector, k=1)
+
+    # the fake embeddings can give two texts the same vector, the one found must have it
+    assert np.allclose(embeddings.embed_query(found[0].page_content), vector)
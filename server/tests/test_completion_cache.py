@@ -0,0 +1,82 @@
+import time
+from langchain.vectorstores import FAISS
+from app.utils import autocomplete
+from app.utils import embeddings as embeddings_module
+from app.utils.completion_cache import CompletionCache
+from app.utils.retrieval import RetrievalCache
+
+
+def key(query, version=1, tenant='tenant', dialect='postgresql'):
+    return ('autocomplete', tenant, version, dialect, query, None)
+
+
+def test_hit_and_least_recently_used_eviction():
+    cache = CompletionCache(2, 60, 0)
+    cache.put(key('select a'), ['SELECT a FROM t;'])
+    cache.put(key('select b'), ['SELECT b FROM t;'])
+    cache.get(key('select a'))
+    cache.put(key('select c'), ['SELECT c FROM t;'])
+
+    assert cache.get(key('select a')) == ['SELECT a FROM t;']
+    assert cache.get(key('select b')) is None
+    assert cache.stats() == {'entries': 2, 'hits': 2, 'similar_hits': 0, 'misses': 1}
+
+
+def test_entries_expire():
+    cache = CompletionCache(10, 0.05, 0)
+    cache.put(key('select a'), ['SELECT a FROM t;'])
+    time.sleep(0.1)
+
+    assert cache.get(key('select a')) is None
+
+
+def test_new_index_version_drops_the_tenant_entries():
+    cache = CompletionCache(10, 60, 0)
+    cache.put(key('select a'), ['SELECT a FROM t;'])
+    cache.put(key('select a', tenant='other'), ['SELECT a FROM t;'])
+    cache.put(key('select b', version=2), ['SELECT b FROM t;'])
+
+    assert cache.stats()['entries'] == 2
+    assert cache.get(key('select b', version=2)) == ['SELECT b FROM t;']
+    assert cache.get(key('select a', tenant='other')) == ['SELECT a FROM t;']
+
+
+def test_similar_hint(embeddings):
+    cache = CompletionCache(10, 60, 0.9)
+    cache.put(key('select a from t where'), ['SELECT a FROM t WHERE a > 1;'],
+              embeddings.embed_query('select a from t where'))
+    embedding = embeddings.embed_query('SELECT a FROM t WHERE')
+
+    assert cache.get_similar(key('SELECT a FROM t WHERE'), embedding) == ['SELECT a FROM t WHERE a > 1;']
+    assert cache.get_similar(key('SELECT a FROM t WHERE', dialect='mysql'), embedding) is None
+    assert cache.get_similar(key('update t set'), embeddings.embed_query('update t set')) is None
+
+
+def test_retrieval_cache_eviction():
+    cache = RetrievalCache(1)
+    cache.put(('tenant', 1, 'select a'), None, ['a'])
+    cache.put(('tenant', 1, 'select b'), None, ['b'])
+
+    assert ('tenant', 1, 'select a') not in cache
+    assert cache.get(('tenant', 1, 'select b')) == (None, ['b'])
+
+
+def test_repeated_hint_skips_the_llm(embeddings, monkeypatch):
+    calls = []
+
+    def generate_suggestions(query, docs, dialect, timeout=None, cancelled=None):
+        calls.append(query)
+        return ['SELECT id FROM users;']
+
+    monkeypatch.setattr(autocomplete, 'generate_suggestions', generate_suggestions)
+    monkeypatch.setattr(autocomplete, 'completion_cache', CompletionCache(10, 60, 0.97))
+    monkeypatch.setattr(autocomplete, 'retrieval_cache', RetrievalCache(10))
+    monkeypatch.setattr(embeddings_module, '_embeddings', embeddings)
+    docsearch = FAISS.from_texts(['CREATE TABLE users (id int);'], embeddings, [{'type': 'schema', 'table': 'users'}])
+
+    first = autocomplete.autocomplete_query_suggestions('SELECT id', docsearch, 'postgresql', 'tenant', 1)
+    second = autocomplete.autocomplete_query_suggestions('select  id', docsearch, 'postgresql', 'tenant', 1)
+    third = autocomplete.autocomplete_query_suggestions('SELECT id', docsearch, 'postgresql', 'tenant', 2)
+
+    assert first == second == third == ['SELECT id FROM users;']
+    assert calls == ['SELECT id', 'SELECT id']
@@ -0,0 +1,66 @@
+import threading
+import time
+import pytest
+from langchain.vectorstores import FAISS
+from app.utils import autocomplete
+from app.utils import embeddings as embeddings_module
+from app.utils.completion_cache import CompletionCache
+from app.utils.deadline import Deadline, DeadlineExceeded, run_stage
+from app.utils.retrieval import RetrievalCache
+from app.utils.sequencing import RequestSuperseded
+
+
+def test_stage_within_its_budget():
+    deadline = Deadline(1)
+
+    assert deadline.run(0.5, lambda x: x + 1, 1) == 2
+
+
+def test_stage_bounded_by_its_share():
+    deadline = Deadline(1)
+    start = time.monotonic()
+
+    with pytest.raises(DeadlineExceeded):
+        deadline.run(0.1, time.sleep, 1)
+
+    assert time.monotonic() - start < 0.5
+
+
+def test_spent_deadline_runs_nothing():
+    deadline = Deadline(0)
+    calls = []
+
+    with pytest.raises(DeadlineExceeded):
+        deadline.run(None, calls.append, 1)
+    assert calls == []
+
+
+def test_cancelled_stage_stops_at_once():
+    cancelled = threading.Event()
+    deadline = Deadline(5, cancelled)
+    threading.Timer(0.1, cancelled.set).start()
+    start = time.monotonic()
+
+    with pytest.raises(RequestSuperseded):
+        deadline.run(None, time.sleep, 2)
+
+    assert time.monotonic() - start < 1
+
+
+def test_without_deadline_the_stage_runs_inline():
+    assert run_stage(None, 0.1, threading.current_thread) is threading.current_thread()
+
+
+def test_slow_llm_falls_back_to_the_closest_stored_query(embeddings, monkeypatch):
+    monkeypatch.setattr(autocomplete, 'generate_suggestions', lambda *args: time.sleep(2))
+    monkeypatch.setattr(autocomplete, 'completion_cache', CompletionCache(10, 60, 0))
+    monkeypatch.setattr(autocomplete, 'retrieval_cache', RetrievalCache(10))
+    monkeypatch.setattr(embeddings_module, '_embeddings', embeddings)
+    docsearch = FAISS.from_texts(['SELECT name FROM users WHERE id = 1;'], embeddings, [{'type': 'query'}])
+    start = time.monotonic()
+
+    queries = autocomplete.autocomplete_query_suggestions(
+        'SELECT id FROM users', docsearch, 'postgresql', 'tenant', 1, Deadline(0.5))
+
+    assert time.monotonic() - start < 1.5
+    assert queries == ['SELECT name FROM users WHERE id = 1;']
@@ -0,0 +1,78 @@
+from benchmarks.fake_embeddings import FakeEmbeddings
+from app.utils.discover import sync_schema_documents
+from app.utils.indexes import FaissEngine
+
+
+class CountingEmbeddings(FakeEmbeddings):
+    def __init__(self, dimension=32):
+        super().__init__(dimension)
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        return super().embed_documents(texts)
+
+
+def contents(index_engine, docsearch):
+    return sorted((doc.metadata.get('type'), doc.metadata.get('table') or '', doc.page_content)
+                  for doc in index_engine.documents(docsearch).values())
+
+
+def test_first_sync_adds_every_table():
+    index_engine = FaissEngine()
+    tables_info = {'a': 'CREATE TABLE a (id int);', 'b': 'CREATE TABLE b (id int);'}
+
+    docsearch, counts, changed, removed = sync_schema_documents(
+        index_engine, None, tables_info, FakeEmbeddings(32))
+
+    assert counts == {'added': 2, 'updated': 0, 'removed': 0, 'unchanged': 0}
+    assert (sorted(changed), removed) == (['a', 'b'], [])
+    assert contents(index_engine, docsearch) == [
+        ('schema', 'a', 'CREATE TABLE a (id int);'), ('schema', 'b', 'CREATE TABLE b (id int);')]
+
+
+def test_sync_only_embeds_the_changed_tables():
+    index_engine = FaissEngine()
+    embeddings = CountingEmbeddings()
+    docsearch, _, _, _ = sync_schema_documents(index_engine, None, {
+        'a': 'CREATE TABLE a (id int);', 'b': 'CREATE TABLE b (id int);', 'c': 'CREATE TABLE c (id int);'}, embeddings)
+    docsearch.add_texts(['SELECT id FROM a;', 'SELECT id FROM b;', 'SELECT id FROM c;', 'SELECT 1;'], [
+        {'type': 'query', 'source': 'sample', 'table': 'a'}, {'type': 'query', 'source': 'sample', 'table': 'b'},
+        {'type': 'query', 'source': 'sample', 'table': 'c'}, {'type': 'query'}])
+    embeddings.calls = []
+
+    docsearch, counts, changed, removed = sync_schema_documents(index_engine, docsearch, {
+        'a': 'CREATE TABLE a (id int);', 'b': 'CREATE TABLE b (id bigint);', 'd': 'CREATE TABLE d (id int);'},
+        embeddings)
+
+    assert counts == {'added': 1, 'updated': 1, 'removed': 1, 'unchanged': 1}
+    assert (sorted(changed), removed) == (['b', 'd'], ['c'])
+    assert embeddings.calls == [['CREATE TABLE b (id bigint);', 'CREATE TABLE d (id int);']]
+    # the stored queries are kept, the sample queries of the updated and removed tables are dropped
+    assert contents(index_engine, docsearch) == [
+        ('query', '', 'SELECT 1;'), ('query', 'a', 'SELECT id FROM a;'),
+        ('schema', 'a', 'CREATE TABLE a (id int);'), ('schema', 'b', 'CREATE TABLE b (id bigint);'),
+        ('schema', 'd', 'CREATE TABLE d (id int);')]
+
+
+def test_unchanged_schema_embeds_nothing():
+    index_engine = FaissEngine()
+    embeddings = CountingEmbeddings()
+    tables_info = {'a': 'CREATE TABLE a (id int);'}
+    docsearch, _, _, _ = sync_schema_documents(index_engine, None, tables_info, embeddings)
+    embeddings.calls = []
+
+    docsearch, counts, changed, removed = sync_schema_documents(index_engine, docsearch, tables_info, embeddings)
+
+    assert counts == {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 1}
+    assert (changed, removed, embeddings.calls) == ([], [], [])
+
+
+def test_progress_after_every_batch():
+    progress = []
+    tables_info = {'t{}'.format(i): 'CREATE TABLE t{} (id int);'.format(i) for i in range(5)}
+
+    sync_schema_documents(FaissEngine(), None, tables_info, FakeEmbeddings(32), batch_size=2,
+                          progress=lambda embedded, total: progress.append((embedded, total)))
+
+    assert progress == [(0, 5), (2, 5), (4, 5), (5, 5)]
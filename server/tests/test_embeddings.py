@@ -0,0 +1,78 @@
+import uuid
+import numpy as np
+from benchmarks.fake_embeddings import FakeEmbeddings
+from app.utils import embeddings as embeddings_module
+from app.utils.embeddings import CachedEmbeddings, RemoteEmbeddings
+
+
+class CountingEmbeddings(FakeEmbeddings):
+    def __init__(self, dimension=32):
+        super().__init__(dimension)
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        return super().embed_documents(texts)
+
+
+class MemoryCachedEmbeddings(CachedEmbeddings):
+    # the same cache, kept in a dict instead of the metadata database
+    def __init__(self, embeddings, model, stored=None):
+        super().__init__(embeddings, model)
+        self.stored = stored if stored is not None else {}
+
+    def _lookup(self, hashes):
+        return {text_hash: self.stored[text_hash] for text_hash in hashes if text_hash in self.stored}
+
+    def _store(self, vectors):
+        self.stored.update(vectors)
+
+
+def test_misses_are_embedded_once_in_one_batch():
+    counting = CountingEmbeddings()
+    cached = MemoryCachedEmbeddings(counting, 'fake')
+    cached.embed_documents(['SELECT 1;'])
+
+    vectors = cached.embed_documents(['SELECT 1;', 'SELECT 2;', 'SELECT 3;', 'SELECT 2;'])
+
+    assert counting.calls == [['SELECT 1;'], ['SELECT 2;', 'SELECT 3;']]
+    assert np.allclose(vectors, FakeEmbeddings(32).embed_documents(['SELECT 1;', 'SELECT 2;', 'SELECT 3;', 'SELECT 2;']))
+    assert (cached.hits, cached.misses) == (2, 3)
+
+
+def test_unavailable_cache_embeds_everything():
+    counting = CountingEmbeddings()
+
+    class Unavailable(CachedEmbeddings):
+        def _lookup(self, hashes):
+            raise Exception('no database')
+
+        def _store(self, vectors):
+            raise Exception('no database')
+
+    vectors = Unavailable(counting, 'fake').embed_documents(['SELECT 1;', 'SELECT 2;'])
+
+    assert counting.calls == [['SELECT 1;', 'SELECT 2;']]
+    assert len(vectors) == 2
+
+
+def test_cache_round_trip_in_database(database):
+    model = 'test:' + uuid.uuid4().hex
+    CachedEmbeddings(CountingEmbeddings(), model).embed_documents(['SELECT 1;', 'SELECT 2;'])
+    counting = CountingEmbeddings()
+
+    vectors = CachedEmbeddings(counting, model).embed_documents(['SELECT 2;', 'SELECT 1;'])
+
+    assert counting.calls == []
+    assert np.allclose(vectors, FakeEmbeddings(32).embed_documents(['SELECT 2;', 'SELECT 1;']), atol=1e-6)
+
+
+def test_remote_embeddings_are_cached_by_the_worker(monkeypatch):
+    monkeypatch.setenv('EMBEDDING_METHOD', 'remote')
+    monkeypatch.setenv('USE_DATABASE', 'True')
+    monkeypatch.delenv('EMBEDDING_SERVER', raising=False)
+    monkeypatch.setattr(embeddings_module, '_embeddings', None)
+
+    embeddings = embeddings_module.select_embeddings()
+
+    assert isinstance(embeddings.embeddings, RemoteEmbeddings)
@@ -0,0 +1,60 @@
+import pytest
+from app.utils.indexes import FaissEngine, IndexConflict
+
+
+def texts_of(index_engine, docsearch):
+    return set(doc.page_content for doc in index_engine.documents(docsearch).values())
+
+
+def test_file_write_over_newer_index_conflicts(index_folder, tenant, embeddings):
+    index_engine = FaissEngine()
+    index_engine.write_index(None, index_engine.read_index_contents(
+        ['SELECT 1;'], embeddings, [{'type': 'query'}]), tenant)
+    first = index_engine.read_index(None, embeddings, use_cache=False, name=tenant)
+    second = index_engine.read_index(None, embeddings, use_cache=False, name=tenant)
+
+    index_engine.add_texts(None, first, embeddings, ['SELECT 2;'], [{'type': 'query'}], name=tenant)
+    with pytest.raises(IndexConflict):
+        index_engine.add_texts(None, second, embeddings, ['SELECT 3;'], [{'type': 'query'}], name=tenant)
+
+    # started over from the newer one
+    second = index_engine.read_index(None, embeddings, use_cache=False, name=tenant)
+    index_engine.add_texts(None, second, embeddings, ['SELECT 3;'], [{'type': 'query'}], name=tenant)
+    docsearch = index_engine.read_index(None, embeddings, use_cache=False, name=tenant)
+    assert texts_of(index_engine, docsearch) == {'SELECT 1;', 'SELECT 2;', 'SELECT 3;'}
+
+
+def test_write_catches_up_with_deltas(database, index_folder, tenant, embeddings):
+    index_engine = FaissEngine()
+    index_engine.write_index(database, index_engine.read_index_contents(
+        ['SELECT 1;'], embeddings, [{'type': 'query'}]), tenant)
+    writer = index_engine.read_index(database, embeddings, use_cache=False, name=tenant)
+    adder = index_engine.read_index(database, embeddings, use_cache=False, name=tenant)
+
+    index_engine.add_texts(database, adder, embeddings, ['SELECT 2;'], [{'type': 'query'}], name=tenant)
+    writer.add_texts(['SELECT 3;'], [{'type': 'query'}])
+    index_engine.write_index(database, writer, tenant)
+
+    docsearch = index_engine.read_index(database, embeddings, use_cache=False, name=tenant)
+    assert texts_of(index_engine, docsearch) == {'SELECT 1;', 'SELECT 2;', 'SELECT 3;'}
+
+
+def test_write_after_compaction_starts_over(database, index_folder, tenant, embeddings):
+    index_engine = FaissEngine()
+    index_engine.write_index(database, index_engine.read_index_contents(
+        ['SELECT 1;'], embeddings, [{'type': 'query'}]), tenant)
+    writer = index_engine.read_index(database, embeddings, use_cache=False, name=tenant)
+    adder = index_engine.read_index(database, embeddings, use_cache=False, name=tenant)
+
+    index_engine.add_texts(database, adder, embeddings, ['SELECT 2;'], [{'type': 'query'}], name=tenant)
+    index_engine.compact(database, embeddings, tenant)
+    # the delta is folded into the snapshot, it can't be replayed on the writer's copy anymore
+    writer.add_texts(['SELECT 3;'], [{'type': 'query'}])
+    with pytest.raises(IndexConflict):
+        index_engine.write_index(database, writer, tenant)
+
+    writer = index_engine.read_index(database, embeddings, use_cache=False, name=tenant)
+    writer.add_texts(['SELECT 3;'], [{'type': 'query'}])
+    index_engine.write_index(database, writer, tenant)
+    docsearch = index_engine.read_index(database, embeddings, use_cache=False, name=tenant)
+    assert texts_of(index_engine, docsearch) == {'SELECT 1;', 'SELECT 2;', 'SELECT 3;'}
@@ -0,0 +1,138 @@
+import os
+import threading
+import time
+from app.utils import jobs, sample_queries
+from app.utils.indexes import FaissEngine
+from app.utils.write_buffer import WriteBuffer
+
+
+def test_one_active_job_per_tenant(index_folder, tenant):
+    store = jobs.job_store(None)
+    job = store.create(tenant, 3)
+
+    assert store.create(tenant, 3) is None
+    assert store.active(tenant)['id'] == job['id']
+    assert store.create(tenant + 'other', 1) is not None
+
+    store.update(job['id'], status='done')
+
+    assert store.active(tenant) is None
+    assert store.create(tenant, 3) is not None
+
+
+def test_stale_job_no_longer_blocks_its_tenant(index_folder, tenant, monkeypatch):
+    store = jobs.job_store(None)
+    job = store.create(tenant, 3)
+    monkeypatch.setattr(jobs, 'DISCOVER_JOB_TIMEOUT', -1)
+
+    assert store.create(tenant, 3) is not None
+    assert store.get(job['id'])['status'] == 'failed'
+
+
+def test_increment_several_fields(index_folder, tenant):
+    store = jobs.job_store(None)
+    job = store.create(tenant, 3)
+
+    store.increment(job['id'], sample_tables_done=1, queries_generated=4)
+    store.increment(job['id'], sample_tables_done=1, queries_generated=2)
+
+    job = store.get(job['id'])
+    assert (job['sample_tables_done'], job['queries_generated']) == (2, 6)
+
+
+def test_finished_jobs_expire(index_folder, tenant, monkeypatch):
+    store = jobs.job_store(None)
+    finished = store.create(tenant, 3)
+    store.update(finished['id'], status='done')
+    running = store.create(tenant, 3)
+    old = time.time() - 10
+    for job in (finished, running):
+        os.utime(store._path(job['id']), (old, old))
+    monkeypatch.setattr(jobs, 'DISCOVER_JOB_TTL', 5)
+
+    store.create(tenant + 'other', 1)
+
+    assert store.get(finished['id']) is None
+    assert store.get(running['id']) is not None
+
+
+def test_job_slots_bound_the_running_jobs(index_folder, monkeypatch):
+    monkeypatch.setattr(jobs, 'DISCOVER_WORKERS', 2)
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def job():
+        with jobs.job_slot():
+            with lock:
+                running.append(True)
+                peak.append(len(running))
+            time.sleep(0.2)
+            with lock:
+                running.pop()
+
+    threads = [threading.Thread(target=job) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(peak) == 4
+    assert max(peak) == 2
+
+
+def test_sample_queries_progress(index_folder, tenant, embeddings, monkeypatch):
+    index_engine = FaissEngine()
+    index_engine.write_index(None, index_engine.read_index_contents(
+        ['CREATE TABLE a (id int);'], embeddings, [{'type': 'schema', 'table': 'a'}]), tenant)
+    docsearch = index_engine.read_index(None, embeddings, use_cache=False, name=tenant)
+    generated = {'CREATE TABLE a (id int);': ['SELECT id FROM a;', 'SELECT * FROM a;'], 'CREATE TABLE b (id int);': []}
+
+    def generate_queries_for_schema(info, schema_dict, dialect):
+        if info not in generated:
+            raise Exception('LLM unavailable')
+        return generated[info]
+
+    monkeypatch.setattr(sample_queries, 'generate_queries_for_schema', generate_queries_for_schema)
+    monkeypatch.setattr(sample_queries, 'write_buffer', WriteBuffer(1, 0.05))
+    store = jobs.job_store(None)
+    job = store.create(tenant, 3)
+    tables_info = {'a': 'CREATE TABLE a (id int);', 'b': 'CREATE TABLE b (id int);', 'c': 'CREATE TABLE c (id int);'}
+
+    scheduled = sample_queries.schedule_sample_queries(
+        None, index_engine, embeddings, docsearch, tenant, tables_info, 'postgresql', {},
+        lambda **counts: store.increment(job['id'], **counts))
+    for _ in range(100):
+        if store.get(job['id'])['sample_tables_done'] == 3:
+            break
+        time.sleep(0.05)
+
+    job = store.get(job['id'])
+    assert scheduled == 3
+    assert (job['sample_tables_total'], job['sample_tables_done'], job['queries_generated']) == (3, 3, 2)
+    docsearch = index_engine.read_index(None, embeddings, use_cache=False, name=tenant)
+    assert sample_queries.tables_with_sample_queries(index_engine, docsearch) == {'a'}
+
+
+class Executor:
+    def __init__(self):
+        self.stopped = False
+
+    def shutdown(self, wait=True):
+        self.stopped = True
+
+
+def test_idle_job_processes_are_stopped(monkeypatch):
+    monkeypatch.setattr(jobs, 'DISCOVER_WORKERS_IDLE', 0.05)
+    discover_jobs = jobs.DiscoverJobs(1)
+    executor = discover_jobs._executor = Executor()
+    discover_jobs._pending = 2
+
+    discover_jobs.release(executor)
+    time.sleep(0.2)
+    assert not executor.stopped
+
+    discover_jobs.release(executor)
+    time.sleep(0.2)
+    assert executor.stopped
+    assert discover_jobs._executor is None
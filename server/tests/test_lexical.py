@@ -0,0 +1,66 @@
+import pytest
+from langchain.docstore.document import Document
+from langchain.vectorstores import FAISS
+from app.utils import embeddings as embeddings_module
+from app.utils.lexical import LexicalIndex, reciprocal_rank_fusion, referenced_tables
+from app.utils.retrieval import lexical_documents
+
+
+def schema(table, info):
+    return Document(page_content=info, metadata={'type': 'schema', 'table': table})
+
+
+DOCS = [schema('users', 'CREATE TABLE users (id int, email text);'),
+        schema('orders', 'CREATE TABLE orders (id int, user_id int, total_amount numeric);'),
+        schema('order_items', 'CREATE TABLE order_items (order_id int, product_id int);'),
+        schema('products', 'CREATE TABLE products (id int, name text);')]
+
+
+@pytest.mark.parametrize('query, tables', [
+    ('SELECT * FROM users', ['users']),
+    ('SELECT * FROM public."Orders" o JOIN users u ON u.id = o.user_id', ['orders', 'users']),
+    ('SELECT * FROM users, products WHERE', ['users', 'products']),
+    ('UPDATE orders SET total_amount = 0', ['orders']),
+    ('INSERT INTO order_items (order_id) VALUES (1)', ['order_items']),
+    ('SELECT 1', []),
+])
+def test_referenced_tables(query, tables):
+    assert referenced_tables(query) == tables
+
+
+def test_bm25_ranks_the_tables_of_the_identifiers():
+    lexical_index = LexicalIndex(DOCS)
+
+    assert [doc.metadata['table'] for doc in lexical_index.search('SELECT total_amount', 2)] == ['orders']
+    assert lexical_index.search('SELECT invoice', 3) == []
+    assert lexical_index.search('SELECT product_id', 1)[0].metadata['table'] == 'order_items'
+
+
+def test_named_tables():
+    lexical_index = LexicalIndex(DOCS)
+
+    assert [doc.metadata['table'] for doc in lexical_index.tables(['orders', 'users'])] == ['orders', 'users']
+    assert lexical_index.tables(['orders', 'invoices']) is None
+
+
+def test_reciprocal_rank_fusion():
+    users, orders, products = DOCS[0], DOCS[1], DOCS[3]
+
+    merged = reciprocal_rank_fusion([[users, orders], [orders, products]], 3)
+
+    assert merged == [orders, users, products]
+
+
+def test_named_tables_skip_the_embedding(embeddings, monkeypatch):
+    class NoEmbeddings:
+        def embed_query(self, text):
+            raise AssertionError('embedded ' + text)
+
+    monkeypatch.setattr(embeddings_module, '_embeddings', NoEmbeddings())
+    docsearch = FAISS.from_texts([doc.page_content for doc in DOCS], embeddings, [doc.metadata for doc in DOCS])
+
+    docs = lexical_documents(docsearch, 'SELECT email FROM users u JOIN orders o ON')
+
+    assert [doc.metadata['table'] for doc in docs[:2]] == ['users', 'orders']
+    assert lexical_documents(docsearch, 'SELECT * FROM invoices') is None
+    assert lexical_documents(docsearch, 'SELECT email') is None
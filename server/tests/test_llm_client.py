@@ -0,0 +1,99 @@
+import threading
+import time
+import pytest
+import requests
+from benchmarks.stub_llm import StubLLMHandler, start_stub_llm
+from app.utils.llm_client import DEFAULT_PARAMS, LLMClient, LLMClientError, endpoint_params
+from app.utils.sequencing import RequestSuperseded
+
+
+@pytest.fixture
+def stub_llm():
+    server, host = start_stub_llm(latency=0)
+    yield server, host
+    server.shutdown()
+
+
+def client(host, retries=2, max_concurrency=4):
+    return LLMClient(host, '', '', 4, 1, 5, retries, 0.01, max_concurrency)
+
+
+def test_complete(stub_llm):
+    server, host = stub_llm
+
+    assert client(host).complete('users(id int)\nSELECT id', 'autocomplete', stopping_strings=[';']) == \
+        'SELECT * FROM users;'
+    assert server.requests == 1
+
+
+def test_retries_unavailable_backend(stub_llm, monkeypatch):
+    server, host = stub_llm
+    failures = [503, 502]
+    do_post = StubLLMHandler.do_POST
+
+    def flaky(handler):
+        if failures:
+            handler.send_response(failures.pop(0))
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+            return
+        do_post(handler)
+
+    monkeypatch.setattr(StubLLMHandler, 'do_POST', flaky)
+
+    assert client(host).complete('SELECT', 'autocomplete', stopping_strings=[';']) == 'SELECT * FROM dual;'
+    assert server.requests == 1
+
+
+def test_gives_up_after_the_retries(stub_llm, monkeypatch):
+    _, host = stub_llm
+    calls = []
+
+    def unavailable(handler):
+        calls.append(True)
+        handler.send_response(503)
+        handler.send_header('Content-Length', '0')
+        handler.end_headers()
+
+    monkeypatch.setattr(StubLLMHandler, 'do_POST', unavailable)
+
+    with pytest.raises(LLMClientError):
+        client(host, retries=1).complete('SELECT', 'autocomplete')
+    assert len(calls) == 2
+
+
+def test_timeout_bounds_the_call(stub_llm):
+    server, host = stub_llm
+    server.latency = 1
+    start = time.monotonic()
+
+    with pytest.raises((LLMClientError, requests.Timeout)):
+        client(host).complete('SELECT', 'autocomplete', timeout=0.3)
+
+    assert time.monotonic() - start < 0.9
+
+
+def test_concurrency_limit(stub_llm):
+    server, host = stub_llm
+    server.latency = 0.5
+    llm = client(host, max_concurrency=1)
+    first = threading.Thread(target=llm.complete, args=('SELECT', 'autocomplete'))
+    first.start()
+    time.sleep(0.1)
+
+    with pytest.raises(LLMClientError):
+        llm.complete('SELECT', 'autocomplete', timeout=0.2)
+    cancelled = threading.Event()
+    cancelled.set()
+    with pytest.raises(RequestSuperseded):
+        llm.complete('SELECT', 'autocomplete', cancelled=cancelled)
+    first.join()
+
+
+def test_endpoint_params(monkeypatch):
+    monkeypatch.setenv('LLM_REPAIR_PARAMS', '{"top_k": 5, "max_new_tokens": 100}')
+    monkeypatch.setenv('LLM_QUERIES_PARAMS', 'not json')
+
+    assert endpoint_params('repair')['top_k'] == 5
+    assert endpoint_params('repair')['max_new_tokens'] == 100
+    assert endpoint_params('queries')['top_k'] == DEFAULT_PARAMS['top_k']
@@ -0,0 +1,43 @@
+import pytest
+from prometheus_client import REGISTRY
+from app.utils.metrics import record_cache, span
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_span_observes_failed_stages():
+    before = sample('sqlpal_stage_seconds_count', stage='test_stage')
+
+    with span('test_stage'):
+        pass
+    with pytest.raises(ValueError):
+        with span('test_stage'):
+            raise ValueError()
+
+    assert sample('sqlpal_stage_seconds_count', stage='test_stage') == before + 2
+
+
+def test_cache_lookups():
+    before = sample('sqlpal_cache_lookups_total', cache='test', result='hit')
+
+    record_cache('test', True)
+    record_cache('test', False)
+
+    assert sample('sqlpal_cache_lookups_total', cache='test', result='hit') == before + 1
+    assert sample('sqlpal_cache_lookups_total', cache='test', result='miss') >= 1
+
+
+def test_metrics_route(client):
+    before = sample('sqlpal_request_seconds_count', route='/add')
+    client.post('/add', json={'conn_str': 'postgres://test', 'queries': 'SELECT 1;'})
+
+    response = client.get('/metrics')
+    content = response.get_data(as_text=True)
+
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain')
+    assert sample('sqlpal_request_seconds_count', route='/add') == before + 1
+    assert 'route="/metrics"' not in content
+    assert 'sqlpal_residency_tenants{tier="hot"}' in content
@@ -0,0 +1,38 @@
+from langchain.vectorstores import FAISS
+from app.utils.indexes import FaissEngine
+from app.utils.prefix import PrefixIndex, prefix_index_for
+
+
+def test_completions_ranked_by_closeness():
+    prefix_index = PrefixIndex()
+    prefix_index.add(['SELECT id, name FROM users WHERE id = 1;', 'SELECT id FROM users;', 'SELECT 1;',
+                      'select  id from USERS;'])
+
+    assert prefix_index.complete('select   ID', 0, 3) == [
+        'SELECT id FROM users;', 'SELECT id, name FROM users WHERE id = 1;']
+    assert len(prefix_index) == 3
+
+
+def test_min_ratio_and_limit():
+    prefix_index = PrefixIndex()
+    prefix_index.add(['SELECT a FROM t;', 'SELECT a FROM t WHERE a > 1 ORDER BY a;'])
+
+    assert prefix_index.complete('SELECT a', 0.6, 3) == ['SELECT a FROM t;']
+    assert prefix_index.complete('SELECT a', 0, 1) == ['SELECT a FROM t;']
+    assert prefix_index.complete('  ', 0, 3) == []
+    assert prefix_index.complete('UPDATE', 0, 3) == []
+
+
+def test_built_from_stored_queries_and_kept_up_to_date(index_folder, tenant, embeddings):
+    index_engine = FaissEngine()
+    docsearch = FAISS.from_texts(['SELECT id FROM users;', 'CREATE TABLE users (id int);'], embeddings,
+                                 [{'type': 'query'}, {'type': 'schema'}])
+    prefix_index = prefix_index_for(index_engine, docsearch)
+    assert prefix_index.complete('CREATE', 0, 3) == []
+    assert prefix_index.complete('SELECT', 0, 3) == ['SELECT id FROM users;']
+
+    index_engine.write_index(None, docsearch, tenant)
+    index_engine.add_texts(None, docsearch, embeddings, ['SELECT name FROM users;'], [{'type': 'query'}], tenant)
+
+    assert prefix_index_for(index_engine, docsearch) is prefix_index
+    assert prefix_index.complete('SELECT name', 0, 3) == ['SELECT name FROM users;']
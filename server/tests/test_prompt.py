@@ -0,0 +1,43 @@
+from langchain.docstore.document import Document
+from app.utils.prompt import build_table_info, render_schema
+from app.utils.tokens import count_tokens
+
+
+def schema(info):
+    return Document(page_content=info, metadata={'type': 'schema'})
+
+
+def test_render_create_table():
+    doc = schema('CREATE TABLE IF NOT EXISTS "public"."orders" (\n  "id" serial PRIMARY KEY,\n'
+                 '  total numeric(10, 2) NOT NULL,\n  user_id int REFERENCES users (id),\n'
+                 '  PRIMARY KEY (id),\n  CONSTRAINT orders_user FOREIGN KEY (user_id) REFERENCES users (id)\n);')
+
+    assert render_schema(doc) == 'public.orders(id serial, total numeric(10,2), user_id int)'
+
+
+def test_other_documents_are_collapsed():
+    assert render_schema(schema('users:\n  id  int\n  email text')) == 'users: id int email text'
+
+
+def test_type_arguments_are_kept():
+    assert render_schema(schema('CREATE TABLE t (name varchar (20), price decimal(8, 2) DEFAULT 0, id int)')) == \
+        't(name varchar(20), price decimal(8,2), id int)'
+
+
+def test_duplicates_and_example_queries():
+    docs = [schema('CREATE TABLE users (id int);'), schema('CREATE  TABLE users (id int);'),
+            Document(page_content='SELECT id\nFROM users;', metadata={'type': 'query'}),
+            schema('CREATE TABLE orders (id int);')]
+
+    assert build_table_info(docs) == 'users(id int)\norders(id int)\n\nExample queries:\nSELECT id FROM users;'
+
+
+def test_budget_filled_by_rank():
+    wide = 'CREATE TABLE wide ({});'.format(', '.join('column_{} int'.format(i) for i in range(50)))
+    docs = [schema('CREATE TABLE users (id int);'), schema(wide), schema('CREATE TABLE orders (id int);')]
+    budget = count_tokens('users(id int)') + count_tokens('orders(id int)') + 2
+
+    # the wide table doesn't fit, the next smaller one still does
+    assert build_table_info(docs, budget) == 'users(id int)\norders(id int)'
+    assert build_table_info(docs, count_tokens('users(id int)') + 1) == 'users(id int)'
+    assert build_table_info(docs, 0).count('\n') == 2
@@ -0,0 +1,66 @@
+import os
+import time
+import pytest
+from app.utils import residency as residency_module
+from app.utils.indexes import FaissEngine
+from app.utils.residency import Residency, cold_path, hot_path
+
+
+@pytest.fixture
+def tenants(index_folder, embeddings, monkeypatch):
+    # two indexes, the first one last used an hour ago
+    monkeypatch.setattr(residency_module, 'INDEX_MIN_RESIDENCY_SECONDS', 0)
+    index_engine = FaissEngine()
+    names = ['cold-tenant', 'hot-tenant']
+    for name in names:
+        index_engine.write_index(None, index_engine.read_index_contents(
+            ['CREATE TABLE {} (id int);'.format(name.replace('-', '_'))], embeddings, [{'type': 'schema'}]), name)
+    old = time.time() - 3600
+    os.utime(hot_path(names[0]), (old, old))
+    return index_engine, names
+
+
+def test_least_recently_used_is_demoted_past_the_budget(tenants):
+    _, (cold_tenant, hot_tenant) = tenants
+    residency = Residency(os.path.getsize(hot_path(hot_tenant)) + 1, 1024 * 1024)
+
+    residency.sweep()
+
+    assert not os.path.exists(hot_path(cold_tenant))
+    assert os.path.exists(cold_path(cold_tenant))
+    assert os.path.exists(hot_path(hot_tenant))
+    stats = residency.stats()
+    assert (stats['hot']['tenants'], stats['cold']['tenants'], stats['demotions']) == (1, 1, 1)
+
+
+def test_recently_used_tenants_stay(tenants, monkeypatch):
+    _, names = tenants
+    monkeypatch.setattr(residency_module, 'INDEX_MIN_RESIDENCY_SECONDS', 7200)
+
+    Residency(1, 1024 * 1024).sweep()
+
+    assert all(os.path.exists(hot_path(name)) for name in names)
+
+
+def test_idle_tenants_are_demoted_under_the_budget(tenants, monkeypatch):
+    _, (cold_tenant, hot_tenant) = tenants
+    monkeypatch.setattr(residency_module, 'INDEX_IDLE_SECONDS', 600)
+
+    Residency(1024 * 1024 * 1024, 1024 * 1024).sweep()
+
+    assert os.path.exists(cold_path(cold_tenant))
+    assert os.path.exists(hot_path(hot_tenant))
+
+
+def test_demoted_index_is_rehydrated_on_read(tenants, embeddings):
+    index_engine, (cold_tenant, hot_tenant) = tenants
+    version = index_engine.local_version(cold_tenant)
+    Residency(os.path.getsize(hot_path(hot_tenant)) + 1, 1024 * 1024).sweep()
+
+    docsearch = index_engine.read_index(None, embeddings, use_cache=False, name=cold_tenant)
+
+    assert [doc.page_content for doc in index_engine.documents(docsearch).values()] == [
+        'CREATE TABLE cold_tenant (id int);']
+    assert os.path.exists(hot_path(cold_tenant))
+    assert not os.path.exists(cold_path(cold_tenant))
+    assert index_engine.local_version(cold_tenant) == version
@@ -0,0 +1,92 @@
+import pytest
+from app import routes
+from app.utils import get_id_from_conn_str
+from app.utils.indexes import FaissEngine
+from app.utils.sequencing import RequestSequencer
+from app.utils.write_buffer import WriteBuffer
+
+
+@pytest.fixture
+def write_buffer(monkeypatch):
+    write_buffer = WriteBuffer(100, 60)
+    monkeypatch.setattr(routes, 'write_buffer', write_buffer)
+    return write_buffer
+
+
+@pytest.fixture
+def indexed(index_folder, embeddings):
+    # a discovered database to add the queries to
+    index_engine = FaissEngine()
+    name = get_id_from_conn_str('postgres://test')
+    index_engine.write_index(None, index_engine.read_index_contents(
+        ['CREATE TABLE users (id int);'], embeddings, [{'type': 'schema', 'table': 'users'}]), name)
+    return index_engine, name
+
+
+@pytest.mark.parametrize('body', [
+    {'queries': 'SELECT 1;'},
+    {'queries': {'query': 'SELECT 1;'}},
+    {'queries': ['SELECT 1;', 2]},
+    {'query': ['SELECT 1;']},
+])
+def test_add_rejects_malformed_queries(client, write_buffer, indexed, body):
+    body['conn_str'] = 'postgres://test'
+
+    response = client.post('/add', json=body)
+
+    assert response.status_code == 400
+    assert 'error' in response.json
+
+
+def test_add_queues_query_and_queries(client, write_buffer, indexed, embeddings):
+    index_engine, name = indexed
+
+    response = client.post('/add', json={'conn_str': 'postgres://test', 'query': 'SELECT id FROM users;',
+                                         'queries': ['SELECT * FROM users;', ' ']})
+    write_buffer.flush_all()
+
+    assert response.status_code == 202
+    assert response.json['queued'] == 2
+    docsearch = index_engine.read_index(None, embeddings, use_cache=False, name=name)
+    texts = set(doc.page_content for doc in index_engine.documents(docsearch).values())
+    assert {'SELECT id FROM users;', 'SELECT * FROM users;'} <= texts
+
+
+@pytest.fixture
+def stored_query(indexed, embeddings):
+    index_engine, name = indexed
+    docsearch = index_engine.read_index(None, embeddings, use_cache=False, name=name)
+    index_engine.add_texts(None, docsearch, embeddings, ['SELECT id FROM users;'], [{'type': 'query'}], name)
+    return indexed
+
+
+def stream_events(response):
+    return [block.split('\n')[0][len('event: '):] for block in response.get_data(as_text=True).split('\n\n') if block]
+
+
+def test_stream_of_a_late_request_is_superseded(client, stored_query, monkeypatch):
+    sequencer = RequestSequencer()
+    monkeypatch.setattr(routes, 'request_sequencer', sequencer)
+    _, name = stored_query
+    sequencer.start((name, 'editor'), 5)
+
+    response = client.post('/autocomplete/stream', json={'conn_str': 'postgres://test', 'query': 'SELECT id FR',
+                                                         'session_id': 'editor', 'sequence': 3})
+
+    assert stream_events(response) == ['suggestions', 'done']
+    assert '"superseded": true' in response.get_data(as_text=True)
+
+
+def test_requests_without_session_id_are_not_sequenced(client, stored_query, monkeypatch):
+    sequencer = RequestSequencer()
+    monkeypatch.setattr(routes, 'request_sequencer', sequencer)
+    _, name = stored_query
+    ticket = sequencer.start((name, None), 5)
+
+    response = client.post('/autocomplete/stream', json={'conn_str': 'postgres://test', 'query': 'SELECT id FR',
+                                                         'sequence': 3})
+
+    assert stream_events(response) == ['suggestions', 'done']
+    assert 'SELECT id FROM users;' in response.get_data(as_text=True)
+    assert not ticket.superseded()
+    assert sequencer.stats()['superseded'] == 0
@@ -0,0 +1,51 @@
+from app.utils.sequencing import RequestSequencer
+
+
+def test_newer_request_cancels_the_one_in_flight():
+    sequencer = RequestSequencer()
+    first = sequencer.start(('tenant', 'editor'))
+    second = sequencer.start(('tenant', 'editor'))
+
+    assert first.superseded()
+    assert not second.superseded()
+    assert sequencer.stats() == {'in_flight': 1, 'superseded': 1}
+
+
+def test_late_request_is_cancelled_at_once():
+    sequencer = RequestSequencer()
+    newer = sequencer.start(('tenant', 'editor'), 5)
+    older = sequencer.start(('tenant', 'editor'), 3)
+
+    assert older.superseded()
+    assert not newer.superseded()
+
+
+def test_sessions_do_not_cancel_each_other():
+    sequencer = RequestSequencer()
+    first = sequencer.start(('tenant', 'editor'))
+    sequencer.start(('tenant', 'other editor'))
+    sequencer.start(('other tenant', 'editor'))
+
+    assert not first.superseded()
+
+
+def test_requests_without_key_are_never_cancelled():
+    sequencer = RequestSequencer()
+    first = sequencer.start(None)
+    second = sequencer.start(None)
+
+    assert not first.superseded()
+    assert not second.superseded()
+    assert sequencer.stats() == {'in_flight': 0, 'superseded': 0}
+
+
+def test_finish_forgets_the_latest_request():
+    sequencer = RequestSequencer()
+    first = sequencer.start(('tenant', 'editor'))
+    sequencer.finish(first)
+    second = sequencer.start(('tenant', 'editor'))
+
+    assert not first.superseded()
+    assert not second.superseded()
+    sequencer.finish(second)
+    assert sequencer.stats()['in_flight'] == 0
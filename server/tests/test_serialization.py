@@ -0,0 +1,55 @@
+import numpy as np
+from langchain.vectorstores import FAISS
+from benchmarks.fake_embeddings import FakeEmbeddings
+from app.utils import serialization
+
+
+class CountingEmbeddings(FakeEmbeddings):
+    def __init__(self, dimension=32):
+        super().__init__(dimension)
+        self.documents_calls = []
+        self.query_calls = 0
+
+    def embed_documents(self, texts):
+        self.documents_calls.append(list(texts))
+        return super().embed_documents(texts)
+
+    def embed_query(self, text):
+        self.query_calls += 1
+        return super().embed_query(text)
+
+
+def test_dump_and_load(embeddings):
+    docsearch = FAISS.from_texts(['SELECT 1;', 'SELECT 2;'], embeddings, [{'type': 'query'}, {'type': 'schema'}])
+
+    content = serialization.dump(docsearch, 7)
+    loaded = serialization.load(content, embeddings)
+
+    assert serialization.read_version(content) == 7
+    assert loaded.index.ntotal == 2
+    assert np.allclose(loaded.index.reconstruct_n(0, 2), docsearch.index.reconstruct_n(0, 2))
+    assert [loaded.docstore.search(loaded.index_to_docstore_id[i]).metadata for i in range(2)] == [
+        {'type': 'query'}, {'type': 'schema'}]
+
+
+def test_loaded_index_embeds_added_texts_in_one_batch(embeddings):
+    docsearch = FAISS.from_texts(['SELECT 1;'], embeddings)
+    counting = CountingEmbeddings()
+    loaded = serialization.load(serialization.dump(docsearch), counting)
+
+    loaded.add_texts(['SELECT 2;', 'SELECT 3;', 'SELECT 4;'])
+
+    assert counting.documents_calls == [['SELECT 2;', 'SELECT 3;', 'SELECT 4;']]
+    assert counting.query_calls == 0
+
+
+def test_delta_round_trip(embeddings):
+    texts = ['SELECT 1;', 'SELECT 2;']
+    vectors = embeddings.embed_documents(texts)
+
+    decoded_texts, metadatas, decoded_vectors = serialization.decode_delta(
+        serialization.encode_delta(texts, [{'type': 'query'}] * 2, vectors))
+
+    assert decoded_texts == texts
+    assert metadatas == [{'type': 'query'}] * 2
+    assert np.allclose(decoded_vectors, vectors)
@@ -0,0 +1,84 @@
+import pytest
+from langchain.vectorstores import FAISS
+from app.utils import embeddings as embeddings_module
+from app.utils import speculative
+from app.utils.completion_cache import CompletionCache
+from app.utils.indexes import FaissEngine
+from app.utils.retrieval import RetrievalCache
+
+
+@pytest.fixture
+def docsearch(embeddings):
+    return FAISS.from_texts(
+        ['CREATE TABLE orders (id int, customer_id int);', 'CREATE TABLE order_items (order_id int);',
+         'CREATE TABLE customers (id int);', 'SELECT id FROM orders WHERE customer_id = 1;'],
+        embeddings, [{'type': 'schema', 'table': 'orders'}, {'type': 'schema', 'table': 'order_items'},
+                     {'type': 'schema', 'table': 'customers'}, {'type': 'query'}])
+
+
+@pytest.fixture
+def caches(monkeypatch, embeddings):
+    completion_cache = CompletionCache(100, 60, 0)
+    retrieval_cache = RetrievalCache(100)
+    monkeypatch.setattr(speculative, 'completion_cache', completion_cache)
+    monkeypatch.setattr(speculative, 'retrieval_cache', retrieval_cache)
+    monkeypatch.setattr(speculative, '_budgets', {})
+    monkeypatch.setattr(embeddings_module, '_embeddings', embeddings)
+    return completion_cache, retrieval_cache
+
+
+def schema_docs(docsearch):
+    return [doc for doc in FaissEngine().documents(docsearch).values() if doc.metadata['type'] == 'schema']
+
+
+def test_table_names_after_a_table_keyword(docsearch):
+    assert speculative.continuations('SELECT * FROM', docsearch, schema_docs(docsearch)) == [
+        'select * from orders', 'select * from order_items', 'select * from customers']
+
+
+def test_partial_table_name(docsearch):
+    assert speculative.continuations('SELECT * FROM ord', docsearch, schema_docs(docsearch)) == [
+        'select * from orders', 'select * from order_items']
+
+
+def test_next_word_of_stored_queries(docsearch):
+    assert speculative.continuations('SELECT id FROM orders', docsearch, []) == ['select id from orders where']
+
+
+def test_off_by_default(docsearch, caches, monkeypatch):
+    monkeypatch.setattr(speculative, 'SPECULATIVE_MODE', '')
+    speculative.schedule_prefetch('SELECT * FROM', docsearch, 'postgresql', 'tenant', 1)
+    speculative._executor.submit(lambda: None).result()
+
+    assert caches[1].stats()['entries'] == 0
+
+
+def test_prefetch_fills_the_caches(docsearch, caches, monkeypatch):
+    completion_cache, retrieval_cache = caches
+    monkeypatch.setattr(speculative, 'SPECULATIVE_MODE', 'llm')
+    monkeypatch.setattr(speculative, 'CANDIDATES', 2)
+    monkeypatch.setattr(speculative, 'generate_suggestions',
+                        lambda query, docs, dialect: [query.upper() + ' LIMIT 10;'])
+    retrieval_cache.put(('tenant', 1, 'select * from'), None, schema_docs(docsearch))
+
+    speculative.prefetch('SELECT * FROM', docsearch, 'postgresql', 'tenant', 1)
+
+    assert ('tenant', 1, 'select * from orders') in retrieval_cache
+    assert ('tenant', 1, 'select * from order_items') in retrieval_cache
+    assert completion_cache.get(('autocomplete', 'tenant', 1, 'postgresql', 'select * from orders', None)) == [
+        'SELECT * FROM ORDERS LIMIT 10;']
+
+
+def test_tenant_budget_caps_the_llm_calls(docsearch, caches, monkeypatch):
+    completion_cache, retrieval_cache = caches
+    calls = []
+    monkeypatch.setattr(speculative, 'SPECULATIVE_MODE', 'llm')
+    monkeypatch.setattr(speculative, 'TOKENS_PER_MINUTE', 1)
+    monkeypatch.setattr(speculative, 'generate_suggestions', lambda query, docs, dialect: calls.append(query))
+    retrieval_cache.put(('tenant', 1, 'select * from'), None, schema_docs(docsearch))
+
+    speculative.prefetch('SELECT * FROM', docsearch, 'postgresql', 'tenant', 1)
+
+    # past the budget, only the retrieval is prefetched
+    assert calls == []
+    assert ('tenant', 1, 'select * from orders') in retrieval_cache
@@ -0,0 +1,48 @@
+import pytest
+from langchain.docstore.document import Document
+from app.utils.validation import SymbolTable, explainable
+
+
+@pytest.fixture
+def symbols():
+    return SymbolTable([
+        Document(page_content='CREATE TABLE users (id int, name varchar(20), created_at timestamp);',
+                 metadata={'type': 'schema', 'table': 'users'}),
+        Document(page_content='CREATE TABLE orders (id int, user_id int, total numeric, PRIMARY KEY (id));',
+                 metadata={'type': 'schema', 'table': 'orders'}),
+    ])
+
+
+@pytest.mark.parametrize('query', [
+    'WITH recent AS (SELECT id, name FROM users) SELECT name FROM recent;',
+    'WITH recent(uid) AS (SELECT id FROM users), big AS (SELECT user_id FROM orders) '
+    'SELECT uid FROM recent JOIN big ON big.user_id = recent.uid;',
+    'WITH RECURSIVE ids AS (SELECT id FROM users) SELECT id FROM ids;',
+    'SELECT t.n FROM (SELECT count(*) n FROM users) t;',
+    'SELECT u.name, o.total FROM users u JOIN (SELECT user_id, sum(total) total FROM orders GROUP BY user_id) o '
+    'ON o.user_id = u.id;',
+    'SELECT name n, total * 2 doubled FROM users JOIN orders ON orders.user_id = users.id;',
+    'SELECT CASE WHEN total > 1 THEN 1 ELSE 0 END flag FROM orders;',
+])
+def test_names_defined_by_the_query(symbols, query):
+    assert symbols.check(query) == ([], [])
+
+
+def test_unknown_names(symbols):
+    assert symbols.check('SELECT * FROM userz;') == (['userz'], [])
+    assert symbols.check('SELECT DISTINCT nmae FROM users;') == ([], ['nmae'])
+    assert symbols.check('WITH recent AS (SELECT nmae FROM users) SELECT * FROM recent;') == ([], ['nmae'])
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('SELECT 1;', True),
+    ('with x as (select 1) select * from x', True),
+    ("SELECT ';' FROM users;", True),
+    ('DELETE FROM users WHERE id = 1;', True),
+    ('ANALYZE SELECT 1;', False),
+    ('EXPLAIN ANALYZE DELETE FROM users;', False),
+    ('SELECT 1; DROP TABLE users;', False),
+    ('DROP TABLE users;', False),
+])
+def test_explainable(query, expected):
+    assert explainable(query) == expected
@@ -0,0 +1,65 @@
+import time
+from benchmarks.fake_embeddings import FakeEmbeddings
+from app.utils.indexes import FaissEngine
+from app.utils.write_buffer import WriteBuffer
+
+
+class SlowEmbeddings(FakeEmbeddings):
+    # long enough for the next batch to be submitted while a flush is running
+    def embed_documents(self, texts):
+        time.sleep(0.1)
+        return super().embed_documents(texts)
+
+
+def test_concurrent_flushes_keep_every_document(index_folder, tenant, monkeypatch):
+    monkeypatch.setenv('ADD_BUFFER_WORKERS', '2')
+    embeddings = SlowEmbeddings(32)
+    index_engine = FaissEngine()
+    index_engine.write_index(None, index_engine.read_index_contents(
+        ['SELECT 1;'], embeddings, [{'type': 'query'}]), tenant)
+    write_buffer = WriteBuffer(2, 0.05)
+    persisted = []
+
+    for i in range(20):
+        write_buffer.add(tenant, None, index_engine, embeddings, ['SELECT {} FROM t;'.format(i)], [{'type': 'query'}],
+                         callback=lambda i=i: persisted.append(i))
+        time.sleep(0.005)
+    write_buffer.flush_all()
+
+    docsearch = index_engine.read_index(None, embeddings, use_cache=False, name=tenant)
+    texts = set(doc.page_content for doc in index_engine.documents(docsearch).values())
+    assert texts == set(['SELECT 1;'] + ['SELECT {} FROM t;'.format(i) for i in range(20)])
+    assert sorted(persisted) == list(range(20))
+
+
+def test_failed_flush_calls_errback(index_folder, tenant, embeddings):
+    # without a base index the documents can't be added
+    write_buffer = WriteBuffer(1, 0.05)
+    failed = []
+
+    write_buffer.add(tenant, None, FaissEngine(), embeddings, ['SELECT 1;'], [{'type': 'query'}],
+                     errback=lambda: failed.append(True))
+    write_buffer.flush_all()
+
+    assert failed == [True]
+
+
+def test_drain_persists_and_keeps_accepting(index_folder, tenant, embeddings):
+    index_engine = FaissEngine()
+    index_engine.write_index(None, index_engine.read_index_contents(
+        ['SELECT 1;'], embeddings, [{'type': 'query'}]), tenant)
+    write_buffer = WriteBuffer(100, 60)
+    persisted = []
+
+    write_buffer.add(tenant, None, index_engine, embeddings, ['SELECT 2;'], [{'type': 'query'}],
+                     callback=lambda: persisted.append(2))
+    write_buffer.drain()
+    assert persisted == [2]
+
+    write_buffer.add(tenant, None, index_engine, embeddings, ['SELECT 3;'], [{'type': 'query'}],
+                     callback=lambda: persisted.append(3))
+    write_buffer.drain()
+    assert persisted == [2, 3]
+    docsearch = index_engine.read_index(None, embeddings, use_cache=False, name=tenant)
+    assert set(doc.page_content for doc in index_engine.documents(docsearch).values()) == {
+        'SELECT 1;', 'SELECT 2;', 'SELECT 3;'}